@@ -1,537 +1,4026 @@
 import os
+import sys
+import ast
 import json
-from typing import Dict, List
+import math
+import argparse
+import re
+import zlib
+import time
+import random
+import asyncio
+import hashlib
+import string
+import difflib
+import fnmatch
+import unicodedata
+import ipaddress
+import threading
+import contextvars
+from queue import Queue
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
+import httpx
 import streamlit as st
-from anthropic import Anthropic
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from anthropic import AsyncAnthropic, APIConnectionError, APIStatusError, DefaultAsyncHttpxClient
+from anthropic.types import Message
 import sqlite3
+import numpy as np
+try:
+    import fcntl
+except ImportError:  # Windows: 프로세스 간 파일 잠금 없이 동작
+    fcntl = None
 from datetime import datetime
 from typing import Dict
 
 # 환경 변수 로드
 load_dotenv()
 
-# Anthropic 클라이언트 초기화
-anthropic = Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
 MODEL ="claude-3-5-sonnet-20241022"
+# 라우팅 규칙에서 큰 모델이 필요 없는 작업에 쓰는 빠른 모델
+FAST_MODEL = os.getenv("FAST_MODEL", "claude-3-5-haiku-20241022")
+
+# SQLite 연결 설정 (WAL 모드에서는 synchronous=NORMAL이어도 커밋이 손상되지 않습니다)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 10000,
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # 음수는 KiB 단위 (64MB)
+    'temp_store': 'MEMORY',
+}
+
+class ConnectionManager:
+    """DB 파일 하나에 대해 스레드별로 하나의 연결을 열어 재사용합니다."""
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._completed = set()
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_name, timeout=10)
+            conn.row_factory = sqlite3.Row  # 딕셔너리 형태로 결과 반환
+            for name, value in SQLITE_PRAGMAS.items():
+                conn.execute(f"PRAGMA {name} = {value}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """블록이 정상 종료되면 커밋하고 예외가 나면 롤백합니다."""
+        conn = self.connection()
+        with conn:
+            yield conn
+
+    def run_once(self, name: str, fn: Callable):
+        """스키마 생성처럼 프로세스에서 한 번만 필요한 작업을 실행합니다."""
+        with self._lock:
+            if name in self._completed:
+                return
+            fn()
+            self._completed.add(name)
+
+@st.cache_resource
+def get_connection_manager(db_name: str) -> ConnectionManager:
+    """Streamlit 재실행과 세션 사이에서 DB 파일마다 하나의 연결 관리자를 공유합니다."""
+    return ConnectionManager(db_name)
+
+@st.cache_resource
+def get_context_var(name: str, default: Any = None) -> contextvars.ContextVar:
+    """Streamlit은 재실행마다 스크립트를 새로 실행하므로, 캐시된 게이트웨이와 새로 정의된 에이전트가
+    같은 변수를 보도록 이름마다 프로세스에서 하나만 만듭니다."""
+    return contextvars.ContextVar(name, default=default)
+
+# 트레이싱 설정: 요청(최상위 span) 중 TRACE_SAMPLE_RATE 비율만 기록하며 0이면 끔
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.0))
+TRACE_DIR = os.getenv("TRACE_DIR", "traces")
+# 내보낼 형식: chrome (chrome://tracing, Perfetto), otlp (OTLP/JSON)
+TRACE_FORMATS = [name.strip() for name in os.getenv("TRACE_FORMATS", "chrome,otlp").split(",") if name.strip()]
+TRACE_SERVICE_NAME = "middleware-generator"
+
+# 현재 span. 샘플링되지 않은 요청 안에서는 하위 span도 만들지 않도록 NOT_SAMPLED를 넣어 둠
+CURRENT_SPAN = get_context_var('current_span')
+NOT_SAMPLED = 'not_sampled'
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'thread', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, trace: 'Trace', name: str, parent: Optional['Span'], attributes: Dict):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes
+        # 같은 스레드에서 동시에 실행되는 asyncio 작업은 작업별로 구분
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        self.thread = task.get_name() if task else threading.current_thread().name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+class Trace:
+    """요청 하나에서 만들어진 span들을 모읍니다. 여러 스레드에서 동시에 span이 끝날 수 있습니다."""
+    def __init__(self):
+        self.trace_id = os.urandom(16).hex()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+class Tracer:
+    """에이전트 메서드, DB 호출, 검색 단계, LLM 호출을 요청별 부모/자식 span으로 기록하고
+    최상위 span이 끝나면 Chrome trace-event JSON과 OTLP/JSON 파일로 내보냅니다.
+    """
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, output_dir: str = TRACE_DIR,
+                 formats: List[str] = TRACE_FORMATS):
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.formats = formats
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """span을 열고 현재 span으로 설정합니다. 기록하지 않는 요청에서는 None을 반환합니다."""
+        parent = CURRENT_SPAN.get()
+        if parent == NOT_SAMPLED or (parent is None and self.sample_rate <= 0):
+            yield None
+            return
+        if parent is None and random.random() >= self.sample_rate:
+            token = CURRENT_SPAN.set(NOT_SAMPLED)
+            try:
+                yield None
+            finally:
+                CURRENT_SPAN.reset(token)
+            return
+
+        span = Span(parent.trace if parent else Trace(), name, parent, attributes)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            CURRENT_SPAN.reset(token)
+            span.trace.add(span)
+            if parent is None:
+                self.export(span.trace)
+
+    @contextmanager
+    def child_span(self, name: str, **attributes) -> Iterator[Optional[Span]]:
+        """이미 기록 중인 요청 안에서만 span을 엽니다. 백그라운드 작업이 새 trace를 만들지 않게 합니다."""
+        if CURRENT_SPAN.get() in (None, NOT_SAMPLED):
+            yield None
+            return
+        with self.span(name, **attributes) as span:
+            yield span
+
+    def export(self, trace: Trace):
+        exporters = {'chrome': self.to_chrome_trace, 'otlp': self.to_otlp_json}
+        os.makedirs(self.output_dir, exist_ok=True)
+        prefix = os.path.join(self.output_dir, f"{datetime.now():%Y%m%d-%H%M%S}-{trace.trace_id[:8]}")
+        for name in self.formats:
+            with open(f"{prefix}.{name}.json", 'w', encoding='utf-8') as f:
+                json.dump(exporters[name](trace), f, ensure_ascii=False, default=str)
+
+    @staticmethod
+    def to_chrome_trace(trace: Trace) -> Dict:
+        """chrome://tracing이나 Perfetto에서 열 수 있는 trace-event 형식 (완료 이벤트 'X', 시간 단위 µs)"""
+        thread_ids = {}
+        events = []
+        for span in sorted(trace.spans, key=lambda span: span.start_ns):
+            tid = thread_ids.setdefault(span.thread, len(thread_ids) + 1)
+            args = dict(span.attributes, span_id=span.span_id, parent_id=span.parent_id)
+            if span.error:
+                args['error'] = span.error
+            events.append({'name': span.name, 'cat': 'middleware', 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': span.start_ns / 1000, 'dur': (span.end_ns - span.start_ns) / 1000, 'args': args})
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': thread}}
+                      for thread, tid in thread_ids.items())
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'trace_id': trace.trace_id}}
+
+    @staticmethod
+    def to_otlp_json(trace: Trace) -> Dict:
+        """OpenTelemetry 수집기에 그대로 보낼 수 있는 OTLP/JSON ExportTraceServiceRequest 형식"""
+        spans = []
+        for span in trace.spans:
+            attributes = dict(span.attributes, **{'thread.name': span.thread})
+            otlp_span = {
+                'traceId': trace.trace_id, 'spanId': span.span_id, 'name': span.name, 'kind': 1,
+                'startTimeUnixNano': str(span.start_ns), 'endTimeUnixNano': str(span.end_ns),
+                'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+            }
+            if span.parent_id:
+                otlp_span['parentSpanId'] = span.parent_id
+            spans.append(otlp_span)
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': TRACE_SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': TRACE_SERVICE_NAME}, 'spans': spans}],
+        }]}
+
+@st.cache_resource
+def get_tracer() -> Tracer:
+    return Tracer()
+
+tracer = get_tracer()
+
+def traced(method: Callable) -> Callable:
+    """함수 실행을 '클래스.메서드' 이름의 span으로 기록합니다."""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        with tracer.span(method.__qualname__):
+            return method(*args, **kwargs)
+    return wrapper
+
+# LLM 응답 캐시 설정 (모든 Streamlit 프로세스가 같은 SQLite 파일을 공유)
+LLM_CACHE_DB = os.getenv("LLM_CACHE_DB", "middleware_history.db")
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 5000))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024))
+# 이 값보다 temperature가 높은 호출은 다양한 결과를 기대하므로 캐시하지 않습니다. (예시 요청 생성은 0.5)
+# temperature는 캐시 키에 포함되므로 같은 프롬프트라도 temperature가 다르면 다른 항목입니다.
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", 0.3))
+
+class LLMResponseCache:
+    """(model, prompt, temperature, max_tokens) 해시를 키로 LLM 응답을 SQLite에 저장합니다.
+
+    응답은 호출자의 검사(스키마, AST) 전에 저장되므로, 검사에 실패해 다시 요청하면 게이트웨이가 invalidate로 지웁니다.
+    """
+    def __init__(self, db_name: str = LLM_CACHE_DB, ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES, max_bytes: int = LLM_CACHE_MAX_BYTES,
+                 max_temperature: float = LLM_CACHE_MAX_TEMPERATURE):
+        self.db_name = db_name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_temperature = max_temperature
+        self.connections = get_connection_manager(db_name)
+        self.connections.run_once('llm_cache', self.create_schema)
+
+    def create_schema(self):
+        with self.connections.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_accessed REAL,
+                hits INTEGER DEFAULT 0
+            )''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_accessed ON llm_cache (last_accessed)")
+            cursor.execute('''CREATE TABLE IF NOT EXISTS llm_cache_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER
+            )''')
+
+    def accepts(self, params: Dict) -> bool:
+        """캐시 대상 호출인지 확인합니다. temperature가 높은 호출은 제외합니다."""
+        return params.get('temperature', 1.0) <= self.max_temperature
+
+    @staticmethod
+    def make_key(params: Dict) -> str:
+        payload = json.dumps(params, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Message]:
+        now = time.time()
+        with self.connections.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,))
+            row = cursor.fetchone()
+
+            if row and now - row[1] > self.ttl_seconds:
+                cursor.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                row = None
+
+            if row:
+                cursor.execute("UPDATE llm_cache SET last_accessed = ?, hits = hits + 1 WHERE key = ?", (now, key))
+            self._increment(cursor, 'hits' if row else 'misses')
+
+        return Message.model_validate_json(row[0]) if row else None
+
+    def put(self, key: str, model: str, response: Message):
+        now = time.time()
+        payload = response.model_dump_json()
+        with self.connections.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_accessed, hits)
+                VALUES (?, ?, ?, ?, ?, ?, 0)
+            ''', (key, model, payload, len(payload), now, now))
+            self._evict(cursor, now)
+
+    def invalidate(self, key: str):
+        """검사에 실패한 응답을 지워 같은 요청이 다시 받지 않게 합니다."""
+        with self.connections.transaction() as conn:
+            conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+
+    def _evict(self, cursor, now: float):
+        """만료된 항목을 지우고, 개수/용량 한도를 넘으면 가장 오래 사용되지 않은 항목부터 지웁니다."""
+        cursor.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache")
+        count, total_size = cursor.fetchone()
+        if count <= self.max_entries and total_size <= self.max_bytes:
+            return
+
+        cursor.execute("SELECT key, size FROM llm_cache ORDER BY last_accessed ASC")
+        stale_keys = []
+        for key, size in cursor.fetchall():
+            if count <= self.max_entries and total_size <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            count -= 1
+            total_size -= size
+        cursor.executemany("DELETE FROM llm_cache WHERE key = ?", stale_keys)
+
+    @staticmethod
+    def _increment(cursor, name: str):
+        cursor.execute('''
+            INSERT INTO llm_cache_stats (name, value) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1
+        ''', (name,))
+
+    def get_stats(self) -> Dict[str, int]:
+        cursor = self.connections.connection().cursor()
+        cursor.execute("SELECT name, value FROM llm_cache_stats")
+        stats = {'hits': 0, 'misses': 0}
+        stats.update(dict(cursor.fetchall()))
+        cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache")
+        stats['entries'], stats['bytes'] = cursor.fetchone()
+        return stats
+
+# 요구사항 정규화에 쓰는 단위 (값은 바이트 또는 초 단위 배수)
+SIZE_UNITS = {
+    'b': 1, 'byte': 1, 'bytes': 1, '바이트': 1,
+    'kb': 1024, 'kib': 1024, '킬로바이트': 1024,
+    'mb': 1024 ** 2, 'mib': 1024 ** 2, '메가바이트': 1024 ** 2, '메가': 1024 ** 2,
+    'gb': 1024 ** 3, 'gib': 1024 ** 3, '기가바이트': 1024 ** 3, '기가': 1024 ** 3,
+}
+DURATION_UNITS = {
+    'ms': 0.001, 'millisecond': 0.001, 'milliseconds': 0.001, '밀리초': 0.001,
+    's': 1, 'sec': 1, 'secs': 1, 'second': 1, 'seconds': 1, '초': 1,
+    'min': 60, 'mins': 60, 'minute': 60, 'minutes': 60, '분': 60,
+    'h': 3600, 'hr': 3600, 'hrs': 3600, 'hour': 3600, 'hours': 3600, '시간': 3600,
+    'day': 86400, 'days': 86400, '일': 86400,
+}
+# 독립된 숫자 바로 뒤에 붙은 단위 단어만 바꿈 ('100 초과'의 '초'처럼 더 긴 단어의 일부나 '/v1/2ms-report' 같은 경로는 제외)
+UNIT_PATTERN = re.compile(
+    r"(?<![\w./-])(\d+(?:\.\d+)?)\s*("
+    + "|".join(sorted(map(re.escape, {**SIZE_UNITS, **DURATION_UNITS}), key=len, reverse=True)) + r")(?![\w/-])",
+    re.IGNORECASE,
+)
+# 대소문자를 구분하지 않는 값 (의도, 모드, HTTP 메서드, 국가 코드, 헤더 이름). 경로, 헤더 값, 자유 문장은 그대로 둠
+CASE_INSENSITIVE_FIELDS = {'intent', 'mode', 'method', 'methods', 'allowed_methods', 'country', 'countries',
+                           'country_header', 'header_name', 'remove_headers', 'log_headers'}
+# 순서가 의미 없는 목록. 그 외 목록(미들웨어 체인, 처리 단계 등)은 순서를 유지
+UNORDERED_LIST_FIELDS = {'entities', 'requirements', 'constraints', 'countries', 'networks', 'trusted_proxies',
+                         'methods', 'allowed_methods', 'allowed_origins', 'remove_headers', 'log_headers',
+                         'blocked_patterns'}
+
+def _format_number(value: float):
+    return int(value) if float(value).is_integer() else round(value, 6)
+
+def _normalize_units(text: str) -> str:
+    """'1 MB', '1mb', '1메가'는 '1048576b'로, '30 seconds', '30초'는 '30s'로 바꿉니다."""
+    def replace(match: re.Match) -> str:
+        value, unit = float(match.group(1)), match.group(2).casefold()
+        if unit in SIZE_UNITS:
+            return f"{_format_number(value * SIZE_UNITS[unit])}b"
+        return f"{_format_number(value * DURATION_UNITS[unit])}s"
+    return UNIT_PATTERN.sub(replace, text)
+
+def canonicalize_requirements(value: Any, field: Optional[str] = None, in_parameters: bool = False) -> Any:
+    """ParsingAgent 결과에서 의미 없는 차이를 없앱니다.
+
+    키 순서와 표기, 공백, 빈 값은 항상 정규화합니다. 대소문자는 CASE_INSENSITIVE_FIELDS의 값만,
+    단위 표기는 parameters 아래의 값만, 배열 순서는 UNORDERED_LIST_FIELDS만 정규화합니다.
+    field는 값이 들어 있는 키 이름입니다(목록이면 목록의 키).
+    """
+    if isinstance(value, dict):
+        items = {}
+        for key, item in value.items():
+            key = re.sub(r"[\s\-]+", "_", unicodedata.normalize('NFKC', str(key)).strip().casefold())
+            item = canonicalize_requirements(item, key, in_parameters or key == 'parameters')
+            if item not in (None, "", [], {}):
+                items[key] = item
+        return dict(sorted(items.items()))
+    if isinstance(value, (list, tuple)):
+        items = [canonicalize_requirements(item, field, in_parameters) for item in value]
+        items = [item for item in items if item not in (None, "", [], {})]
+        if field not in UNORDERED_LIST_FIELDS:
+            return items
+        return sorted(items, key=lambda item: json.dumps(item, ensure_ascii=False, sort_keys=True))
+    if isinstance(value, str):
+        text = " ".join(unicodedata.normalize('NFKC', value).split())
+        if field in CASE_INSENSITIVE_FIELDS:
+            text = text.casefold()
+        if in_parameters:
+            text = _normalize_units(text)
+        return text.rstrip(".")
+    if isinstance(value, float):
+        return _format_number(value)
+    return value
+
+def requirements_hash(requirements: Dict) -> str:
+    canonical = canonicalize_requirements(requirements)
+    payload = json.dumps(canonical, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def generation_cache_key(requirements: Dict) -> str:
+    """요구사항 해시에 모델 설정(기본/빠른 모델, 라우팅 규칙)을 더한 생성 결과 캐시 키입니다. 모델이 바뀌면 다시 생성합니다."""
+    models = json.dumps([MODEL, FAST_MODEL, MODEL_ROUTES], sort_keys=True)
+    return hashlib.sha256(f"{requirements_hash(requirements)}:{models}".encode('utf-8')).hexdigest()
+
+# 요구사항 해시로 캐시하는 파이프라인 단계 (문서와 검증은 코드에서 만들어지므로 코드와 함께 관리)
+GENERATION_CACHE_STAGES = ['code', 'documentation', 'validation', 'validation_report']
+# 값이 딕셔너리라 JSON으로 저장하는 단계
+GENERATION_CACHE_JSON_STAGES = {'validation_report'}
+
+class GenerationCache:
+    """정규화한 요구사항과 모델 설정의 해시(generation_cache_key)를 키로 생성된 코드, 문서, 검증 결과를 SQLite에 저장합니다.
+
+    표현이 달라도 같은 요구사항으로 분석된 요청은 비싼 생성 단계를 건너뜁니다.
+    """
+    def __init__(self, db_name: str = LLM_CACHE_DB, ttl_seconds: int = LLM_CACHE_TTL_SECONDS,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.connections = get_connection_manager(db_name)
+        self.connections.run_once('generation_cache', self.create_schema)
+
+    def create_schema(self):
+        with self.connections.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS generation_cache (
+                requirements_hash TEXT PRIMARY KEY,
+                requirements TEXT,
+                code TEXT,
+                documentation TEXT,
+                validation TEXT,
+                created_at REAL,
+                last_accessed REAL,
+                hits INTEGER DEFAULT 0,
+                validation_report TEXT
+            )''')
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(generation_cache)")]
+            if 'validation_report' not in columns:
+                conn.execute("ALTER TABLE generation_cache ADD COLUMN validation_report TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_generation_cache_last_accessed ON generation_cache (last_accessed)")
+
+    @traced
+    def get(self, key: str) -> Dict[str, Any]:
+        """저장된 단계 결과를 반환합니다. 코드가 없으면 문서/검증도 쓰지 않습니다."""
+        now = time.time()
+        with self.connections.transaction() as conn:
+            row = conn.execute(
+                f"SELECT {', '.join(GENERATION_CACHE_STAGES)}, created_at FROM generation_cache WHERE requirements_hash = ?",
+                (key,)
+            ).fetchone()
+            if row is None or row['code'] is None or now - row['created_at'] > self.ttl_seconds:
+                return {}
+            conn.execute("UPDATE generation_cache SET last_accessed = ?, hits = hits + 1 WHERE requirements_hash = ?",
+                         (now, key))
+        return {stage: json.loads(row[stage]) if stage in GENERATION_CACHE_JSON_STAGES else row[stage]
+                for stage in GENERATION_CACHE_STAGES if row[stage]}
+
+    @traced
+    def put(self, key: str, requirements: Dict, stage: str, value: Any):
+        """단계 결과를 저장합니다. 코드가 새로 저장되면 이전 코드로 만든 문서/검증은 지웁니다."""
+        now = time.time()
+        with self.connections.transaction() as conn:
+            if stage == 'code':
+                conn.execute('''
+                    INSERT OR REPLACE INTO generation_cache
+                    (requirements_hash, requirements, code, created_at, last_accessed, hits)
+                    VALUES (?, ?, ?, ?, ?, 0)
+                ''', (key, json.dumps(canonicalize_requirements(requirements), ensure_ascii=False), value, now, now))
+                self._evict(conn, now)
+            else:
+                if stage in GENERATION_CACHE_JSON_STAGES:
+                    value = json.dumps(value, ensure_ascii=False)
+                conn.execute(f"UPDATE generation_cache SET {stage} = ? WHERE requirements_hash = ?", (value, key))
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM generation_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        conn.execute('''
+            DELETE FROM generation_cache WHERE requirements_hash IN (
+                SELECT requirements_hash FROM generation_cache ORDER BY last_accessed DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries,))
+
+    def get_stats(self) -> Dict[str, int]:
+        row = self.connections.connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM generation_cache"
+        ).fetchone()
+        return {'entries': row[0], 'hits': row[1]}
+
+@st.cache_resource
+def get_generation_cache() -> GenerationCache:
+    return GenerationCache()
+
+# LLM 호출 기록 설정
+LLM_TELEMETRY_DB = os.getenv("LLM_TELEMETRY_DB", LLM_CACHE_DB)
+LLM_TELEMETRY_RETENTION_DAYS = int(os.getenv("LLM_TELEMETRY_RETENTION_DAYS", 30))
+
+# 현재 LLM을 호출하는 (에이전트, 메서드). track_llm_calls가 설정하고 게이트웨이가 기록에 사용합니다.
+LLM_CALL_CONTEXT = get_context_var('llm_call_context', ('unknown', 'unknown'))
+
+def _stream_in_context(context: contextvars.Context, scope, chunks: Iterator) -> Iterator:
+    """스트림을 context 안에서 읽으며, 다 읽거나 닫거나 예외가 날 때 span(scope)을 닫습니다."""
+    try:
+        while True:
+            try:
+                chunk = context.run(next, chunks)
+            except StopIteration:
+                break
+            yield chunk
+    except GeneratorExit:
+        # 호출자가 중간에 읽기를 멈춘 것은 오류가 아님
+        if hasattr(chunks, 'close'):
+            context.run(chunks.close)
+        context.run(scope.__exit__, None, None, None)
+        raise
+    except BaseException as e:
+        context.run(scope.__exit__, type(e), e, e.__traceback__)
+        raise
+    context.run(scope.__exit__, None, None, None)
+
+def track_llm_calls(method: Callable) -> Callable:
+    """메서드 안에서 일어나는 LLM 호출을 '클래스 이름, 메서드 이름'으로 기록하도록 호출 컨텍스트를 설정하고
+    메서드 실행을 span으로 기록합니다.
+
+    *_stream 메서드처럼 iterator를 반환하면 LLM 호출은 읽을 때 일어나므로, 다 읽거나 닫을 때까지 span을 열어 둡니다.
+    호출 컨텍스트와 span은 복사한 컨텍스트 안에서만 설정되어 호출자의 컨텍스트를 바꾸지 않습니다.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        agent, name = type(self).__name__, method.__name__
+        context = contextvars.copy_context()
+        context.run(LLM_CALL_CONTEXT.set, (agent, name))
+        scope = tracer.span(f"{agent}.{name}")
+        context.run(scope.__enter__)
+        try:
+            result = context.run(method, self, *args, **kwargs)
+        except BaseException as e:
+            context.run(scope.__exit__, type(e), e, e.__traceback__)
+            raise
+        if isinstance(result, Iterator):
+            return _stream_in_context(context, scope, result)
+        context.run(scope.__exit__, None, None, None)
+        return result
+    return wrapper
+
+def percentile(values: List[float], q: float) -> float:
+    """nearest-rank 방식의 백분위수를 계산합니다."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+class LLMTelemetry:
+    """LLM 호출마다 에이전트, 메서드, 모델, 토큰 사용량, 지연 시간, 결과를 llm_calls 테이블에 기록합니다."""
+    def __init__(self, db_name: str = LLM_TELEMETRY_DB, retention_days: int = LLM_TELEMETRY_RETENTION_DAYS):
+        self.db_name = db_name
+        self.retention_days = retention_days
+        self.connections = get_connection_manager(db_name)
+        self.connections.run_once('llm_calls', self.create_schema)
+
+    def create_schema(self):
+        with self.connections.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS llm_calls (
+                id INTEGER PRIMARY KEY,
+                created_at REAL,
+                agent TEXT,
+                method TEXT,
+                model TEXT,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                cache_read_tokens INTEGER,
+                cache_write_tokens INTEGER,
+                latency_ms REAL,
+                first_token_ms REAL,
+                retries INTEGER,
+                outcome TEXT,
+                error TEXT,
+                escalated INTEGER DEFAULT 0
+            )''')
+            # 이전 스키마로 만들어진 테이블에는 모델 승격 여부 컬럼을 추가
+            columns = [row['name'] for row in cursor.execute("PRAGMA table_info(llm_calls)")]
+            if 'escalated' not in columns:
+                cursor.execute("ALTER TABLE llm_calls ADD COLUMN escalated INTEGER DEFAULT 0")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_created_at ON llm_calls (created_at)")
+            # 보관 기간이 지난 기록은 프로세스 시작 시 정리
+            cursor.execute("DELETE FROM llm_calls WHERE created_at < ?",
+                           (time.time() - self.retention_days * 86400,))
+
+    def record(self, call: Dict):
+        """게이트웨이가 만든 호출 정보를 저장합니다. 캐시 적중은 토큰을 사용하지 않았으므로 0으로 기록합니다."""
+        usage = call.get('usage')
+        with self.connections.transaction() as conn:
+            conn.execute('''
+                INSERT INTO llm_calls (created_at, agent, method, model, input_tokens, output_tokens,
+                                       cache_read_tokens, cache_write_tokens, latency_ms, first_token_ms,
+                                       retries, outcome, error, escalated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                call['created_at'], call['agent'], call['method'], call['model'],
+                getattr(usage, 'input_tokens', None) or 0,
+                getattr(usage, 'output_tokens', None) or 0,
+                getattr(usage, 'cache_read_input_tokens', None) or 0,
+                getattr(usage, 'cache_creation_input_tokens', None) or 0,
+                call['latency_ms'], call.get('first_token_ms'), call.get('retries', 0),
+                call['outcome'], call.get('error'), int(call.get('escalated', False)),
+            ))
+
+    def get_calls(self, since: float) -> List[sqlite3.Row]:
+        cursor = self.connections.connection().cursor()
+        cursor.execute("SELECT * FROM llm_calls WHERE created_at >= ? ORDER BY created_at", (since,))
+        return cursor.fetchall()
+
+    @staticmethod
+    def summarize(calls: List[sqlite3.Row], keys: Tuple[str, ...] = ('agent', 'method')) -> List[Dict]:
+        """keys 컬럼(기본은 에이전트, 메서드)별 호출 수, 오류/캐시 적중/모델 승격 수, 지연 시간 백분위수,
+        토큰 사용량과 처리량, 접두사 캐시 읽기 비율을 계산합니다.
+
+        지연 시간과 처리량은 실제로 API를 호출해 성공한 호출만으로 계산합니다.
+        """
+        groups = {}
+        for call in calls:
+            groups.setdefault(tuple(call[key] or '' for key in keys), []).append(call)
+
+        summary = []
+        for group_key, group in sorted(groups.items()):
+            completed = [call for call in group if call['outcome'] == 'ok']
+            latencies = [call['latency_ms'] for call in completed]
+            first_tokens = [call['first_token_ms'] for call in completed if call['first_token_ms'] is not None]
+            output_tokens = sum(call['output_tokens'] for call in completed)
+            cache_read_tokens = sum(call['cache_read_tokens'] for call in completed)
+            prompt_tokens = sum(call['input_tokens'] + call['cache_read_tokens'] + call['cache_write_tokens']
+                                for call in completed)
+            summary.append({
+                **dict(zip(keys, group_key)),
+                'calls': len(group),
+                'escalations': sum(1 for call in group if call['escalated']),
+                'errors': sum(1 for call in group if call['outcome'] == 'error'),
+                'cache_hits': sum(1 for call in group if call['outcome'] == 'cache_hit'),
+                **{f"p{q}_ms": percentile(latencies, q) for q in (50, 95, 99)},
+                'p50_first_token_ms': percentile(first_tokens, 50),
+                'input_tokens': sum(call['input_tokens'] for call in completed),
+                'output_tokens': output_tokens,
+                'cache_read_tokens': cache_read_tokens,
+                'cache_write_tokens': sum(call['cache_write_tokens'] for call in completed),
+                # 입력(프롬프트) 토큰 중 접두사 캐시에서 읽은 비율
+                'prompt_cache_read_ratio': cache_read_tokens / prompt_tokens if prompt_tokens else 0.0,
+                'output_tokens_per_second': output_tokens / (sum(latencies) / 1000) if latencies else 0.0,
+            })
+        return summary
+
+# LLM 요청 스케줄러 설정 (조직의 rate limit에 맞게 조정)
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", 50))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", 40000))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", 1.0))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", 60.0))
+# 재시도할 HTTP 상태 코드 (요청 시간 초과, 충돌, rate limit, 서버 오류, 과부하)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+class TokenBucket:
+    """분당 허용량을 일정한 속도로 다시 채우는 토큰 버킷입니다."""
+    def __init__(self, capacity_per_minute: int):
+        self.capacity = float(capacity_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay_for(self, amount: float) -> float:
+        """amount만큼 사용할 수 있을 때까지 기다려야 하는 시간(초)을 반환합니다."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class RequestScheduler:
+    """요청 수/토큰 수 버킷과 동시 실행 한도를 함께 적용하는 비동기 스케줄러입니다."""
+    def __init__(self, requests_per_minute: int = LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # 먼저 도착한 요청이 먼저 버킷을 사용하도록 대기열을 직렬화
+        self._queue_lock = asyncio.Lock()
+
+    @staticmethod
+    def estimate_tokens(params: Dict) -> int:
+        """입력 길이와 max_tokens로 사용할 토큰 수를 보수적으로 추정합니다."""
+        prompt = json.dumps(
+            [params.get('system', ''), params.get('messages', []), params.get('tools', [])],
+            ensure_ascii=False, default=str
+        )
+        # 한글은 글자당 토큰 수가 많으므로 2글자당 1토큰으로 계산
+        return len(prompt) // 2 + params.get('max_tokens', 0)
+
+    async def acquire(self, estimated_tokens: int):
+        await self._semaphore.acquire()
+        try:
+            async with self._queue_lock:
+                while True:
+                    delay = max(self.request_bucket.delay_for(1),
+                                self.token_bucket.delay_for(estimated_tokens))
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.request_bucket.consume(1)
+                self.token_bucket.consume(estimated_tokens)
+        except BaseException:
+            self._semaphore.release()
+            raise
+
+    def release(self, estimated_tokens: int, used_tokens: Optional[int] = None):
+        """실제 사용량이 추정치보다 적으면 차이만큼 토큰 버킷에 돌려줍니다."""
+        if used_tokens is not None:
+            self.token_bucket.refund(estimated_tokens - used_tokens)
+        self._semaphore.release()
+
+def is_retryable_error(error: Exception) -> bool:
+    if isinstance(error, APIConnectionError):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS_CODES
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """서버가 retry-after를 주면 따르고, 아니면 지수 백오프에 지터를 더한 대기 시간을 계산합니다."""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_BACKOFF_MAX_SECONDS)
+        except ValueError:
+            pass
+    delay = min(LLM_BACKOFF_MAX_SECONDS, LLM_BACKOFF_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+# 에이전트가 model로 넘기면 게이트웨이가 라우팅 규칙으로 실제 모델을 고릅니다.
+ROUTED_MODEL = "routed"
+# "에이전트.메서드" 패턴(fnmatch)별 모델과 입력 토큰 상한. 위에서부터 처음 일치하는 규칙을 쓰며,
+# 일치하는 규칙이 없거나 입력이 max_input_tokens를 넘으면 MODEL을 씁니다. MODEL_ROUTES(JSON 배열)로 바꿀 수 있습니다.
+DEFAULT_MODEL_ROUTES = [
+    {"route": "ParsingAgent.*", "model": FAST_MODEL, "max_input_tokens": 4000},
+    {"route": "SampleRequestAgent.*", "model": FAST_MODEL},
+    {"route": "MiddlewareAgent.verify_improvements", "model": FAST_MODEL, "max_input_tokens": 8000},
+    {"route": "DocumentationAgent.*", "model": FAST_MODEL, "max_input_tokens": 8000},
+]
+MODEL_ROUTES = json.loads(os.getenv("MODEL_ROUTES", "null")) or DEFAULT_MODEL_ROUTES
+
+class ModelRouter:
+    """에이전트/메서드와 입력 크기로 호출마다 사용할 모델을 고릅니다.
+
+    빠른 모델의 응답이 스키마나 AST 검사를 통과하지 못해 escalate로 다시 요청하면 기본 모델을 씁니다.
+    """
+    def __init__(self, routes: List[Dict] = MODEL_ROUTES, default_model: str = MODEL):
+        self.routes = routes
+        self.default_model = default_model
+
+    @staticmethod
+    def input_tokens(params: Dict) -> int:
+        return estimate_prompt_tokens(json.dumps(
+            [params.get('system', ''), params.get('messages', []), params.get('tools', [])],
+            ensure_ascii=False, default=str
+        ))
+
+    def select(self, agent: str, method: str, params: Dict, escalate: bool = False) -> str:
+        if escalate:
+            return self.default_model
+        route = f"{agent}.{method}"
+        for rule in self.routes:
+            if fnmatch.fnmatchcase(route, rule['route']):
+                if self.input_tokens(params) <= rule.get('max_input_tokens', math.inf):
+                    return rule['model']
+                break
+        return self.default_model
+
+class LLMGateway:
+    """모든 에이전트가 공유하는 LLM 호출 진입점입니다.
+
+    동일한 요청은 캐시된 응답을 반환하고, 나머지는 하나의 AsyncAnthropic 클라이언트(keep-alive 연결 풀)로
+    보내며 스케줄러로 rate limit을 지키고 재시도 가능한 오류는 백오프 후 다시 시도합니다.
+    동기 코드에서도 쓸 수 있도록 전용 이벤트 루프 스레드에서 요청을 실행합니다.
+    telemetry가 주어지면 모든 호출의 토큰 사용량과 지연 시간을 호출한 에이전트/메서드별로 기록합니다.
+    model이 ROUTED_MODEL인 요청은 router가 고른 모델로 보냅니다.
+    """
+    def __init__(self, client: AsyncAnthropic, cache: Optional[LLMResponseCache] = None,
+                 scheduler: Optional[RequestScheduler] = None, max_retries: int = LLM_MAX_RETRIES,
+                 telemetry: Optional[LLMTelemetry] = None, router: Optional[ModelRouter] = None):
+        self.client = client
+        self.cache = cache
+        self.telemetry = telemetry
+        self.scheduler = scheduler or RequestScheduler()
+        self.router = router or ModelRouter()
+        self.max_retries = max_retries
+        self.messages = _GatewayMessages(self)
+
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+        self._loop_thread.start()
+
+    def create_message(self, use_cache: bool = True, **params) -> Message:
+        """동기 호출용 진입점입니다. 게이트웨이 이벤트 루프에서 요청을 실행하고 결과를 기다립니다."""
+        # 이벤트 루프 스레드에는 contextvar가 전달되지 않으므로 호출 컨텍스트(에이전트/메서드, 현재 span)를 직접 넘김
+        future = asyncio.run_coroutine_threadsafe(
+            self.acreate_message(use_cache, context=contextvars.copy_context(), **params), self._loop
+        )
+        return future.result()
+
+    def stream_text(self, use_cache: bool = True, context: Optional[contextvars.Context] = None,
+                    **params) -> Iterator[str]:
+        """messages.stream으로 생성되는 텍스트 조각을 도착하는 대로 반환하는 동기 제너레이터입니다.
+
+        캐시된 응답은 한 번에 전체 텍스트로 반환됩니다. 제너레이터는 처음 읽을 때 실행되므로
+        호출 컨텍스트는 호출 시점에 context로 받습니다.
+        """
+        chunks = Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._stream_into(chunks, use_cache, context, params), self._loop
+        )
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _STREAM_END:
+                    break
+                yield chunk
+            future.result()
+        finally:
+            # 호출자가 중간에 읽기를 멈추면 진행 중인 요청도 취소
+            future.cancel()
+
+    async def _stream_into(self, chunks: Queue, use_cache: bool, context: Optional[contextvars.Context],
+                           params: Dict):
+        try:
+            await self.acreate_message(use_cache, on_text=chunks.put, context=context, **params)
+        finally:
+            chunks.put(_STREAM_END)
+
+    async def acreate_message(self, use_cache: bool = True, on_text: Optional[Callable[[str], None]] = None,
+                              context: Optional[contextvars.Context] = None, escalate: bool = False,
+                              **params) -> Message:
+        """on_text가 주어지면 스트리밍으로 요청하고 텍스트 조각마다 on_text를 호출합니다.
+
+        context는 호출한 스레드의 contextvar 값이며, 이 작업 안에서만 적용됩니다.
+        escalate는 응답이 스키마/AST 검사를 통과하지 못해 다시 요청할 때 쓰며, 라우팅된 요청은 기본 모델로 보냅니다.
+        모델이 바뀐 경우만 승격(escalated)으로 기록합니다. 다시 요청할 때는 첫 요청의 (검사에 실패한) 캐시 항목을
+        지우고, 재시도 응답은 아직 검사하지 않았으므로 캐시를 읽거나 쓰지 않습니다.
+        """
+        for var, value in (context or {}).items():
+            var.set(value)
+        agent, method = LLM_CALL_CONTEXT.get()
+        escalated = False
+        first_params = params
+        if params.get('model') == ROUTED_MODEL:
+            first_params = {**params, 'model': self.router.select(agent, method, params)}
+            model = self.router.select(agent, method, params, escalate)
+            escalated = escalate and model != first_params['model']
+            params = {**params, 'model': model}
+        if escalate:
+            use_cache = False
+            if self.cache is not None:
+                failed_key = self.cache.make_key(with_prompt_cache_breakpoint(first_params))
+                await asyncio.to_thread(self.cache.invalidate, failed_key)
+        params = with_prompt_cache_breakpoint(params)
+        with tracer.span('llm.call', agent=agent, method=method, model=params['model'], escalated=escalated) as span:
+            return await self._create_message(use_cache, on_text, agent, method, escalated, span, params)
+
+    async def _create_message(self, use_cache: bool, on_text: Optional[Callable[[str], None]],
+                              agent: str, method: str, escalated: bool, span: Optional[Span],
+                              params: Dict) -> Message:
+        call = {'created_at': time.time(), 'agent': agent, 'method': method, 'model': params.get('model'),
+                'escalated': escalated, 'outcome': 'ok', 'retries': 0}
+        started_at = time.perf_counter()
+        if on_text is not None:
+            emit = on_text
+
+            def on_text(text: str):
+                if 'first_token_ms' not in call:
+                    call['first_token_ms'] = (time.perf_counter() - started_at) * 1000
+                emit(text)
+
+        try:
+            cacheable = use_cache and self.cache is not None and self.cache.accepts(params)
+            if cacheable:
+                key = self.cache.make_key(params)
+                with tracer.span('llm.cache_lookup'):
+                    cached = await asyncio.to_thread(self.cache.get, key)
+                if cached is not None:
+                    call['outcome'] = 'cache_hit'
+                    if span is not None:
+                        span.set(cache_hit=True)
+                    if on_text is not None:
+                        on_text(cached.content[0].text)
+                    return cached
+
+            response = await self._send(params, on_text, call)
+            call['usage'] = response.usage
+            if span is not None:
+                span.set(input_tokens=response.usage.input_tokens, output_tokens=response.usage.output_tokens,
+                         cache_read_tokens=getattr(response.usage, 'cache_read_input_tokens', None) or 0,
+                         cache_write_tokens=getattr(response.usage, 'cache_creation_input_tokens', None) or 0)
+
+            if cacheable:
+                with tracer.span('llm.cache_store'):
+                    await asyncio.to_thread(self.cache.put, key, params['model'], response)
+            return response
+        except asyncio.CancelledError:
+            call['outcome'] = 'cancelled'
+            raise
+        except Exception as e:
+            call['outcome'], call['error'] = 'error', type(e).__name__
+            raise
+        finally:
+            if self.telemetry is not None:
+                call['latency_ms'] = (time.perf_counter() - started_at) * 1000
+                # 기록은 응답을 기다리게 하지 않도록 작업 스레드에서 처리
+                self._loop.run_in_executor(None, self.telemetry.record, call)
+
+    async def _send(self, params: Dict, on_text: Optional[Callable[[str], None]] = None,
+                    call: Optional[Dict] = None) -> Message:
+        estimated_tokens = self.scheduler.estimate_tokens(params)
+        attempt = 0
+        streamed = False
+        while True:
+            # rate limit/동시 실행 한도 대기와 실제 API 요청 시간을 구분해 기록
+            with tracer.span('llm.queue', estimated_tokens=estimated_tokens):
+                await self.scheduler.acquire(estimated_tokens)
+            used_tokens = None
+            try:
+                with tracer.span('llm.request', attempt=attempt, stream=on_text is not None):
+                    if on_text is None:
+                        response = await self.client.messages.create(**params)
+                    else:
+                        async with self.client.messages.stream(**params) as stream:
+                            async for text in stream.text_stream:
+                                streamed = True
+                                on_text(text)
+                            response = await stream.get_final_message()
+                used_tokens = response.usage.input_tokens + response.usage.output_tokens
+                return response
+            except Exception as e:
+                # 이미 일부 텍스트를 내보낸 스트림은 중복 출력을 막기 위해 재시도하지 않습니다.
+                if streamed or attempt >= self.max_retries or not is_retryable_error(e):
+                    raise
+                delay = backoff_delay(attempt, e)
+            finally:
+                self.scheduler.release(estimated_tokens, used_tokens)
+            attempt += 1
+            if call is not None:
+                call['retries'] = attempt
+            await asyncio.sleep(delay)
+
+# stream_text 대기열의 종료 표시
+_STREAM_END = object()
+
+class _GatewayMessages:
+    """에이전트가 기존처럼 client.messages.create(...)로 게이트웨이를 호출할 수 있게 합니다."""
+    def __init__(self, gateway: LLMGateway):
+        self._gateway = gateway
+
+    def create(self, **params) -> Message:
+        return self._gateway.create_message(**params)
+
+    def stream_text(self, **params) -> Iterator[str]:
+        return self._gateway.stream_text(context=contextvars.copy_context(), **params)
+
+@st.cache_resource
+def get_llm_gateway() -> LLMGateway:
+    """Streamlit 재실행과 세션 사이에서 공유되는 프로세스 단위 게이트웨이를 만듭니다."""
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY * 2,
+                            max_keepalive_connections=LLM_MAX_CONCURRENCY,
+                            keepalive_expiry=60)
+    )
+    client = AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), http_client=http_client, max_retries=0)
+    return LLMGateway(client, LLMResponseCache(), telemetry=LLMTelemetry())
+
+# Anthropic 클라이언트 초기화
+anthropic = get_llm_gateway()
+
+# 히스토리 탭에서 한 번에 보여주는 항목 수
+HISTORY_PAGE_SIZE = 20
+
+# 전문 검색 설정: unicode61은 한글을 공백 단위로 나누므로 접두사 검색과 조사 제거로 활용형을 찾습니다.
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+FTS_INPUT_TEXT_WEIGHT = 2.0
+# 검색어 끝에서 떼어낼 한국어 조사/어미 (긴 것부터 검사)
+KOREAN_SUFFIXES = ('에서', '으로', '에게', '까지', '부터', '해줘', '하는', '해서',
+                   '을', '를', '이', '가', '은', '는', '의', '에', '로', '와', '과', '도')
+
+def build_fts_query(query: str) -> str:
+    """검색어를 단어별 접두사 검색을 OR로 묶은 FTS5 MATCH 식으로 바꿉니다."""
+    terms = []
+    for word in re.findall(r"\w+", query.lower()):
+        # '러시아로부터'처럼 조사가 겹친 경우도 있어 더 떼어낼 것이 없을 때까지 반복
+        stripped = True
+        while stripped:
+            stripped = False
+            for suffix in KOREAN_SUFFIXES:
+                if word.endswith(suffix) and len(word) - len(suffix) >= 2:
+                    word = word[:-len(suffix)]
+                    stripped = True
+                    break
+        terms.append(f'"{word}"*')
+    return " OR ".join(dict.fromkeys(terms))
 
 class MiddlewareDatabase:
     def __init__(self, db_name: str = 'middleware_history.db'):
         self.db_name = db_name
-        self.create_schema()
+        self.connections = get_connection_manager(db_name)
+        self.embedding_manager = EmbeddingManager()
+        # 스키마 생성/마이그레이션은 프로세스당 한 번만 실행
+        self.connections.run_once('middleware_history', self.create_schema)
+        # FTS 색인과 임베딩은 백그라운드 색인기가 변경 로그를 따라 갱신
+        self.indexer = get_history_indexer(db_name)
 
     def create_schema(self):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS middleware_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT,
-            input_text TEXT,
-            requirements TEXT,
-            initial_code TEXT,
-            initial_documentation TEXT,
-            validation TEXT,
-            improved_code TEXT,
-            improved_documentation TEXT
+        with self.connections.transaction() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS middleware_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT,
+                input_text TEXT,
+                requirements TEXT,
+                initial_code TEXT,
+                initial_documentation TEXT,
+                validation TEXT,
+                improved_code TEXT,
+                improved_documentation TEXT,
+                date TEXT GENERATED ALWAYS AS (substr(timestamp, 1, 10)) VIRTUAL,
+                validation_report TEXT,
+                request_key TEXT
+            )''')
+            # 이전 스키마로 만들어진 테이블에는 날짜 생성 컬럼, 구조화된 검증 결과 컬럼, 요청 키 컬럼을 추가
+            columns = [row['name'] for row in conn.execute("PRAGMA table_xinfo(middleware_history)")]
+            if 'date' not in columns:
+                conn.execute('''ALTER TABLE middleware_history
+                    ADD COLUMN date TEXT GENERATED ALWAYS AS (substr(timestamp, 1, 10)) VIRTUAL''')
+            if 'validation_report' not in columns:
+                conn.execute("ALTER TABLE middleware_history ADD COLUMN validation_report TEXT")
+            if 'request_key' not in columns:
+                conn.execute("ALTER TABLE middleware_history ADD COLUMN request_key TEXT")
+            # 배치 요청은 요청 키로 한 번만 저장 (재시작으로 다시 처리해도 히스토리가 중복되지 않음)
+            conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_middleware_history_request_key
+                ON middleware_history (request_key) WHERE request_key IS NOT NULL''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_middleware_history_timestamp ON middleware_history (timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_middleware_history_date ON middleware_history (date, timestamp)")
+            # 히스토리 텍스트 조각별 임베딩 (float32 또는 int8 벡터를 BLOB으로 저장, int8이면 스케일을 함께 저장)
+            conn.execute('''CREATE TABLE IF NOT EXISTS embeddings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                history_id INTEGER,
+                field TEXT,
+                chunk_index INTEGER,
+                text TEXT,
+                embedding BLOB,
+                embedding_scale REAL
+            )''')
+            embedding_columns = [row['name'] for row in conn.execute("PRAGMA table_info(embeddings)")]
+            if 'embedding_scale' not in embedding_columns:
+                conn.execute("ALTER TABLE embeddings ADD COLUMN embedding_scale REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_history_id ON embeddings (history_id)")
+            fts_created = self._create_fts(conn)
+            change_log_created = self._create_change_log(conn)
+            if fts_created or change_log_created:
+                # 색인이 생기기 전에 저장된 행을 모두 색인 대상으로 등록
+                conn.execute("INSERT INTO history_changes (history_id, op) SELECT id, 'upsert' FROM middleware_history")
+
+    @staticmethod
+    def _create_fts(conn: sqlite3.Connection) -> bool:
+        """input_text와 requirements에 대한 FTS5 색인을 만듭니다. 새로 만들었으면 True를 반환합니다.
+
+        색인 내용은 HistoryIndexer가 변경 로그를 따라 채우므로 원본 테이블과 별도로 텍스트를 보관합니다.
+        """
+        row = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'middleware_history_fts'"
+        ).fetchone()
+        if row and "content=" in row['sql']:
+            # 이전 버전의 external content 색인과 동기화 트리거는 지우고 새로 만듦
+            for trigger in ('insert', 'delete', 'update'):
+                conn.execute(f"DROP TRIGGER IF EXISTS middleware_history_fts_{trigger}")
+            conn.execute("DROP TABLE middleware_history_fts")
+            row = None
+        conn.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS middleware_history_fts USING fts5(
+            input_text, requirements,
+            tokenize='{FTS_TOKENIZER}'
         )''')
-        conn.commit()
-        conn.close()
+        return row is None
 
-    def save_results(self, initial_result, improved_result=None):
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO middleware_history 
-            (timestamp, input_text, requirements, initial_code, 
-             initial_documentation, validation, improved_code, improved_documentation)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+    @staticmethod
+    def _create_change_log(conn: sqlite3.Connection) -> bool:
+        """히스토리 행의 추가/수정/삭제를 트리거로 history_changes에 기록합니다.
+
+        새로 만들었거나 색인 대상 열이 바뀌어 전체를 다시 색인해야 하면 True를 반환합니다.
+        """
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_changes'"
+        ).fetchone()
+        update_trigger = conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'middleware_history_changes_update'"
+        ).fetchone()
+        outdated = update_trigger is not None and 'improved_code' not in update_trigger['sql']
+        if outdated:
+            # 코드 열을 임베딩하기 전의 트리거: 코드 열 수정도 기록하도록 다시 만듦
+            conn.execute("DROP TRIGGER middleware_history_changes_update")
+        conn.execute('''CREATE TABLE IF NOT EXISTS history_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            history_id INTEGER,
+            op TEXT
+        )''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS middleware_history_changes_insert
+            AFTER INSERT ON middleware_history BEGIN
+                INSERT INTO history_changes (history_id, op) VALUES (new.id, 'upsert');
+            END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS middleware_history_changes_update
+            AFTER UPDATE OF input_text, requirements, initial_code, improved_code ON middleware_history BEGIN
+                INSERT INTO history_changes (history_id, op) VALUES (new.id, 'upsert');
+            END''')
+        conn.execute('''CREATE TRIGGER IF NOT EXISTS middleware_history_changes_delete
+            AFTER DELETE ON middleware_history BEGIN
+                INSERT INTO history_changes (history_id, op) VALUES (old.id, 'delete');
+            END''')
+        return exists is None or outdated
+
+    @traced
+    def search_history(self, query: str, limit: int = 3) -> List[Dict]:
+        """FTS5 색인에서 bm25 점수가 높은 순서로 히스토리를 검색합니다."""
+        match = build_fts_query(query)
+        if not match:
+            return []
+        cursor = self.connections.connection().execute('''
+            SELECT h.*, bm25(middleware_history_fts, ?, 1.0) AS score
+            FROM middleware_history_fts
+            JOIN middleware_history h ON h.id = middleware_history_fts.rowid
+            WHERE middleware_history_fts MATCH ?
+            ORDER BY score
+            LIMIT ?
+        ''', (FTS_INPUT_TEXT_WEIGHT, match, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+    def reset(self):
+        """히스토리 테이블을 비우고 스키마를 다시 만듭니다."""
+        with self.connections.transaction() as conn:
+            conn.execute("DROP TABLE IF EXISTS middleware_history")
+            conn.execute("DROP TABLE IF EXISTS middleware_history_fts")
+            # 임베딩 id와 변경 순번이 재사용되지 않도록 테이블을 지우지 않고 비움 (AUTOINCREMENT 시퀀스 유지)
+            conn.execute("DELETE FROM embeddings")
+            conn.execute("DELETE FROM history_changes")
+        self.create_schema()
+
+    @staticmethod
+    def _history_row(initial_result: Dict, improved_result: Dict = None) -> Tuple:
+        return (
             datetime.now().isoformat(),
             initial_result.get('input_text', ''),
-            json.dumps(initial_result.get('requirements', {})),
+            json.dumps(initial_result.get('requirements', {}), ensure_ascii=False),
             initial_result.get('code', ''),
             initial_result.get('documentation', ''),
             initial_result.get('validation', ''),
             improved_result.get('improved_code', '') if improved_result else '',
-            improved_result.get('improved_documentation', '') if improved_result else ''
-        ))
-        
-        conn.commit()
-        conn.close()
+            improved_result.get('improved_documentation', '') if improved_result else '',
+            json.dumps(initial_result['validation_report'], ensure_ascii=False)
+            if initial_result.get('validation_report') else None,
+            initial_result.get('request_key'),
+        )
+
+    @traced
+    def save_results(self, initial_result, improved_result=None):
+        self.save_many([(initial_result, improved_result)])
+
+    @traced
+    def save_many(self, results: List[Tuple[Dict, Optional[Dict]]]):
+        """여러 결과를 하나의 트랜잭션으로 저장합니다. (initial_result, improved_result) 쌍의 목록을 받습니다.
+
+        색인 갱신은 트리거가 남긴 변경 로그를 HistoryIndexer가 처리하므로 저장은 임베딩 계산을 기다리지 않습니다.
+        initial_result에 request_key가 있으면 같은 키로 이미 저장된 결과는 다시 저장하지 않습니다.
+        """
+        with self.connections.transaction() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO middleware_history
+                (timestamp, input_text, requirements, initial_code,
+                 initial_documentation, validation, improved_code, improved_documentation, validation_report,
+                 request_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [self._history_row(initial, improved) for initial, improved in results])
+        self.indexer.notify()
+
+    @staticmethod
+    def _insert_embeddings(conn: sqlite3.Connection, history_id: int, field: str, chunks: List[Dict]):
+        conn.executemany('''
+            INSERT INTO embeddings (history_id, field, chunk_index, text, embedding, embedding_scale)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(history_id, field, index, chunk['text'], *encode_embedding(chunk['embedding']))
+              for index, chunk in enumerate(chunks)])
+
+    @traced
+    def list_history(self, limit: int = None, before: Optional[Tuple[str, int]] = None,
+                     date: Optional[str] = None) -> List[Dict]:
+        """최신순으로 히스토리 요약(id, timestamp, input_text, 개선 여부)을 한 페이지 조회합니다.
+
+        before에 이전 페이지 마지막 항목의 (timestamp, id)를 주면 그 다음 페이지를 반환합니다.
+        date('YYYY-MM-DD')를 주면 해당 날짜의 기록만 조회합니다.
+        """
+        conditions, params = [], []
+        if date:
+            conditions.append("date = ?")
+            params.append(date)
+        if before:
+            conditions.append("(timestamp, id) < (?, ?)")
+            params.extend(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        cursor = self.connections.connection().execute(f'''
+            SELECT id, timestamp, input_text, improved_code != '' AS has_improvement
+            FROM middleware_history
+            {where}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', (*params, limit or HISTORY_PAGE_SIZE))
+        return [dict(row) for row in cursor.fetchall()]
+
+    @traced
+    def get_history_dates(self) -> List[str]:
+        """히스토리가 있는 날짜('YYYY-MM-DD')를 최신순으로 반환합니다."""
+        cursor = self.connections.connection().execute('''
+            SELECT DISTINCT date
+            FROM middleware_history
+            ORDER BY date DESC
+        ''')
+        return [row['date'] for row in cursor.fetchall()]
+
+    @traced
+    def get_entry(self, entry_id: int) -> Optional[Dict]:
+        """히스토리 항목 하나의 전체 내용을 조회합니다."""
+        cursor = self.connections.connection().execute(
+            "SELECT * FROM middleware_history WHERE id = ?", (entry_id,)
+        )
+        row = cursor.fetchone()
+        return dict(row) if row else None
 
     def get_all_history(self):
-        conn = sqlite3.connect(self.db_name)
-        conn.row_factory = sqlite3.Row  # 딕셔너리 형태로 결과 반환
-        cursor = conn.cursor()
-        
-        cursor.execute('''
+        cursor = self.connections.connection().execute('''
             SELECT * FROM middleware_history
             ORDER BY timestamp DESC
         ''')
         
-        results = [dict(row) for row in cursor.fetchall()]
-        conn.close()
+        return [dict(row) for row in cursor.fetchall()]
+
+# 색인기가 한 번에 처리하는 변경 수와, 다른 프로세스의 변경을 확인하는 주기(초)
+INDEXER_BATCH_SIZE = 200
+INDEXER_POLL_INTERVAL = 2.0
+# 임베딩하는 히스토리 열. 요청은 문장 단위로, 코드는 AST 블록 단위로 나뉩니다(EmbeddingManager.iter_chunks).
+HISTORY_EMBEDDING_FIELDS = ('input_text', 'initial_code', 'improved_code')
+CODE_EMBEDDING_FIELDS = ('initial_code', 'improved_code')
+# 이 열이 바뀌면 다시 색인 (FTS 색인은 input_text, requirements)
+INDEXED_COLUMNS = ('input_text', 'requirements', 'initial_code', 'improved_code')
+
+class HistoryIndexer:
+    """history_changes 변경 로그를 소비해 FTS 색인, 임베딩, 벡터 인덱스를 증분 갱신하는 백그라운드 스레드입니다.
+
+    요청(input_text)과 생성/개선된 코드(initial_code, improved_code)를 열별로 임베딩합니다.
+
+    변경 로그는 DB에 남으므로 처리 전에 프로세스가 끝나도 다음 실행에서 이어서 색인합니다.
+    같은 행의 변경은 한 번만 처리하며, 현재 행을 다시 읽어 반영하므로 여러 번 처리해도 결과가 같습니다.
+    """
+    def __init__(self, db_name: str, poll_interval: float = INDEXER_POLL_INTERVAL):
+        self.db_name = db_name
+        self.connections = get_connection_manager(db_name)
+        self.embedding_manager = EmbeddingManager()
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="history-indexer", daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """새 변경이 생겼음을 알려 바로 처리하게 합니다."""
+        self._wakeup.set()
+
+    def _run(self):
+        # 시작하자마자 이전 실행에서 남은 변경부터 처리
+        while True:
+            try:
+                self.process_pending()
+            except Exception as e:
+                print(f"히스토리 색인 실패: {e}", file=sys.stderr)
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def pending_count(self) -> int:
+        return self.connections.connection().execute("SELECT COUNT(*) FROM history_changes").fetchone()[0]
+
+    def process_pending(self) -> int:
+        """쌓인 변경을 모두 처리하고 처리한 변경 수를 반환합니다.
+
+        주기적으로 도는 백그라운드 작업이므로 요청 trace 안에서 불렸고 처리할 변경이 있을 때만 span을 남깁니다.
+        """
+        if not self.pending_count():
+            return 0
+        with tracer.child_span('HistoryIndexer.process_pending'):
+            return self._process_all()
+
+    def _process_all(self) -> int:
+        processed = 0
+        with self._lock:
+            while True:
+                count = self._process_batch()
+                if not count:
+                    break
+                processed += count
+        if processed:
+            # 검색 요청이 새 임베딩을 읽는 비용을 치르지 않도록 벡터 인덱스도 미리 갱신
+            get_vector_index(self.db_name).refresh()
+        return processed
+
+    def _process_batch(self) -> int:
+        conn = self.connections.connection()
+        changes = conn.execute(
+            "SELECT seq, history_id FROM history_changes ORDER BY seq LIMIT ?", (INDEXER_BATCH_SIZE,)
+        ).fetchall()
+        if not changes:
+            return 0
+        history_ids = list(dict.fromkeys(row['history_id'] for row in changes))
+        placeholders = ",".join("?" * len(history_ids))
+        columns = ", ".join(INDEXED_COLUMNS)
+        rows = conn.execute(
+            f"SELECT id, {columns} FROM middleware_history WHERE id IN ({placeholders})", history_ids
+        ).fetchall()
+        # 임베딩은 쓰기 트랜잭션 밖에서 계산 (행마다 HISTORY_EMBEDDING_FIELDS 순서로 이어 붙임)
+        embeddings = self.embedding_manager.create_embeddings_many(
+            [row[field] or '' for row in rows for field in HISTORY_EMBEDDING_FIELDS])
+        field_count = len(HISTORY_EMBEDDING_FIELDS)
+
+        with self.connections.transaction() as conn:
+            for history_id in history_ids:
+                conn.execute("DELETE FROM middleware_history_fts WHERE rowid = ?", (history_id,))
+                conn.execute("DELETE FROM embeddings WHERE history_id = ?", (history_id,))
+            for index, row in enumerate(rows):
+                current = conn.execute(
+                    f"SELECT {columns} FROM middleware_history WHERE id = ?", (row['id'],)
+                ).fetchone()
+                if current is None or tuple(current) != tuple(row[column] for column in INDEXED_COLUMNS):
+                    # 읽은 뒤에 바뀐 행은 뒤에 쌓인 변경으로 다시 처리됨
+                    continue
+                conn.execute(
+                    "INSERT INTO middleware_history_fts (rowid, input_text, requirements) VALUES (?, ?, ?)",
+                    (row['id'], row['input_text'], row['requirements'])
+                )
+                for field, chunks in zip(HISTORY_EMBEDDING_FIELDS,
+                                         embeddings[index * field_count:(index + 1) * field_count]):
+                    MiddlewareDatabase._insert_embeddings(conn, row['id'], field, chunks)
+            conn.execute("DELETE FROM history_changes WHERE seq <= ?", (changes[-1]['seq'],))
+        return len(changes)
+
+@st.cache_resource
+def get_history_indexer(db_name: str) -> HistoryIndexer:
+    """프로세스마다 DB 하나당 색인 스레드 하나를 띄웁니다."""
+    indexer = HistoryIndexer(db_name)
+    indexer.start()
+    return indexer
+
+# 규칙 기반 분석 결과의 신뢰도가 이 값보다 낮으면 LLM으로 분석
+RULE_PARSER_MIN_CONFIDENCE = float(os.getenv("RULE_PARSER_MIN_CONFIDENCE", 0.8))
+
+# 국가 코드를 넣어 주는 CDN/로드 밸런서 헤더. 클라이언트가 보낸 같은 이름의 헤더를 프록시가 항상 덮어씁니다.
+PROXY_COUNTRY_HEADERS = ('CF-IPCountry', 'CloudFront-Viewer-Country', 'X-AppEngine-Country', 'X-Vercel-IP-Country')
+# 위 목록에 없는 자체 프록시 헤더를 쓸 때 그 이름. 요청에 헤더 이름이 없으면 규칙 기반 분석은 이 헤더를 사용합니다.
+COUNTRY_SOURCE_HEADER = os.getenv("COUNTRY_SOURCE_HEADER", "")
+
+def is_proxy_country_header(name) -> bool:
+    """누구나 보낼 수 있는 임의의 헤더가 아니라 프록시가 넣어 주는 국가 코드 헤더인지 확인합니다."""
+    trusted = PROXY_COUNTRY_HEADERS + ((COUNTRY_SOURCE_HEADER,) if COUNTRY_SOURCE_HEADER else ())
+    return isinstance(name, str) and name.casefold() in (header.casefold() for header in trusted)
+
+COUNTRY_CODES = {
+    '러시아': 'RU', 'russia': 'RU', '중국': 'CN', 'china': 'CN', '북한': 'KP', 'north korea': 'KP',
+    '이란': 'IR', 'iran': 'IR', '미국': 'US', 'united states': 'US', 'usa': 'US', '일본': 'JP', 'japan': 'JP',
+    '대한민국': 'KR', '한국': 'KR', 'south korea': 'KR', 'korea': 'KR', '베트남': 'VN', 'vietnam': 'VN',
+    '인도네시아': 'ID', 'indonesia': 'ID', '인도': 'IN', 'india': 'IN', '브라질': 'BR', 'brazil': 'BR',
+    '독일': 'DE', 'germany': 'DE', '영국': 'GB', 'united kingdom': 'GB', '우크라이나': 'UA', 'ukraine': 'UA',
+}
+# 영문 국가명은 단어 경계로, 한글은 조사가 붙으므로 부분 문자열로 찾음 (긴 이름 우선)
+COUNTRY_PATTERN = re.compile("|".join(
+    rf"\b{re.escape(name)}\b" if name.isascii() else re.escape(name)
+    for name in sorted(COUNTRY_CODES, key=len, reverse=True)
+))
+IP_PATTERN = re.compile(r"(?<![\d.])(?:\d{1,3}\.){3}\d{1,3}(?:/\d{1,2})?(?![\d.])")
+HEADER_NAME_PATTERN = re.compile(
+    r"\b(authorization|cookie|user-agent|[a-z][a-z0-9]*(?:-[a-z0-9]+)+)(?![a-z0-9-])\s*(?:헤더|header)?", re.IGNORECASE)
+SIZE_PATTERN = re.compile(
+    r"(\d+(?:\.\d+)?)\s*(" + "|".join(sorted(map(re.escape, SIZE_UNITS), key=len, reverse=True)) + r")(?![a-z])")
+RATE_WINDOWS = {
+    '초': 1, '분': 60, '시간': 3600, '일': 86400,
+    'second': 1, 'sec': 1, 's': 1, 'minute': 60, 'min': 60, 'm': 60, 'hour': 3600, 'hr': 3600, 'h': 3600, 'day': 86400,
+}
+RATE_PATTERNS = [
+    # "분당 100회", "1초에 10번"
+    re.compile(r"(?:(\d+)\s*)?(초|분|시간|일)\s*(?:당|에|동안)\s*(\d+)\s*(?:회|번|건|개|요청|requests?)?"),
+    # "100 requests per minute", "10 req/s", "100회/분"
+    re.compile(r"(\d+)\s*(?:회|번|건|개|requests?|reqs?|calls?)\s*(?:/|per|a|an|every|each)\s*(\d+)?\s*"
+               r"(초|분|시간|일|seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|s|m|h)(?![a-z])"),
+]
+URL_PATTERN = re.compile(r"https?://[^\s,'\"()]+")
+HTTP_METHODS = ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'HEAD']
+
+BLOCK_WORDS = re.compile(r"차단|막아|막기|막는|막을|거부|거절|금지|\b(?:block|deny|reject|ban|forbid)")
+ALLOW_WORDS = re.compile(r"허용|화이트리스트|만\s*통과|\b(?:allow|whitelist|permit)")
+REQUIRE_WORDS = re.compile(r"필수|반드시|없으면|없는|누락|있어야|확인|검사|\b(?:require|must|missing|mandatory|check)")
+HEADER_TRANSFORM_WORDS = re.compile(r"추가|제거|삭제|변경|바꿔|\b(?:add|remove|strip|rewrite|replace)")
+BODY_WORDS = re.compile(r"본문|바디|페이로드|업로드|요청\s*크기|\b(?:body|payload|upload|request size|content-length)")
+RATE_WORDS = re.compile(r"속도\s*제한|요청\s*수|횟수|레이트|\b(?:rate|throttl|limit)")
+CORS_WORDS = re.compile(r"\bcors(?![a-z])|교차\s*출처|cross-origin")
+# 예외나 조건이 붙은 요청은 규칙으로 다 담기 어려우므로 신뢰도를 낮춤
+CONDITION_WORDS = re.compile(r"제외|예외|경우|다만|단,|때만|\b(?:except|unless|only if|only when|but)\b")
+# 규칙이 처리하지 못하는 절: 이런 표현이 남아 있으면 규칙 결과를 쓰지 않고 LLM으로 분석
+NEGATION_WORDS = re.compile(r"하지\s*(?:말|마|않)|말고|않|\b(?:don't|do not|never|not|without)\b")
+# "/admin 경로", "로그인 api", "POST /files"처럼 일부 경로/메서드로 범위를 좁히는 표현 (템플릿은 모든 요청에 적용됨)
+PATH_SCOPE_PATTERN = re.compile(r"(?:^|[\s('\"])/[a-z0-9_{]")
+SCOPE_WORDS = re.compile(r"경로|엔드포인트|로그인|페이지|(?<![a-z0-9-])api(?![\s-]*(?:키|key))|\b(?:endpoints?|routes?|paths?|login)\b")
+METHOD_SCOPE_PATTERN = re.compile(r"(?<![a-z])(?:get|post|put|patch|delete|options|head)(?![a-z])")
+# 거부 외의 추가 동작 (기록, 알림, 값 생성/설정, 리다이렉트 등)
+EXTRA_ACTION_WORDS = re.compile(r"로그(?!인)|기록|알림|통보|생성|넣|설정|리다이렉트|"
+                                r"\b(?:log|logs|logging|notify|alert|generate|insert|set|redirect)\b")
+# 헤더가 있는지뿐 아니라 값까지 검사하는 표현
+HEADER_VALUE_WORDS = re.compile(r"인지|이어야|여야|값|유효|형식|일치|포함|토큰|[/=]|"
+                                r"\b(?:valid|value|equals?|match|format|contains?|bearer|token)")
+# 요청 수 제한의 시간 창 외에 남는 기간 표현 ("초과 시 1시간 차단")
+DURATION_PATTERN = re.compile(r"\d+\s*(?:초|분|시간|일)|(?:초|분|시간|일)\s*당|"
+                              r"\d+\s*(?:seconds?|secs?|minutes?|mins?|hours?|hrs?|days?)(?![a-z])")
+
+class RuleBasedParser:
+    """자주 들어오는 요청(국가/IP 차단, 필수 헤더, 본문 크기 제한, 요청 수 제한, CORS)을
+    키워드/정규식 규칙으로 ParsingAgent와 같은 JSON 구조로 분석합니다.
+
+    규칙 하나만 확실하게 맞고 규칙이 처리하지 못한 절(부정, 경로/메서드 범위, 값 조건, 추가 동작)이
+    남지 않을 때만 결과를 반환하고, 그 외에는 None을 반환해 LLM 분석으로 넘깁니다.
+    """
+    def __init__(self, min_confidence: float = RULE_PARSER_MIN_CONFIDENCE, country_header: str = COUNTRY_SOURCE_HEADER):
+        self.min_confidence = min_confidence
+        self.country_header = country_header
+        self.rules = [self._country_filter, self._ip_filter, self._require_header,
+                      self._body_size_limit, self._rate_limit, self._cors]
+        self._lock = threading.Lock()
+        self.stats = {'rule_hits': 0, 'llm_fallbacks': 0}
+
+    def parse(self, text: str) -> Optional[Dict]:
+        result = self.match(text)
+        with self._lock:
+            self.stats['rule_hits' if result else 'llm_fallbacks'] += 1
+        return result
+
+    def match(self, text: str) -> Optional[Dict]:
+        """통계를 남기지 않고 분석합니다. 규칙으로 확실하게 분석할 수 없으면 None을 반환합니다."""
+        normalized = " ".join(unicodedata.normalize('NFKC', text).casefold().split())
+        matches = [match for match in (rule(normalized) for rule in self.rules) if match]
+        result = None
+        if len(matches) == 1:
+            result, confidence = matches[0]
+            if CONDITION_WORDS.search(normalized):
+                confidence -= 0.3
+            if sum(1 for _ in iter_sentences(normalized)) > 1:
+                confidence -= 0.2
+            if self.unconsumed_clauses(result['intent'], normalized):
+                confidence -= 0.5
+            if confidence < self.min_confidence:
+                result = None
+        return result
+
+    @staticmethod
+    def unconsumed_clauses(intent: str, text: str) -> List[str]:
+        """규칙 결과(템플릿 파라미터)에 담기지 않는 절의 종류를 반환합니다. 비어 있지 않으면 LLM으로 분석해야 합니다."""
+        clauses = []
+        if NEGATION_WORDS.search(text):
+            clauses.append('negation')
+        without_urls = URL_PATTERN.sub(" ", text)
+        if PATH_SCOPE_PATTERN.search(without_urls) or SCOPE_WORDS.search(without_urls):
+            clauses.append('path_scope')
+        # CORS 규칙은 메서드를 허용 메서드로 사용
+        if intent != 'cors' and METHOD_SCOPE_PATTERN.search(text):
+            clauses.append('method_scope')
+        if EXTRA_ACTION_WORDS.search(text):
+            clauses.append('extra_action')
+        if intent == 'require_header' and HEADER_VALUE_WORDS.search(text):
+            clauses.append('value_constraint')
+        if intent == 'rate_limit' and (len(DURATION_PATTERN.findall(text)) > 1 or BLOCK_WORDS.search(text)):
+            clauses.append('extra_action')
+        return clauses
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.stats['rule_hits'] + self.stats['llm_fallbacks']
+            return dict(self.stats, hit_rate=self.stats['rule_hits'] / total if total else 0.0)
+
+    @staticmethod
+    def _result(intent: str, entities: List[str], requirements: List[str], constraints: List[str],
+                parameters: Dict) -> Dict:
+        return {'intent': intent, 'entities': entities, 'requirements': requirements,
+                'constraints': constraints, 'parameters': parameters}
+
+    @staticmethod
+    def _filter_mode(text: str) -> Optional[str]:
+        if ALLOW_WORDS.search(text) and not BLOCK_WORDS.search(text):
+            return 'allow'
+        return 'deny' if BLOCK_WORDS.search(text) else None
+
+    def _country_filter(self, text: str) -> Optional[Tuple[Dict, float]]:
+        countries = list(dict.fromkeys(COUNTRY_CODES[match.group()] for match in COUNTRY_PATTERN.finditer(text)))
+        mode = self._filter_mode(text)
+        # 국가 코드를 어느 프록시 헤더에서 읽을지 모르면 LLM으로 분석
+        header = next((name for name in PROXY_COUNTRY_HEADERS if name.casefold() in text), self.country_header)
+        if not countries or not mode or not header:
+            return None
+        action = "만 허용하고 나머지는 차단" if mode == 'allow' else "에서 오는 요청을 차단"
+        return self._result(
+            'country_filter', ['국가 코드', f'{header} 헤더', 'HTTP 요청'],
+            [f"{', '.join(countries)}{action}", "차단된 요청에는 403 Forbidden 응답"],
+            [f"국가 코드는 CDN/프록시가 넣어 주는 {header} 헤더로 판별",
+             "클라이언트가 보낸 같은 이름의 헤더는 프록시가 덮어써야 함"],
+            {'mode': mode, 'countries': countries, 'status_code': 403, 'country_header': header},
+        ), 0.9
+
+    def _ip_filter(self, text: str) -> Optional[Tuple[Dict, float]]:
+        networks = []
+        for match in IP_PATTERN.finditer(text):
+            try:
+                networks.append(str(ipaddress.ip_network(match.group(), strict=False)))
+            except ValueError:
+                continue
+        mode = self._filter_mode(text)
+        if not networks or not mode:
+            return None
+        action = "만 허용" if mode == 'allow' else "에서 오는 요청을 차단"
+        return self._result(
+            'ip_filter', ['클라이언트 IP', 'IP 대역', 'HTTP 요청'],
+            [f"{', '.join(networks)}{action}", "거부된 요청에는 403 Forbidden 응답"],
+            ["프록시 뒤에서는 X-Forwarded-For 헤더를 확인"],
+            {'mode': mode, 'networks': networks, 'status_code': 403},
+        ), 0.9
+
+    def _require_header(self, text: str) -> Optional[Tuple[Dict, float]]:
+        if not re.search(r"헤더|\bheader", text) or not REQUIRE_WORDS.search(text) or HEADER_TRANSFORM_WORDS.search(text):
+            return None
+        names = [match.group(1) for match in HEADER_NAME_PATTERN.finditer(text)
+                 if not match.group(1).startswith(('http', 'content-length'))]
+        if len(names) != 1:
+            return None
+        header = "-".join(part.capitalize() for part in names[0].split("-"))
+        status_code = 401 if header in ('Authorization', 'Cookie') else 400
+        return self._result(
+            'require_header', ['HTTP 헤더', 'HTTP 요청'],
+            [f"{header} 헤더가 없는 요청을 거부", f"헤더가 없으면 {status_code} 응답"],
+            ["헤더 이름은 대소문자를 구분하지 않음"],
+            {'header_name': header, 'status_code': status_code},
+        ), 0.85
+
+    def _body_size_limit(self, text: str) -> Optional[Tuple[Dict, float]]:
+        match = SIZE_PATTERN.search(text)
+        if not match or not BODY_WORDS.search(text):
+            return None
+        max_bytes = int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+        return self._result(
+            'body_size_limit', ['요청 본문', 'Content-Length 헤더'],
+            [f"요청 본문이 {match.group(1)}{match.group(2).upper()}({max_bytes}바이트)를 넘으면 거부",
+             "초과한 요청에는 413 Payload Too Large 응답"],
+            ["Content-Length가 없는 요청은 읽은 바이트 수로 확인"],
+            {'max_body_bytes': max_bytes, 'status_code': 413},
+        ), 0.9
+
+    def _rate_limit(self, text: str) -> Optional[Tuple[Dict, float]]:
+        match = RATE_PATTERNS[0].search(text)
+        if match:
+            window = int(match.group(1) or 1) * RATE_WINDOWS[match.group(2)]
+            limit = int(match.group(3))
+        else:
+            match = RATE_PATTERNS[1].search(text)
+            if not match:
+                return None
+            unit = match.group(3)
+            unit = unit if unit in RATE_WINDOWS else unit.rstrip('s')
+            window = int(match.group(2) or 1) * RATE_WINDOWS[unit]
+            limit = int(match.group(1))
+        if not RATE_WORDS.search(text) and not re.search(r"제한|초과|넘", text):
+            return None
+        key = 'api_key' if re.search(r"api\s*(?:키|key)", text) else 'user' if re.search(r"사용자|\buser", text) else 'client_ip'
+        return self._result(
+            'rate_limit', ['클라이언트 식별자', '요청 횟수', '시간 창'],
+            [f"{key}별로 {window}초 동안 최대 {limit}회까지 요청 허용", "한도를 넘으면 429 Too Many Requests 응답"],
+            ["여러 프로세스에서 실행하면 카운터를 공유 저장소에 두어야 함"],
+            {'limit': limit, 'window_seconds': window, 'key': key, 'status_code': 429},
+        ), 0.9
+
+    def _cors(self, text: str) -> Optional[Tuple[Dict, float]]:
+        if not CORS_WORDS.search(text):
+            return None
+        origins = URL_PATTERN.findall(text) or ['*']
+        methods = [method for method in HTTP_METHODS if re.search(rf"(?<![a-z]){method.lower()}(?![a-z])", text)] or HTTP_METHODS[:5]
+        credentials = bool(re.search(r"credential|자격\s*증명|쿠키|cookie", text))
+        return self._result(
+            'cors', ['Origin 헤더', 'CORS 응답 헤더', 'Preflight(OPTIONS) 요청'],
+            [f"허용 출처: {', '.join(origins)}", f"허용 메서드: {', '.join(methods)}", "OPTIONS 사전 요청에 바로 응답"],
+            ["자격 증명을 허용하면 출처에 '*'를 쓸 수 없음"] if credentials else [],
+            {'allowed_origins': origins, 'allowed_methods': methods, 'allow_credentials': credentials},
+        ), 0.85 if origins == ['*'] and credentials else 0.9
+
+@st.cache_resource
+def get_rule_parser() -> RuleBasedParser:
+    return RuleBasedParser()
+
+# 템플릿으로 만든 미들웨어 코드 앞에 붙는 공통 코드 (WSGI 미들웨어, 표준 라이브러리만 사용)
+TEMPLATE_PRELUDE = '''from http import HTTPStatus
+
+TRUST_PROXY = ${trust_proxy}
+# 앞에 있는 신뢰하는 프록시 수. 각 프록시는 X-Forwarded-For 끝에 접속한 주소를 덧붙입니다.
+TRUSTED_HOPS = ${trusted_hops}
+
+def reject(start_response, status_code, headers=()):
+    """본문에 상태 문구만 담은 응답을 바로 돌려줍니다."""
+    status = HTTPStatus(status_code)
+    body = status.phrase.encode('utf-8')
+    start_response(f"{status.value} {status.phrase}", [
+        ('Content-Type', 'text/plain; charset=utf-8'),
+        ('Content-Length', str(len(body))),
+        *headers,
+    ])
+    return [body]
+
+def client_ip(environ):
+    """프록시를 신뢰하면 X-Forwarded-For에서 신뢰하는 프록시가 덧붙인 주소를, 아니면 REMOTE_ADDR를 사용합니다.
+
+    앞쪽 항목은 클라이언트가 임의로 보낼 수 있으므로 오른쪽에서 TRUSTED_HOPS번째 항목을 씁니다.
+    """
+    if TRUST_PROXY:
+        forwarded = [item.strip() for item in environ.get('HTTP_X_FORWARDED_FOR', '').split(',') if item.strip()]
+        if forwarded:
+            return forwarded[max(len(forwarded) - TRUSTED_HOPS, 0)]
+    return environ.get('REMOTE_ADDR', '')
+'''
+
+COUNTRY_FILTER_TEMPLATE = '''import ipaddress
+
+# CDN/프록시가 넣어 주는 국가 코드 헤더로 국가를 판별합니다.
+# 클라이언트도 같은 이름의 헤더를 보낼 수 있으므로 프록시가 이 헤더를 항상 덮어써야 하며,
+# TRUSTED_PROXIES를 지정하면 그 대역에서 들어오지 않은 요청(프록시 우회)은 거부합니다.
+MODE = ${mode}
+COUNTRIES = frozenset(${countries})
+STATUS_CODE = ${status_code}
+COUNTRY_HEADER = ${country_header_key}
+TRUSTED_PROXIES = tuple(ipaddress.ip_network(network) for network in ${trusted_proxies})
+
+def from_trusted_proxy(environ):
+    if not TRUSTED_PROXIES:
+        return True
+    try:
+        ip = ipaddress.ip_address(environ.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+class CountryFilterMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not from_trusted_proxy(environ):
+            return reject(start_response, STATUS_CODE)
+        country = environ.get(COUNTRY_HEADER, '').strip().upper()
+        listed = country in COUNTRIES
+        if listed if MODE == 'deny' else not listed:
+            return reject(start_response, STATUS_CODE)
+        return self.app(environ, start_response)
+'''
+
+IP_FILTER_TEMPLATE = '''import ipaddress
+from functools import lru_cache
+
+MODE = ${mode}
+NETWORKS = tuple(ipaddress.ip_network(network) for network in ${networks})
+STATUS_CODE = ${status_code}
+
+@lru_cache(maxsize=65536)
+def is_listed(address):
+    """같은 주소를 반복해서 대역과 비교하지 않도록 결과를 캐시합니다. 잘못된 주소는 None입니다."""
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return None
+    return any(ip in network for network in NETWORKS)
+
+class IPFilterMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        listed = is_listed(client_ip(environ))
+        if listed is None or (listed if MODE == 'deny' else not listed):
+            return reject(start_response, STATUS_CODE)
+        return self.app(environ, start_response)
+'''
+
+REQUIRE_HEADER_TEMPLATE = '''
+HEADER_NAME = ${header_name}
+HEADER_KEY = ${header_key}
+STATUS_CODE = ${status_code}
+
+class RequireHeaderMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not environ.get(HEADER_KEY, '').strip():
+            headers = [('WWW-Authenticate', 'Bearer')] if STATUS_CODE == 401 else []
+            return reject(start_response, STATUS_CODE, headers)
+        return self.app(environ, start_response)
+'''
+
+BODY_SIZE_LIMIT_TEMPLATE = '''
+MAX_BODY_BYTES = ${max_body_bytes}
+STATUS_CODE = ${status_code}
+
+class RequestBodyTooLarge(Exception):
+    pass
+
+class LimitedInput:
+    """Content-Length가 없는(chunked) 요청은 읽은 바이트 수로 한도를 확인합니다."""
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.remaining = limit
+
+    def _consume(self, data):
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            raise RequestBodyTooLarge()
+        return data
+
+    def read(self, size=-1):
+        return self._consume(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self._consume(self.stream.readline(size))
+
+    def __iter__(self):
+        for line in self.stream:
+            yield self._consume(line)
+
+class BodySizeLimitMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        length = environ.get('CONTENT_LENGTH')
+        if length:
+            try:
+                if int(length) > MAX_BODY_BYTES:
+                    return reject(start_response, STATUS_CODE)
+            except ValueError:
+                return reject(start_response, 400)
+        else:
+            environ['wsgi.input'] = LimitedInput(environ['wsgi.input'], MAX_BODY_BYTES)
+        try:
+            return self.app(environ, start_response)
+        except RequestBodyTooLarge:
+            return reject(start_response, STATUS_CODE)
+'''
+
+RATE_LIMIT_TEMPLATE = '''import threading
+import time
+
+LIMIT = ${limit}
+WINDOW_SECONDS = ${window_seconds}
+KEY = ${key}
+STATUS_CODE = ${status_code}
+# 가득 찬 버킷을 정리하기 시작하는 키 수
+MAX_TRACKED_KEYS = 100000
+
+def rate_key(environ):
+    if KEY == 'api_key':
+        return environ.get('HTTP_X_API_KEY') or client_ip(environ)
+    if KEY == 'user':
+        return environ.get('REMOTE_USER') or environ.get('HTTP_X_USER_ID') or client_ip(environ)
+    return client_ip(environ)
+
+class RateLimitMiddleware:
+    """키마다 토큰 버킷(용량 LIMIT, WINDOW_SECONDS마다 LIMIT개 충전)으로 요청 수를 제한합니다.
+
+    카운터는 프로세스 메모리에 있으므로 여러 프로세스로 실행하면 프로세스별로 한도가 적용됩니다.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.rate = LIMIT / WINDOW_SECONDS
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _take(self, key, now):
+        tokens, updated = self.buckets.get(key, (LIMIT, now))
+        tokens = min(LIMIT, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        return 0.0
+
+    def _cleanup(self, now):
+        self.buckets = {
+            key: (tokens, updated) for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.rate < LIMIT
+        }
+
+    def __call__(self, environ, start_response):
+        now = time.monotonic()
+        with self.lock:
+            if len(self.buckets) > MAX_TRACKED_KEYS:
+                self._cleanup(now)
+            retry_after = self._take(rate_key(environ), now)
+        if retry_after:
+            return reject(start_response, STATUS_CODE, [('Retry-After', str(max(1, round(retry_after))))])
+        return self.app(environ, start_response)
+'''
+
+CORS_TEMPLATE = '''
+ALLOWED_ORIGINS = frozenset(${allowed_origins})
+ALLOWED_METHODS = ${allowed_methods_header}
+ALLOW_CREDENTIALS = ${allow_credentials}
+MAX_AGE = ${max_age}
+
+class CORSMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        origin = environ.get('HTTP_ORIGIN')
+        if not origin or not ('*' in ALLOWED_ORIGINS or origin in ALLOWED_ORIGINS):
+            # 허용하지 않은 출처에는 CORS 헤더를 붙이지 않아 브라우저가 차단하게 함
+            return self.app(environ, start_response)
+
+        cors_headers = [('Access-Control-Allow-Origin', '*' if '*' in ALLOWED_ORIGINS else origin)]
+        if '*' not in ALLOWED_ORIGINS:
+            cors_headers.append(('Vary', 'Origin'))
+        if ALLOW_CREDENTIALS:
+            cors_headers.append(('Access-Control-Allow-Credentials', 'true'))
+
+        if environ.get('REQUEST_METHOD') == 'OPTIONS' and 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' in environ:
+            # 사전 요청(preflight)은 애플리케이션까지 보내지 않고 바로 응답
+            start_response('204 No Content', cors_headers + [
+                ('Access-Control-Allow-Methods', ALLOWED_METHODS),
+                ('Access-Control-Allow-Headers', environ.get('HTTP_ACCESS_CONTROL_REQUEST_HEADERS', '')),
+                ('Access-Control-Max-Age', str(MAX_AGE)),
+            ])
+            return [b'']
+
+        def cors_start_response(status, headers, exc_info=None):
+            return start_response(status, headers + cors_headers, exc_info)
+        return self.app(environ, cors_start_response)
+'''
+
+REQUEST_LOGGING_TEMPLATE = '''import logging
+import time
+
+LOG_HEADERS = ${log_headers}
+SLOW_REQUEST_SECONDS = ${slow_request_seconds}
+# 로그에 남기지 않는 민감한 헤더
+REDACTED_HEADERS = frozenset({'HTTP_AUTHORIZATION', 'HTTP_COOKIE', 'HTTP_X_API_KEY'})
+
+logger = logging.getLogger('middleware.access')
+
+class RequestLoggingMiddleware:
+    """요청마다 메서드, 경로, 상태 코드, 처리 시간을 기록하고 느린 요청은 경고로 남깁니다."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        status_holder = []
+
+        def logging_start_response(status, headers, exc_info=None):
+            status_holder.append(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        result = self.app(environ, logging_start_response)
+        try:
+            yield from result
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+            elapsed = time.perf_counter() - started
+            level = logging.WARNING if elapsed >= SLOW_REQUEST_SECONDS else logging.INFO
+            if logger.isEnabledFor(level):
+                path = environ.get('PATH_INFO', '')
+                if environ.get('QUERY_STRING'):
+                    path += '?' + environ['QUERY_STRING']
+                message = "%s %s %s %.1fms"
+                args = [environ.get('REQUEST_METHOD'), path, status_holder[0] if status_holder else '-', elapsed * 1000]
+                if LOG_HEADERS:
+                    message += " headers=%s"
+                    args.append({key[5:]: value for key, value in environ.items()
+                                 if key.startswith('HTTP_') and key not in REDACTED_HEADERS})
+                logger.log(level, message, *args)
+'''
+
+RESPONSE_CACHE_TEMPLATE = '''import threading
+import time
+from collections import OrderedDict
+
+TTL_SECONDS = ${ttl_seconds}
+MAX_ENTRIES = ${max_entries}
+# 이 지시어가 있는 응답은 다른 사용자에게 보내면 안 되거나 저장하면 안 됨
+UNCACHEABLE_DIRECTIVES = frozenset(['private', 'no-store', 'no-cache'])
+
+def request_key(environ):
+    host = environ.get('HTTP_HOST') or f"{environ.get('SERVER_NAME', '')}:{environ.get('SERVER_PORT', '')}"
+    return (environ.get('wsgi.url_scheme', 'http'), host.lower(), environ.get('SCRIPT_NAME', ''),
+            environ.get('PATH_INFO', ''), environ.get('QUERY_STRING', ''))
+
+def vary_values(environ, names):
+    return tuple(environ.get('HTTP_' + name.upper().replace('-', '_'), '') for name in names)
+
+def cacheable_vary(headers):
+    """응답을 캐시할 수 있으면 Vary에 나온 요청 헤더 이름 목록을, 캐시하면 안 되면 None을 반환합니다."""
+    vary = []
+    for name, value in headers:
+        name = name.lower()
+        if name == 'set-cookie':
+            return None
+        if name == 'cache-control':
+            directives = {item.split('=')[0].strip().lower() for item in value.split(',')}
+            if directives & UNCACHEABLE_DIRECTIVES:
+                return None
+        if name == 'vary':
+            vary += [item.strip().lower() for item in value.split(',') if item.strip()]
+    return None if '*' in vary else tuple(sorted(set(vary)))
+
+class ResponseCacheMiddleware:
+    """인증 정보가 없는 GET 요청의 200 응답을 호스트+경로+쿼리 문자열 단위로 TTL 동안 메모리에 캐시합니다 (LRU).
+
+    Set-Cookie가 있거나 Cache-Control이 private/no-store/no-cache인 응답, Vary: *인 응답은 캐시하지 않으며,
+    Vary에 나온 요청 헤더 값이 같은 요청에만 캐시된 응답을 돌려줍니다.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if (environ.get('REQUEST_METHOD') != 'GET'
+                or 'HTTP_AUTHORIZATION' in environ or 'HTTP_COOKIE' in environ):
+            return self.app(environ, start_response)
+
+        key = request_key(environ)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > now and vary_values(environ, entry[1]) == entry[2]:
+                self.entries.move_to_end(key)
+                _, _, _, status, headers, body = entry
+                start_response(status, headers + [('X-Cache', 'HIT')])
+                return [body]
+
+        captured = {}
+
+        def capturing_start_response(status, headers, exc_info=None):
+            captured['status'], captured['headers'] = status, headers
+            return start_response(status, headers + [('X-Cache', 'MISS')], exc_info)
+
+        result = self.app(environ, capturing_start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        vary = cacheable_vary(captured.get('headers', []))
+        if captured.get('status', '').startswith('200') and vary is not None:
+            with self.lock:
+                self.entries[key] = (now + TTL_SECONDS, vary, vary_values(environ, vary),
+                                     captured['status'], captured['headers'], body)
+                self.entries.move_to_end(key)
+                while len(self.entries) > MAX_ENTRIES:
+                    self.entries.popitem(last=False)
+        return [body]
+'''
+
+HEADER_TRANSFORM_TEMPLATE = '''
+SET_HEADERS = ${set_headers}
+REMOVE_HEADERS = frozenset(name.lower() for name in ${remove_headers})
+REPLACED_HEADERS = REMOVE_HEADERS | frozenset(name.lower() for name in SET_HEADERS)
+
+class HeaderTransformMiddleware:
+    """응답 헤더를 추가/덮어쓰고 지정한 헤더를 제거합니다."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        def transform_start_response(status, headers, exc_info=None):
+            headers = [(name, value) for name, value in headers if name.lower() not in REPLACED_HEADERS]
+            headers.extend(SET_HEADERS.items())
+            return start_response(status, headers, exc_info)
+        return self.app(environ, transform_start_response)
+'''
+
+CONTENT_FILTER_TEMPLATE = '''import io
+import re
+from urllib.parse import unquote_plus
+
+BLOCKED_PATTERN = re.compile("|".join(f"(?:{pattern})" for pattern in ${blocked_patterns}), re.IGNORECASE)
+STATUS_CODE = ${status_code}
+# 이보다 큰 본문은 검사하지 않고 통과시킴 (본문 크기 제한 미들웨어와 함께 사용)
+MAX_SCAN_BYTES = ${max_scan_bytes}
+
+class ContentFilterMiddleware:
+    """쿼리 문자열과 본문에 금지된 패턴이 있으면 요청을 거부합니다."""
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if BLOCKED_PATTERN.search(unquote_plus(environ.get('QUERY_STRING', ''))):
+            return reject(start_response, STATUS_CODE)
+
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return reject(start_response, 400)
+        if 0 < length <= MAX_SCAN_BYTES:
+            body = environ['wsgi.input'].read(length)
+            # 애플리케이션이 본문을 다시 읽을 수 있도록 되돌려 줌
+            environ['wsgi.input'] = io.BytesIO(body)
+            if BLOCKED_PATTERN.search(body.decode('utf-8', errors='replace')):
+                return reject(start_response, STATUS_CODE)
+        return self.app(environ, start_response)
+'''
+
+REQUIRED = object()
+
+def header_environ_key(name: str) -> str:
+    """HTTP 헤더 이름을 WSGI environ 키로 바꿉니다. (X-Api-Key → HTTP_X_API_KEY)"""
+    key = name.upper().replace('-', '_')
+    return key if key in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f"HTTP_{key}"
+
+def _is_str_list(value) -> bool:
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+def _is_header_map(value) -> bool:
+    return isinstance(value, dict) and all(
+        isinstance(name, str) and re.fullmatch(r"[A-Za-z0-9-]+", name)
+        and isinstance(text, str) and not re.search(r"[\r\n]", text)
+        for name, text in value.items()
+    )
+
+def _valid_networks(value) -> bool:
+    try:
+        return _is_str_list(value) and all(ipaddress.ip_network(item, strict=False) for item in value)
+    except ValueError:
+        return False
+
+def _valid_patterns(value) -> bool:
+    try:
+        return _is_str_list(value) and bool(value) and all(re.compile(item) for item in value)
+    except re.error:
+        return False
+
+def _is_status(value) -> bool:
+    return isinstance(value, int) and 400 <= value <= 599
+
+def _is_positive(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+class MiddlewareTemplate:
+    """intent 하나에 대응하는 미리 검토된 미들웨어 코드와 parameters 규격입니다.
+
+    params는 {이름: (검사 함수, 기본값)}이며 기본값이 REQUIRED인 항목은 반드시 있어야 합니다.
+    derived는 렌더링 직전에 parameters로부터 추가 값을 계산합니다.
+    """
+    def __init__(self, description: str, source: str, params: Dict[str, Tuple[Callable[[Any], bool], Any]],
+                 derived: Callable[[Dict], Dict] = None, check: Callable[[Dict], bool] = None):
+        self.description = description
+        self.source = source
+        self.params = params
+        self.derived = derived
+        self.check = check
+
+    def bind(self, parameters: Dict) -> Optional[Dict]:
+        """parameters가 규격에 맞으면 기본값을 채운 값을, 모르는 키가 있거나 값이 맞지 않으면 None을 반환합니다."""
+        if not isinstance(parameters, dict) or set(parameters) - set(self.params):
+            return None
+        values = {}
+        for name, (is_valid, default) in self.params.items():
+            value = parameters.get(name, default)
+            if value is REQUIRED or not is_valid(value):
+                return None
+            values[name] = value
+        if self.check and not self.check(values):
+            return None
+        return values
+
+    def render(self, values: Dict) -> str:
+        values = dict(values, trust_proxy=values.get('trust_proxy', False),
+                      trusted_hops=values.get('trusted_hops', 1))
+        if self.derived:
+            values.update(self.derived(values))
+        substitutions = {name: repr(value) for name, value in values.items()}
+        return (string.Template(TEMPLATE_PRELUDE).substitute(substitutions)
+                + string.Template(self.source).substitute(substitutions))
+
+FILTER_MODE = (lambda value: value in ('allow', 'deny'), 'deny')
+TRUST_PROXY_PARAM = (lambda value: isinstance(value, bool), False)
+TRUSTED_HOPS_PARAM = (lambda value: isinstance(value, int) and not isinstance(value, bool) and value >= 1, 1)
+
+MIDDLEWARE_TEMPLATES = {
+    'country_filter': MiddlewareTemplate(
+        f"국가 코드로 요청 차단/허용 (country_header는 프록시가 넣는 헤더: {', '.join(PROXY_COUNTRY_HEADERS)})",
+        COUNTRY_FILTER_TEMPLATE,
+        {'mode': FILTER_MODE,
+         'countries': (lambda value: _is_str_list(value) and bool(value) and all(len(item) == 2 for item in value), REQUIRED),
+         'status_code': (_is_status, 403),
+         'country_header': (is_proxy_country_header, REQUIRED),
+         'trusted_proxies': (_valid_networks, [])},
+        derived=lambda values: {'countries': sorted(item.upper() for item in values['countries']),
+                                'country_header_key': header_environ_key(values['country_header']),
+                                'trusted_proxies': [str(ipaddress.ip_network(item, strict=False))
+                                                    for item in values['trusted_proxies']]},
+    ),
+    'ip_filter': MiddlewareTemplate(
+        "IP 주소/대역으로 요청 차단/허용", IP_FILTER_TEMPLATE,
+        {'mode': FILTER_MODE, 'networks': (lambda value: bool(value) and _valid_networks(value), REQUIRED),
+         'status_code': (_is_status, 403), 'trust_proxy': TRUST_PROXY_PARAM, 'trusted_hops': TRUSTED_HOPS_PARAM},
+        derived=lambda values: {'networks': [str(ipaddress.ip_network(item, strict=False)) for item in values['networks']]},
+    ),
+    'require_header': MiddlewareTemplate(
+        "필수 요청 헤더가 없으면 거부", REQUIRE_HEADER_TEMPLATE,
+        {'header_name': (lambda value: isinstance(value, str) and bool(re.fullmatch(r"[A-Za-z0-9-]+", value)), REQUIRED),
+         'status_code': (_is_status, 400)},
+        derived=lambda values: {'header_key': header_environ_key(values['header_name'])},
+    ),
+    'body_size_limit': MiddlewareTemplate(
+        "요청 본문 크기 제한", BODY_SIZE_LIMIT_TEMPLATE,
+        {'max_body_bytes': (lambda value: isinstance(value, int) and value > 0, REQUIRED),
+         'status_code': (_is_status, 413)},
+    ),
+    'rate_limit': MiddlewareTemplate(
+        "클라이언트별 요청 수 제한", RATE_LIMIT_TEMPLATE,
+        {'limit': (lambda value: isinstance(value, int) and value > 0, REQUIRED),
+         'window_seconds': (_is_positive, REQUIRED),
+         'key': (lambda value: value in ('client_ip', 'api_key', 'user'), 'client_ip'),
+         'status_code': (_is_status, 429), 'trust_proxy': TRUST_PROXY_PARAM, 'trusted_hops': TRUSTED_HOPS_PARAM},
+    ),
+    'cors': MiddlewareTemplate(
+        "CORS 허용 출처/메서드 설정", CORS_TEMPLATE,
+        {'allowed_origins': (lambda value: _is_str_list(value) and bool(value), ['*']),
+         'allowed_methods': (lambda value: _is_str_list(value) and bool(value)
+                             and all(item.upper() in HTTP_METHODS for item in value), HTTP_METHODS[:5]),
+         'allow_credentials': (lambda value: isinstance(value, bool), False),
+         'max_age': (lambda value: isinstance(value, int) and value >= 0, 600)},
+        derived=lambda values: {'allowed_methods_header': ", ".join(item.upper() for item in values['allowed_methods'])},
+        # 자격 증명을 허용하면서 모든 출처를 허용하는 설정은 보안상 템플릿으로 만들지 않음
+        check=lambda values: not (values['allow_credentials'] and '*' in values['allowed_origins']),
+    ),
+    'request_logging': MiddlewareTemplate(
+        "요청/응답 로깅", REQUEST_LOGGING_TEMPLATE,
+        {'log_headers': (lambda value: isinstance(value, bool), False),
+         'slow_request_seconds': (_is_positive, 1.0)},
+    ),
+    'response_cache': MiddlewareTemplate(
+        "GET 응답 캐싱", RESPONSE_CACHE_TEMPLATE,
+        {'ttl_seconds': (_is_positive, 60), 'max_entries': (lambda value: isinstance(value, int) and value > 0, 1024)},
+    ),
+    'header_transform': MiddlewareTemplate(
+        "응답 헤더 추가/제거", HEADER_TRANSFORM_TEMPLATE,
+        {'set_headers': (_is_header_map, {}), 'remove_headers': (_is_str_list, [])},
+        check=lambda values: bool(values['set_headers'] or values['remove_headers']),
+    ),
+    'content_filter': MiddlewareTemplate(
+        "쿼리/본문의 금지 패턴 차단", CONTENT_FILTER_TEMPLATE,
+        {'blocked_patterns': (_valid_patterns, REQUIRED), 'status_code': (_is_status, 400),
+         'max_scan_bytes': (lambda value: isinstance(value, int) and value > 0, 65536)},
+    ),
+}
+
+def describe_templates() -> str:
+    """ParsingAgent 프롬프트에 넣을 intent 목록입니다."""
+    lines = []
+    for intent, template in MIDDLEWARE_TEMPLATES.items():
+        required = [name for name, (_, default) in template.params.items() if default is REQUIRED]
+        optional = [name for name, (_, default) in template.params.items() if default is not REQUIRED]
+        lines.append(f"- {intent}: {template.description} (필수: {', '.join(required) or '없음'}"
+                     f" / 선택: {', '.join(optional) or '없음'})")
+    return "\n".join(lines)
+
+class TemplateLibrary:
+    """분석된 intent와 parameters가 템플릿 규격에 맞으면 LLM 대신 템플릿으로 코드를 만듭니다."""
+    def __init__(self, templates: Dict[str, MiddlewareTemplate] = MIDDLEWARE_TEMPLATES):
+        self.templates = templates
+        self._lock = threading.Lock()
+        self.stats = {'template_hits': 0, 'llm_generations': 0}
+
+    def render(self, requirements: Dict) -> Optional[str]:
+        """템플릿이 없거나 parameters가 규격을 벗어나면(사용자 정의 요구사항) None을 반환합니다."""
+        code = None
+        template = self.templates.get(requirements.get('intent')) if isinstance(requirements, dict) else None
+        if template:
+            values = template.bind(requirements.get('parameters', {}))
+            if values is not None:
+                code = f"# 템플릿: {requirements['intent']}\n" + template.render(values)
+        with self._lock:
+            self.stats['template_hits' if code else 'llm_generations'] += 1
+        return code
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.stats['template_hits'] + self.stats['llm_generations']
+            return dict(self.stats, hit_rate=self.stats['template_hits'] / total if total else 0.0)
+
+@st.cache_resource
+def get_template_library() -> TemplateLibrary:
+    return TemplateLibrary()
+
+# 프롬프트 접두사 캐시: 모든 에이전트는 역할 설명, 템플릿 목록, 작업별 규칙 전체를 담은 같은 첫 system 블록을 보내고,
+# 이번 작업을 고르는 짧은 블록과 요청마다 바뀌는 내용은 그 뒤(system 두 번째 블록, user 메시지)에 둡니다.
+# 모델별 최소 길이(Haiku 2048, 그 외 1024토큰)보다 짧은 접두사는 API가 캐시하지 않으므로, 도구 스키마와 첫 블록을 합친
+# 접두사가 최소 길이를 넘는 요청에만 첫 system 블록에 cache_control 중단점 하나를 붙입니다.
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "1") != "0"
+PROMPT_CACHE_MIN_TOKENS = {'haiku': 2048}
+PROMPT_CACHE_DEFAULT_MIN_TOKENS = 1024
+
+def min_cacheable_tokens(model: str) -> int:
+    """모델이 캐시할 수 있는 최소 접두사 토큰 수입니다."""
+    return next((tokens for family, tokens in PROMPT_CACHE_MIN_TOKENS.items() if family in str(model).lower()),
+                PROMPT_CACHE_DEFAULT_MIN_TOKENS)
+
+def prompt_prefix_tokens(params: Dict) -> int:
+    """tools와 첫 system 블록으로 이루어진 공유 접두사의 토큰 수를 로컬에서 추정합니다."""
+    system = params.get('system') or []
+    text = system if isinstance(system, str) else (system[0].get('text', '') if system else '')
+    tools = params.get('tools')
+    return (estimate_prompt_tokens(json.dumps(tools, ensure_ascii=False)) if tools else 0) + estimate_prompt_tokens(text)
+
+def with_prompt_cache_breakpoint(params: Dict) -> Dict:
+    """공유 접두사가 모델의 최소 캐시 길이를 넘으면 첫 system 블록에 중단점을 붙인 params를 반환합니다.
+
+    짧은 접두사에 붙인 중단점은 API가 무시하므로 보내지 않습니다.
+    """
+    system = params.get('system')
+    if (not PROMPT_CACHE_ENABLED or not isinstance(system, list) or not system
+            or prompt_prefix_tokens(params) < min_cacheable_tokens(params.get('model'))):
+        return params
+    return {**params, 'system': [{**system[0], 'cache_control': {"type": "ephemeral"}}, *system[1:]]}
+
+# 모든 에이전트가 공유하는 첫 번째 system 블록의 머리말
+AGENT_BASE_PROMPT = """당신은 자연어 요청을 분석해 Python HTTP 미들웨어를 생성, 검증, 개선, 문서화하는 시스템의 에이전트입니다.
+아래에는 이 시스템의 모든 작업 규칙이 있습니다. 마지막 system 블록이 지정한 작업의 규칙만 따르세요."""
+
+PARSING_RULES = f"""사용자의 자연어 요청을 분석하여 JSON 형태로 구조화해주세요.
+
+다음 항목들을 반드시 포함해주세요:
+1. "intent": 요청의 주요 의도
+2. "entities": 필요한 주요 개체들의 배열
+3. "requirements": 구체적인 요구사항들의 배열
+4. "constraints": 제약사항이나 고려사항들의 배열
+5. "parameters": 필요한 설정값들을 키-값 쌍으로
+
+요청이 아래 템플릿 미들웨어 중 하나에 해당하면 "intent"에 해당 이름을, "parameters"에는 나열된 키만 사용하세요:
+{describe_templates()}
+
+규칙:
+1. 응답은 반드시 유효한 JSON 형식이어야 합니다.
+2. JSON 외의 다른 텍스트는 포함하지 마세요.
+3. 모든 키는 영문 소문자로 작성하세요.
+4. 값은 한글 또는 영문으로 작성할 수 있습니다."""
+
+SAMPLE_REQUEST_RULES = """HTTP Request 처리를 위한 미들웨어 요청을 JSON 배열로 생성해주세요.
+
+고려해야 할 HTTP Request 관련 카테고리:
+1. 요청 헤더 검증/수정 (예: Content-Type, Authorization 등)
+2. 요청 본문 검증/변환 (예: JSON 유효성 검사, 크기 제한 등)
+3. 요청 파라미터 처리 (예: URL 파라미터 검증, 쿼리 파라미터 정제 등)
+4. 요청 보안 관련 (예: CORS, XSS 방지, JWT 검증 등)
+5. 요청 최적화 (예: 압축, 캐싱, 요청 횟수 제한 등)
+
+응답 예시:
+[
+    "들어오는 모든 HTTP 요청의 Content-Type이 application/json인지 검증하는 미들웨어",
+    "요청 헤더에 유효한 JWT 토큰이 있는지 확인하는 미들웨어",
+    "POST 요청의 본문 크기를 5MB로 제한하는 미들웨어"
+]
+
+규칙:
+1. 각 요청은 구체적인 HTTP Request 처리와 관련되어야 합니다.
+2. 실제 웹 애플리케이션에서 활용 가능한 현실적인 시나리오여야 합니다.
+3. 보안, 성능, 데이터 무결성 등 다양한 측면을 고려해야 합니다.
+4. 응답은 반드시 JSON 배열 형식이어야 합니다.
+5. 각 요청은 명확하고 구체적이어야 합니다.
+6. 최소한 3개 이상의 요청을 만들어야 합니다.
+
+최대한 실용적이고 일반적으로 필요한 HTTP Request 미들웨어 요청을 생성해주세요."""
+
+MIDDLEWARE_RULES = """주어진 요구사항에 맞는 HTTP 미들웨어 코드를 생성해주세요.
+
+규칙:
+1. 코드는 Python으로 작성해주세요.
+2. 필요한 주석을 포함해주세요.
+3. 코드외에 다른 설명은 포함하지 마세요.
+4. 함수는 "HTTP Request" 형태를 입력받습니다."""
+
+VALIDATION_RULES = """주어진 Python 코드가 요구사항을 충족하는지 검증하고, report_validation 도구로 결과를 보고해주세요.
+문제가 없는 분류는 빈 배열로 두세요."""
+
+IMPROVEMENT_RULES = """주어진 코드를 검증 결과를 바탕으로 개선해주세요.
+
+개선 규칙:
+1. 검증 결과에서 지적된 모든 문제를 해결해야 합니다.
+2. 에러 처리와 예외 상황 대응을 강화해야 합니다.
+3. 코드 성능과 보안을 개선해야 합니다.
+4. 기존 기능은 모두 유지하면서 개선해야 합니다.
+5. 모든 변경사항에 대해 주석으로 설명을 추가해야 합니다.
+6. HTTP 미들웨어의 표준 패턴을 따라야 합니다.
+
+응답 형식:
+1. Python 코드만 제공해주세요.
+2. 추가 설명이나 마크다운은 포함하지 마세요."""
+
+VERIFICATION_RULES = """개선된 코드가 원래 요구사항을 충족하면서 실제로 개선되었는지 검증해주세요.
+True 또는 False로만 응답해주세요."""
+
+DOCUMENTATION_RULES = """주어진 Python 코드에 대한 문서를 생성해주세요.
+코드가 원본 코드의 개선 버전이면 문서에 다음 내용을 포함해주세요:
+1. 개선된 부분 설명
+2. 성능/보안 개선사항
+3. 변경된 로직 설명"""
+
+CHANGES_SUMMARY_RULES = """주어진 코드 변경 내용을 분석하여 요약해주세요.
+
+요약 포함 사항:
+1. 주요 변경사항 목록
+2. 개선된 기능/성능
+3. 보안 강화 사항
+4. 코드 구조 변경
+5. 새로운 예외 처리
+
+응답 형식:
+1. Markdown 형식
+2. 명확한 섹션 구분
+3. 중요 변경사항 강조"""
+
+API_DOCUMENTATION_RULES = """주어진 미들웨어 코드에 대한 API 문서를 생성해주세요.
+
+문서 포함 사항:
+1. API 엔드포인트 설명
+2. 요청/응답 형식
+3. 미들웨어 동작 방식
+4. 에러 처리 방법
+5. 설정 옵션
+6. 사용 예시
+
+응답 형식:
+1. Markdown 형식
+2. OpenAPI 스펙 호환
+3. 명확한 예시 포함"""
+
+ENHANCED_REQUIREMENTS_RULES = """주어진 요청과 유사한 이전 사례들을 바탕으로 향상된 요구사항을 생성해주세요.
+
+응답 규칙:
+1. 반드시 유효한 JSON 형식으로 응답해야 합니다
+2. 모든 키는 영문 소문자로 작성하세요
+3. JSON 외의 다른 텍스트는 포함하지 마세요
+4. 빈 응답은 허용되지 않습니다"""
+
+# 작업 이름 -> (제목, 고정 지시문). 순서가 곧 공유 블록 안의 순서입니다.
+AGENT_TASKS = {
+    'parsing': ("요구사항 분석", PARSING_RULES),
+    'sample_request': ("예시 요청 생성", SAMPLE_REQUEST_RULES),
+    'middleware': ("미들웨어 생성", MIDDLEWARE_RULES),
+    'validation': ("코드 검증", VALIDATION_RULES),
+    'improvement': ("코드 개선", IMPROVEMENT_RULES),
+    'verification': ("개선 확인", VERIFICATION_RULES),
+    'documentation': ("문서 생성", DOCUMENTATION_RULES),
+    'changes_summary': ("변경사항 요약", CHANGES_SUMMARY_RULES),
+    'api_documentation': ("API 문서 생성", API_DOCUMENTATION_RULES),
+    'enhanced_requirements': ("요구사항 보강", ENHANCED_REQUIREMENTS_RULES),
+}
+
+@lru_cache(maxsize=1)
+def shared_agent_prompt() -> str:
+    """모든 에이전트가 첫 system 블록으로 보내는 공유 지시문입니다 (작업별 규칙과 검증 결과 형식).
+
+    내용이 바이트 단위로 같아야 에이전트 사이에서도 접두사 캐시가 적중하므로 요청마다 바뀌는 값은 넣지 않습니다.
+    """
+    sections = [f"## [{task}] {title}\n{rules}" for task, (title, rules) in AGENT_TASKS.items()]
+    # 검증, 개선, 개선 확인 작업이 주고받는 검증 결과의 필드 정의
+    report_schema = json.dumps(VALIDATION_REPORT_TOOL['input_schema'], ensure_ascii=False, indent=2)
+    return "\n\n".join([AGENT_BASE_PROMPT, *sections, f"## 검증 결과 형식 (report_validation 도구 입력)\n{report_schema}"])
+
+def prompt_prefix(task: str) -> List[Dict]:
+    """공유 지시문 블록과 이번 작업을 지정하는 블록으로 system 파라미터를 만듭니다.
+
+    캐시 중단점은 게이트웨이가 모델을 정한 뒤 접두사 길이를 보고 첫 블록에 붙입니다(with_prompt_cache_breakpoint).
+    요청마다 바뀌는 내용은 user 메시지로만 보내야 합니다.
+    """
+    title, _ = AGENT_TASKS[task]
+    return [{"type": "text", "text": shared_agent_prompt()},
+            {"type": "text", "text": f"이번 작업은 [{task}] {title}입니다. 위의 [{task}] 규칙만 따르세요."}]
+
+class ParsingAgent:
+    def __init__(self):
+        self.client = anthropic
+        self.rule_parser = get_rule_parser()
+        
+    @track_llm_calls
+    def parse_natural_language(self, text: str) -> Dict:
+        # 자주 들어오는 형태의 요청은 LLM 호출 없이 규칙으로 분석
+        parsed = self.rule_parser.parse(text)
+        if parsed is not None:
+            return parsed
+
+        # 응답이 JSON 객체가 아니면 기본 모델로 한 번 더 요청
+        for escalate in (False, True):
+            response = self.client.messages.create(
+                model=ROUTED_MODEL,
+                max_tokens=1000,
+                system=prompt_prefix('parsing'),
+                messages=[{"role": "user", "content": f"요청: {text}"}],
+                temperature=0.1,
+                escalate=escalate,
+            )
+            try:
+                parsed = json.loads(response.content[0].text)
+            except json.JSONDecodeError as e:
+                error = e
+                continue
+            if isinstance(parsed, dict):
+                return parsed
+            error = "JSON 객체가 아닙니다"
+
+        st.error(f"JSON 파싱 오류: {str(error)}")
+        st.write("원본 응답:", response.content[0].text)
+        return {}
+
+class SampleRequestAgent:
+    def __init__(self):
+        self.client = anthropic
+        
+    @track_llm_calls
+    def generate_sample_requests(self, n: int = 5) -> List[str]:
+        response = self.client.messages.create(
+            model=ROUTED_MODEL,
+            max_tokens=500,
+            system=prompt_prefix('sample_request'),
+            messages=[{"role": "user", "content": f"미들웨어 요청 {n}개를 생성해주세요."}],
+            temperature=0.5,
+        )
         
-        return results
+        try:
+            samples = json.loads(response.content[0].text)
+            # 추가 검증: 각 샘플이 HTTP Request 관련 키워드를 포함하는지 확인
+            http_keywords = ['http', 'request', 'header', 'body', 'payload', 'content-type', 
+                           'authorization', 'token', 'jwt', 'cors', 'method', 'get', 'post', 
+                           'put', 'delete', 'url', 'query', 'parameter']
+            
+            validated_samples = []
+            for sample in samples:
+                sample_lower = sample.lower()
+                if any(keyword in sample_lower for keyword in http_keywords):
+                    validated_samples.append(sample)
+            
+            return validated_samples if validated_samples else []
+            
+        except json.JSONDecodeError as e:
+            st.error(f"JSON 파싱 오류: {str(e)}")
+            st.write("원본 응답:", response.content[0].text)
+            return []
+
+# 프롬프트에 넣는 가변 맥락(코드 변경 내용, 검증 결과 등)의 토큰 예산
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", 3000))
+# unified diff에서 변경된 줄 앞뒤로 함께 보여줄 줄 수
+PROMPT_DIFF_CONTEXT_LINES = 3
+
+def estimate_prompt_tokens(text: str) -> int:
+    """API 호출 없이 토큰 수를 추정합니다. 영문/코드는 약 4글자, 한글 등은 약 1글자가 1토큰입니다."""
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return math.ceil(ascii_chars / 4) + (len(text) - ascii_chars)
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """줄 단위로 앞에서부터 예산만큼 남기고 생략한 줄 수를 표시합니다."""
+    if estimate_prompt_tokens(text) <= max_tokens:
+        return text
+    lines = text.splitlines()
+    kept, used = [], 0
+    for line in lines:
+        cost = estimate_prompt_tokens(line) + 1
+        if used + cost > max_tokens:
+            break
+        kept.append(line)
+        used += cost
+    return "\n".join(kept + [f"... ({len(lines) - len(kept)}줄 생략)"])
+
+def code_diff(original_code: str, improved_code: str) -> str:
+    return "".join(difflib.unified_diff(
+        original_code.splitlines(keepends=True), improved_code.splitlines(keepends=True),
+        fromfile="original.py", tofile="improved.py", n=PROMPT_DIFF_CONTEXT_LINES,
+    ))
+
+def _code_definitions(code: str) -> Optional[Dict[str, str]]:
+    """최상위 함수/클래스와 클래스 메서드를 이름별로, import 문은 문장별로 AST 덤프와 함께 모읍니다."""
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+    definitions = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            definitions[node.name] = ast.dump(node)
+            if isinstance(node, ast.ClassDef):
+                for member in node.body:
+                    if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                        definitions[f"{node.name}.{member.name}"] = ast.dump(member)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            definitions[ast.unparse(node)] = 'import'
+    return definitions
+
+def code_change_set(original_code: str, improved_code: str) -> Optional[str]:
+    """추가/삭제/변경된 함수, 클래스, 메서드와 import를 나열합니다. 파싱할 수 없으면 None을 반환합니다."""
+    before, after = _code_definitions(original_code), _code_definitions(improved_code)
+    if before is None or after is None:
+        return None
+    groups = {
+        "추가된 정의": [name for name in after if name not in before and after[name] != 'import'],
+        "삭제된 정의": [name for name in before if name not in after and before[name] != 'import'],
+        "변경된 정의": [name for name in after if name in before and after[name] != before[name]],
+        "추가된 import": [name for name in after if name not in before and after[name] == 'import'],
+        "삭제된 import": [name for name in before if name not in after and before[name] == 'import'],
+    }
+    return "\n".join(f"- {title}: {', '.join(names)}" for title, names in groups.items() if names) or "- 변경된 정의 없음"
+
+def code_changes_context(original_code: str, improved_code: str, max_tokens: int = PROMPT_CONTEXT_TOKENS) -> str:
+    """원본/개선 코드 전체 대신 보낼 변경 내용입니다.
+
+    unified diff가 예산 안에 들어가면 그대로 보내고, 넘으면 AST 수준 변경 목록과 함께
+    예산에 들어가는 hunk까지만 보냅니다.
+    """
+    diff = code_diff(original_code, improved_code)
+    if not diff:
+        return "변경 사항 없음"
+    if estimate_prompt_tokens(diff) <= max_tokens:
+        return f"```diff\n{diff}```"
+
+    change_set = code_change_set(original_code, improved_code)
+    header = f"변경된 정의 (AST 기준):\n{truncate_to_tokens(change_set, max_tokens // 2)}\n\n" if change_set else ""
+    budget = max_tokens - estimate_prompt_tokens(header)
+    hunks = re.split(r"(?m)^(?=@@)", diff)
+    kept, used = [hunks[0]], estimate_prompt_tokens(hunks[0])
+    for hunk in hunks[1:]:
+        cost = estimate_prompt_tokens(hunk)
+        if used + cost > budget:
+            if not kept[1:]:
+                kept.append(truncate_to_tokens(hunk, budget - used) + "\n")
+            break
+        kept.append(hunk)
+        used += cost
+    omitted = len(hunks) - len(kept)
+    note = f"... (diff hunk {omitted}개 생략)\n" if omitted > 0 else ""
+    return f"{header}```diff\n{''.join(kept)}{note}```"
+
+def changed_definitions_source(original_code: str, improved_code: str) -> Optional[str]:
+    """개선 코드에서 추가되거나 바뀐 함수, 클래스, 메서드의 소스를 모읍니다. 파싱할 수 없으면 None을 반환합니다.
+
+    기존 클래스는 메서드 외의 부분이 그대로면 바뀐 메서드만 넣습니다.
+    """
+    before = _code_definitions(original_code)
+    if before is None:
+        return None
+    try:
+        tree = ast.parse(improved_code)
+    except (SyntaxError, ValueError):
+        return None
+
+    def class_shell(node: ast.ClassDef) -> str:
+        return ast.dump(ast.ClassDef(node.name, node.bases, node.keywords, [
+            member for member in node.body if not isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef))
+        ], node.decorator_list))
+
+    original_shells = {node.name: class_shell(node) for node in ast.parse(original_code).body
+                       if isinstance(node, ast.ClassDef)}
+
+    sources = []
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) or before.get(node.name) == ast.dump(node):
+            continue
+        if isinstance(node, ast.ClassDef) and original_shells.get(node.name) == class_shell(node):
+            sources += [ast.get_source_segment(improved_code, member) for member in node.body
+                        if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef))
+                        and before.get(f"{node.name}.{member.name}") != ast.dump(member)]
+        else:
+            sources.append(ast.get_source_segment(improved_code, node))
+    return "\n\n".join(source for source in sources if source)
+
+def improved_code_context(original_code: str, improved_code: str, max_tokens: int = PROMPT_CONTEXT_TOKENS) -> str:
+    """개선 코드를 설명하는 맥락으로 '변경 내용 + 바뀐 정의의 소스'와 '개선 코드 전체' 중 더 짧은 쪽 하나만 보냅니다."""
+    full = f"개선된 코드:\n{code_context(improved_code, max_tokens)}"
+    changed = changed_definitions_source(original_code, improved_code)
+    changes = f"원본 대비 변경 내용:\n{code_changes_context(original_code, improved_code, max_tokens)}"
+    if changed:
+        changes += f"\n\n변경된 정의의 개선 후 코드:\n```python\n{truncate_to_tokens(changed, max_tokens)}\n```"
+    return min((changes, full), key=estimate_prompt_tokens)
+
+def is_valid_python(text: str) -> bool:
+    """응답 전체(또는 응답을 감싼 ``` 코드 블록 안)가 파이썬 코드로 파싱되는지 확인합니다."""
+    fenced = re.fullmatch(r"\s*```(?:python|py)?\n(.*?)\n?```\s*", text, re.S)
+    try:
+        ast.parse(fenced.group(1) if fenced else text)
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+def code_context(code: str, max_tokens: int = PROMPT_CONTEXT_TOKENS) -> str:
+    """코드가 예산을 넘으면 전체 대신 함수/클래스 시그니처와 docstring만 남긴 개요를 보냅니다."""
+    if estimate_prompt_tokens(code) <= max_tokens:
+        return code
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return truncate_to_tokens(code, max_tokens)
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            docstring = ast.get_docstring(node)
+            node.body = ([ast.Expr(ast.Constant(docstring))] if docstring else []) + [ast.Expr(ast.Constant(...))]
+    return truncate_to_tokens("# 코드가 길어 함수 본문을 생략한 개요입니다.\n" + ast.unparse(tree), max_tokens)
+
+# 검증 결과의 문제 분류 (키 → 화면에 표시할 이름)
+VALIDATION_CATEGORIES = {
+    'security_issues': "보안",
+    'performance_issues': "성능",
+    'error_handling': "에러 처리",
+    'code_structure': "코드 구조",
+    'functionality_issues': "기능",
+}
+VALIDATION_LIST_FIELDS = ['satisfied_requirements', *VALIDATION_CATEGORIES, 'suggestions']
+# 검증 결과를 구조화된 형태로 받기 위한 도구 정의 (tool_choice로 이 도구만 호출하게 함)
+VALIDATION_REPORT_TOOL = {
+    'name': 'report_validation',
+    'description': "미들웨어 코드가 요구사항을 충족하는지 검증한 결과를 분류해서 보고합니다.",
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            'meets_requirements': {'type': 'boolean', 'description': "요구사항을 모두 충족하면 true"},
+            'summary': {'type': 'string', 'description': "검증 결과 요약 (2~3문장)"},
+            'satisfied_requirements': {'type': 'array', 'items': {'type': 'string'},
+                                       'description': "충족한 요구사항"},
+            **{category: {'type': 'array', 'items': {'type': 'string'}, 'description': f"{label} 관련 문제점"}
+               for category, label in VALIDATION_CATEGORIES.items()},
+            'suggestions': {'type': 'array', 'items': {'type': 'string'}, 'description': "구체적인 개선 제안"},
+        },
+        'required': ['meets_requirements', 'summary', *VALIDATION_LIST_FIELDS],
+    },
+}
+# 도구 입력이 스키마에 맞지 않을 때 다시 요청하는 횟수
+VALIDATION_MAX_ATTEMPTS = 2
+
+def check_validation_report(report: Any) -> Dict:
+    """도구 입력이 검증 결과 스키마에 맞는지 확인합니다. 빠진 목록은 빈 목록으로 채우고, 형식이 다르면 ValueError를 냅니다."""
+    if not isinstance(report, dict):
+        raise ValueError("검증 결과가 객체가 아닙니다")
+    if not isinstance(report.get('meets_requirements'), bool) or not isinstance(report.get('summary'), str):
+        raise ValueError("검증 결과에 meets_requirements 또는 summary가 없습니다")
+    checked = {'meets_requirements': report['meets_requirements'], 'summary': report['summary'].strip()}
+    for field in VALIDATION_LIST_FIELDS:
+        items = report.get(field, [])
+        if not isinstance(items, list) or not all(isinstance(item, str) for item in items):
+            raise ValueError(f"검증 결과의 {field}가 문자열 목록이 아닙니다")
+        checked[field] = [item.strip() for item in items if item.strip()]
+    if report.get('failed') is True:
+        checked['failed'] = True
+    return checked
+
+def failed_validation_report(reason: str) -> Dict:
+    """검증 결과를 받지 못했을 때 파이프라인을 멈추지 않고 쓰는, 실패로 표시된 검증 결과입니다."""
+    return check_validation_report({'meets_requirements': False, 'summary': f"검증 실패: {reason}", 'failed': True})
+
+def render_validation_report(report: Dict) -> str:
+    """구조화된 검증 결과를 화면 표시와 히스토리 저장에 쓰는 마크다운으로 만듭니다."""
+    lines = [f"**요구사항 충족: {'✅ 예' if report['meets_requirements'] else '❌ 아니오'}**", "", report['summary']]
+    sections = [("충족한 요구사항", report['satisfied_requirements'])]
+    sections += [(f"{label} 문제", report[category]) for category, label in VALIDATION_CATEGORIES.items()]
+    sections.append(("개선 제안", report['suggestions']))
+    for title, items in sections:
+        if items:
+            lines += ["", f"#### {title}", *(f"- {item}" for item in items)]
+    return "\n".join(lines)
+
+class ValidationAgent:
+    def __init__(self):
+        self.client = anthropic
+        
+    def validate_middleware(self, code: str, requirements: Dict) -> str:
+        return render_validation_report(self.validate_middleware_report(code, requirements))
+
+    @track_llm_calls
+    def validate_middleware_report(self, code: str, requirements: Dict) -> Dict:
+        """검증 결과를 문제 유형별로 분류된 구조로 반환합니다. (VALIDATION_REPORT_TOOL 스키마)
+
+        여러 번 요청해도 스키마에 맞는 결과를 받지 못하면 오류를 summary에 담은 실패 결과(failed=True)를 반환합니다.
+        """
+        prompt = f"""
+        코드: {code}
+
+        요구사항: {json.dumps(requirements, ensure_ascii=False, indent=2)}
+        """
+
+        error = None
+        for attempt in range(VALIDATION_MAX_ATTEMPTS):
+            response = self.client.messages.create(
+                model=ROUTED_MODEL,
+                max_tokens=1500,
+                tools=[VALIDATION_REPORT_TOOL],
+                tool_choice={"type": "tool", "name": VALIDATION_REPORT_TOOL['name']},
+                system=prompt_prefix('validation'),
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1,
+                # 형식이 잘못된 응답은 캐시를 쓰지 않고 다시 요청 (빠른 모델로 라우팅된 경우에는 기본 모델로 승격)
+                escalate=attempt > 0,
+            )
+            try:
+                tool_input = next(block.input for block in response.content if block.type == 'tool_use')
+                return check_validation_report(tool_input)
+            except (StopIteration, ValueError) as e:
+                error = e
+        return failed_validation_report(f"검증 결과 형식이 올바르지 않습니다 ({error})")
+
+class MiddlewareAgent:
+    def __init__(self):
+        self.client = anthropic
+        self.template_library = get_template_library()
+
+    def generate_middleware(self, requirements: Dict) -> str:
+        return "".join(self.generate_middleware_stream(requirements))
+
+    @track_llm_calls
+    def generate_middleware_stream(self, requirements: Dict) -> Iterator[str]:
+        """미들웨어 코드를 생성되는 대로 조각 단위로 반환합니다."""
+        # 템플릿이 있는 미들웨어는 LLM 호출 없이 바로 렌더링
+        code = self.template_library.render(requirements)
+        if code is not None:
+            return iter([code])
+
+        prompt = f"""
+        요구사항:
+        {json.dumps(requirements, ensure_ascii=False, indent=2)}
+        """
+        
+        return self.client.messages.stream_text(
+            model=ROUTED_MODEL,
+            max_tokens=2000,
+            system=prompt_prefix('middleware'),
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.2,
+        )
+
+    @track_llm_calls
+    def generate_improved_code(self, original_code: str, validation_report: Dict) -> str:
+        """문제 유형별로 분류된 검증 결과(ValidationAgent.validate_middleware_report)를 바탕으로 개선된 코드를 생성합니다."""
+        # 원본 코드는 전체를 다시 작성해야 하므로 그대로 보내고, 검증 결과만 토큰 예산에 맞춥니다.
+        improvement_areas = {category: validation_report[category] for category in VALIDATION_CATEGORIES if validation_report[category]}
+        feedback = truncate_to_tokens(
+            f"{validation_report['summary']}\n\n"
+            f"개선 필요 영역:\n{json.dumps(improvement_areas, ensure_ascii=False, indent=1)}\n\n"
+            f"개선 제안:\n{json.dumps(validation_report['suggestions'], ensure_ascii=False, indent=1)}",
+            PROMPT_CONTEXT_TOKENS,
+        )
+
+        prompt = f"""
+        원본 코드:
+        {original_code}
+
+        검증 결과:
+        {feedback}
+        """
+
+        # 파싱할 수 없는 코드가 나오면 캐시를 쓰지 않고 한 번 더 요청 (빠른 모델로 라우팅된 경우에는 기본 모델로 승격)
+        for escalate in (False, True):
+            response = self.client.messages.create(
+                model=ROUTED_MODEL,
+                max_tokens=2000,
+                system=prompt_prefix('improvement'),
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.2,
+                escalate=escalate,
+            )
+            if is_valid_python(response.content[0].text):
+                break
+        return response.content[0].text
 
-class ParsingAgent:
-    def __init__(self):
-        self.client = anthropic
-        
-    def parse_natural_language(self, text: str) -> Dict:
+    @track_llm_calls
+    def verify_improvements(self, original_code: str, improved_code: str, requirements: Dict) -> bool:
+        """개선된 코드가 원래 요구사항을 충족하면서 실제로 개선되었는지 확인합니다."""
         prompt = f"""
-        다음 자연어 요청을 분석하여 JSON 형태로 구조화해주세요.
-
-        요청: {text}
-
-        다음 항목들을 반드시 포함해주세요:
-        1. "intent": 요청의 주요 의도
-        2. "entities": 필요한 주요 개체들의 배열
-        3. "requirements": 구체적인 요구사항들의 배열
-        4. "constraints": 제약사항이나 고려사항들의 배열
-        5. "parameters": 필요한 설정값들을 키-값 쌍으로
-
-        규칙:
-        1. 응답은 반드시 유효한 JSON 형식이어야 합니다.
-        2. JSON 외의 다른 텍스트는 포함하지 마세요.
-        3. 모든 키는 영문 소문자로 작성하세요.
-        4. 값은 한글 또는 영문으로 작성할 수 있습니다.
+        {improved_code_context(original_code, improved_code)}
+
+        요구사항:
+        {json.dumps(requirements, ensure_ascii=False, indent=2)}
         """
-        
+
         response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=1000,
+            model=ROUTED_MODEL,
+            max_tokens=100,
+            system=prompt_prefix('verification'),
             messages=[{"role": "user", "content": prompt}],
             temperature=0.1,
         )
-        
-        try:
-            return json.loads(response.content[0].text)
-        except json.JSONDecodeError as e:
-            st.error(f"JSON 파싱 오류: {str(e)}")
-            st.write("원본 응답:", response.content[0].text)
-            return {}
-
-class SampleRequestAgent:
+        answer = response.content[0].text.strip().strip('.').lower()
+        if answer not in ('true', 'false'):
+            # True/False 형식을 지키지 않은 응답은 기본 모델로 다시 판단
+            response = self.client.messages.create(
+                model=ROUTED_MODEL,
+                max_tokens=100,
+                system=prompt_prefix('verification'),
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.1,
+                escalate=True,
+            )
+            answer = response.content[0].text.lower()
+        return "true" in answer
+    
+class DocumentationAgent:
     def __init__(self):
         self.client = anthropic
+    def generate_documentation(self, code: str, is_improved: bool = False, original_code: str = None) -> str:
+        """코드에 대한 문서를 생성합니다."""
+        return "".join(self.generate_documentation_stream(code, is_improved, original_code))
+
+    @track_llm_calls
+    def generate_documentation_stream(self, code: str, is_improved: bool = False,
+                                      original_code: str = None) -> Iterator[str]:
+        """문서를 생성되는 대로 조각 단위로 반환합니다."""
+        prompt = f"""
+        코드: {code_context(code)}
+        """
         
-    def generate_sample_requests(self, n: int = 5) -> List[str]:
+        if is_improved and original_code:
+            prompt += f"""
+            이 코드는 원본 코드의 개선 버전입니다. 원본 대비 변경 내용:
+            {code_changes_context(original_code, code)}
+            """
+        
+        return self.client.messages.stream_text(
+            model=ROUTED_MODEL,
+            max_tokens=1500,
+            system=prompt_prefix('documentation'),
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,
+        )
+    
+    @track_llm_calls
+    def generate_changes_summary(self, original_code: str, improved_code: str, validation_feedback: str) -> str:
+        """코드 변경사항을 요약합니다."""
         prompt = f"""
-        HTTP Request 처리를 위한 미들웨어 요청 {n}개를 JSON 배열로 생성해주세요.
+            원본 대비 변경 내용:
+            {code_changes_context(original_code, improved_code)}
+            
+            검증 피드백:
+            {truncate_to_tokens(validation_feedback, PROMPT_CONTEXT_TOKENS // 2)}
+            """
+
+        response = self.client.messages.create(
+            model=ROUTED_MODEL,
+            max_tokens=1000,
+            system=prompt_prefix('changes_summary'),
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.2
+        )
         
-        고려해야 할 HTTP Request 관련 카테고리:
-        1. 요청 헤더 검증/수정 (예: Content-Type, Authorization 등)
-        2. 요청 본문 검증/변환 (예: JSON 유효성 검사, 크기 제한 등)
-        3. 요청 파라미터 처리 (예: URL 파라미터 검증, 쿼리 파라미터 정제 등)
-        4. 요청 보안 관련 (예: CORS, XSS 방지, JWT 검증 등)
-        5. 요청 최적화 (예: 압축, 캐싱, 요청 횟수 제한 등)
-
-        응답 예시:
-        [
-            "들어오는 모든 HTTP 요청의 Content-Type이 application/json인지 검증하는 미들웨어",
-            "요청 헤더에 유효한 JWT 토큰이 있는지 확인하는 미들웨어",
-            "POST 요청의 본문 크기를 5MB로 제한하는 미들웨어"
-        ]
+        return response.content[0].text
 
-        규칙:
-        1. 각 요청은 구체적인 HTTP Request 처리와 관련되어야 합니다.
-        2. 실제 웹 애플리케이션에서 활용 가능한 현실적인 시나리오여야 합니다.
-        3. 보안, 성능, 데이터 무결성 등 다양한 측면을 고려해야 합니다.
-        4. 응답은 반드시 JSON 배열 형식이어야 합니다.
-        5. 각 요청은 명확하고 구체적이어야 합니다.
-        6. 최소한 3개 이상의 요청을 만들어야 합니다.
+    @track_llm_calls
+    def generate_api_documentation(self, code: str, requirements: Dict) -> str:
+        """API 문서를 생성합니다."""
+        prompt = f"""
+            코드:
+            {code}
+            
+            요구사항:
+            {json.dumps(requirements, ensure_ascii=False, indent=2)}
+            """
 
-        최대한 실용적이고 일반적으로 필요한 HTTP Request 미들웨어 요청을 생성해주세요.
-        """
-        
         response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=500,
+            model=ROUTED_MODEL,
+            max_tokens=1500,
+            system=prompt_prefix('api_documentation'),
             messages=[{"role": "user", "content": prompt}],
-            temperature=0.5,
+            temperature=0.3
         )
         
+        return response.content[0].text
+
+# 미들웨어 생성 파이프라인 단계 그래프 (단계 → 입력으로 사용하는 단계들)
+# 'input_text'는 외부에서 주어지는 입력이며, 나머지는 에이전트가 생성합니다.
+PIPELINE_GRAPH = {
+    'requirements': ['input_text'],
+    'code': ['requirements'],
+    'documentation': ['code'],
+    'validation_report': ['code', 'requirements'],
+    'validation': ['validation_report'],
+    'improved_code': ['code', 'validation_report'],
+    'improved_documentation': ['improved_code'],
+}
+# LLM을 호출하지 않고 로컬에서 만드는 단계 (검증 결과 마크다운)
+LOCAL_PIPELINE_STAGES = {'validation'}
+
+# "미들웨어 생성" 단계에서 실행하는 목표 (개선 단계는 따로 요청할 때만 실행)
+INITIAL_PIPELINE_TARGETS = ['requirements', 'code', 'documentation', 'validation_report', 'validation']
+IMPROVEMENT_PIPELINE_TARGETS = ['improved_code', 'improved_documentation']
+
+# 스트리밍 중 화면을 갱신하는 최소 간격(초)
+STREAM_UPDATE_INTERVAL = 0.1
+
+# 핵심 파라미터(request_signature)가 같고 입력 임베딩의 코사인 유사도가 이 값 이상인 이전 요청은
+# LLM을 호출하지 않고 저장된 결과를 재사용
+DUPLICATE_SIMILARITY_THRESHOLD = float(os.getenv("DUPLICATE_SIMILARITY_THRESHOLD", 0.75))
+# 유사도 검사 대상으로 가져올 후보 수
+DUPLICATE_CANDIDATES = 5
+# "분당", "per minute", "/s"처럼 숫자 없이 쓰는 시간 창
+WINDOW_WORD_PATTERN = re.compile(r"(초|분|시간|일)\s*(?:당|에|동안)|(?:per|/|every|each)\s*"
+                                 r"(seconds?|secs?|minutes?|mins?|hours?|hrs?|days?|s|m|h|초|분|시간|일)(?![a-z])")
+
+def request_signature(text: str) -> Tuple:
+    """유사한 요청의 결과를 재사용하기 전에 정확히 같아야 하는 핵심 파라미터를 뽑습니다.
+
+    숫자, 크기 단위, 시간 창, HTTP 메서드, 국가, IP, 경로, URL, 헤더 이름, 차단/허용 여부와 부정 표현이며,
+    임베딩 유사도는 "5MB"와 "50MB"처럼 이 값만 다른 요청을 구분하지 못합니다.
+    """
+    normalized = " ".join(unicodedata.normalize('NFKC', text).casefold().split())
+    urls = URL_PATTERN.findall(normalized)
+    rest = URL_PATTERN.sub(" ", normalized)
+    windows = []
+    for korean, english in WINDOW_WORD_PATTERN.findall(rest):
+        unit = korean or english
+        windows.append(RATE_WINDOWS.get(unit) or RATE_WINDOWS.get(unit.rstrip('s'), unit))
+    return (
+        tuple(sorted(f"{float(number):g}" for number in re.findall(r"\d+(?:\.\d+)?", rest))),
+        tuple(sorted(unit for _, unit in SIZE_PATTERN.findall(rest))),
+        tuple(sorted(map(str, windows))),
+        tuple(sorted(set(METHOD_SCOPE_PATTERN.findall(rest)))),
+        tuple(sorted({COUNTRY_CODES[match.group()] for match in COUNTRY_PATTERN.finditer(rest)})),
+        tuple(sorted(set(IP_PATTERN.findall(rest)))),
+        tuple(sorted(set(re.findall(r"(?:^|[\s('\"])(/[a-z0-9_{}/.-]*)", rest)))),
+        tuple(sorted(set(urls))),
+        tuple(sorted({match.group(1) for match in HEADER_NAME_PATTERN.finditer(rest)})),
+        RuleBasedParser._filter_mode(rest),
+        bool(NEGATION_WORDS.search(rest)),
+    )
+# 파이프라인 단계 → 저장된 히스토리 컬럼
+HISTORY_RESULT_COLUMNS = {
+    'requirements': 'requirements',
+    'code': 'initial_code',
+    'documentation': 'initial_documentation',
+    'validation': 'validation',
+    'validation_report': 'validation_report',
+    'improved_code': 'improved_code',
+    'improved_documentation': 'improved_documentation',
+}
+
+class PipelineExecutor:
+    """단계 그래프를 따라 입력이 준비된 단계부터 스레드 풀에서 동시에 실행합니다."""
+    def __init__(self, graph: Dict[str, List[str]], stages: Dict[str, Callable],
+                 max_workers: int = 4, thread_initializer: Optional[Callable] = None,
+                 on_stage_complete: Optional[Callable[[str, Dict], Dict]] = None):
+        self.graph = graph
+        self.stages = stages
+        self.max_workers = max_workers
+        self.thread_initializer = thread_initializer
+        # 단계가 끝날 때마다 (단계 이름, 지금까지의 결과)로 호출되며, 반환한 {단계: 값}은 실행하지 않고 결과로 채움
+        self.on_stage_complete = on_stage_complete
+        self.timings = {}
+        self.seeded_stages = []
+        self.total_time = 0.0
+
+    def _required_stages(self, targets: List[str], available: Dict) -> List[str]:
+        """목표 단계를 만들기 위해 실행해야 하는 단계들을 찾습니다."""
+        required = []
+        pending = list(targets)
+        while pending:
+            stage = pending.pop()
+            if stage in available or stage in required:
+                continue
+            if stage not in self.graph:
+                raise KeyError(f"알 수 없는 파이프라인 단계입니다: {stage}")
+            required.append(stage)
+            pending.extend(self.graph[stage])
+        return required
+
+    def iter_run(self, initial: Dict, targets: List[str] = None) -> Iterator[Tuple[str, Any]]:
+        """완료되는 순서대로 (단계 이름, 결과)를 반환합니다."""
+        results = dict(initial)
+        remaining = self._required_stages(targets or list(self.graph), results)
+        self.timings = {}
+        self.seeded_stages = []
+        started_at = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,
+                                initializer=self.thread_initializer) as pool:
+            running = {}
+            try:
+                while remaining or running:
+                    # 입력이 모두 준비된 단계를 제출
+                    for stage in [s for s in remaining if all(d in results for d in self.graph[s])]:
+                        remaining.remove(stage)
+                        inputs = {dep: results[dep] for dep in self.graph[stage]}
+                        # 작업 스레드에서도 현재 span 아래에 단계 span이 기록되도록 컨텍스트를 복사해 실행
+                        running[pool.submit(contextvars.copy_context().run, self._timed, stage, inputs)] = stage
+
+                    if not running:
+                        raise RuntimeError(f"실행할 수 없는 단계가 있습니다: {remaining}")
+
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage = running.pop(future)
+                        results[stage] = future.result()
+                        yield stage, results[stage]
+                        seeded = self.on_stage_complete(stage, results) if self.on_stage_complete else {}
+                        for seeded_stage, value in seeded.items():
+                            if seeded_stage in remaining:
+                                remaining.remove(seeded_stage)
+                                results[seeded_stage] = value
+                                self.seeded_stages.append(seeded_stage)
+                                yield seeded_stage, value
+            finally:
+                for future in running:
+                    future.cancel()
+                self.total_time = time.perf_counter() - started_at
+
+    def run(self, initial: Dict, targets: List[str] = None) -> Dict:
+        """모든 목표 단계를 실행하고 결과를 딕셔너리로 반환합니다."""
+        results = dict(initial)
+        results.update(self.iter_run(initial, targets))
+        return results
+
+    def _timed(self, stage: str, inputs: Dict):
+        start = time.perf_counter()
         try:
-            samples = json.loads(response.content[0].text)
-            # 추가 검증: 각 샘플이 HTTP Request 관련 키워드를 포함하는지 확인
-            http_keywords = ['http', 'request', 'header', 'body', 'payload', 'content-type', 
-                           'authorization', 'token', 'jwt', 'cors', 'method', 'get', 'post', 
-                           'put', 'delete', 'url', 'query', 'parameter']
-            
-            validated_samples = []
-            for sample in samples:
-                sample_lower = sample.lower()
-                if any(keyword in sample_lower for keyword in http_keywords):
-                    validated_samples.append(sample)
-            
-            return validated_samples if validated_samples else []
-            
-        except json.JSONDecodeError as e:
-            st.error(f"JSON 파싱 오류: {str(e)}")
-            st.write("원본 응답:", response.content[0].text)
-            return []
+            with tracer.span(f"stage.{stage}"):
+                return self.stages[stage](**inputs)
+        finally:
+            self.timings[stage] = time.perf_counter() - start
 
-class DocumentationAgent:
+class NLPMiddlewareGenerator:
     def __init__(self):
-        self.client = anthropic
-        
-    def generate_documentation(self, code: str) -> str:
-        prompt = f"""
-        다음 Python 코드에 대한 문서를 생성해주세요:
-        코드: {code}
-        응답은 적절한 주석과 설명을 포함해야 합니다.
+        self.parsing_agent = ParsingAgent()
+        self.sample_request_agent = SampleRequestAgent()
+        self.middleware_agent = MiddlewareAgent()
+        self.documentation_agent = DocumentationAgent()
+        self.validation_agent = ValidationAgent()
+        self.db = MiddlewareDatabase()
+        self.search_manager = SearchManager(self.db)
+        self.generation_cache = get_generation_cache()
+
+    def pipeline_stages(self, on_progress: Optional[Callable[[str, str], None]] = None) -> Dict[str, Callable]:
+        """PIPELINE_GRAPH의 각 단계를 실행하는 함수들을 반환합니다.
+
+        on_progress가 주어지면 스트리밍 단계의 (단계 이름, 지금까지 생성된 텍스트)를 주기적으로 전달합니다.
         """
-        
-        try:
-            response = self.client.messages.create(
-                model="claude-3-5-haiku-20241022",
-                max_tokens=1500,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.5,
-            )
-            
-            # content가 리스트인 경우 첫 번째 요소의 text 속성 사용
-            if isinstance(response.content, list):
-                if len(response.content) > 0:
-                    return response.content[0].text
-                else:
-                    return "문서 생성에 실패했습니다."
-            # content가 단일 객체인 경우 직접 text 속성 사용
-            else:
-                return response.content.text
-                
-        except Exception as e:
-            return f"문서 생성 중 오류 발생: {str(e)}"
+        def collect(stage: str, chunks: Iterator[str]) -> str:
+            text = ""
+            last_update = 0.0
+            for chunk in chunks:
+                text += chunk
+                now = time.perf_counter()
+                if on_progress and now - last_update >= STREAM_UPDATE_INTERVAL:
+                    on_progress(stage, text)
+                    last_update = now
+            return text
 
-class ValidationAgent:
-    def __init__(self):
-        self.client = anthropic
-        
-    def validate_middleware(self, code: str, requirements: Dict) -> str:
-        prompt = f"""
-        다음 Python 코드가 주어진 요구사항을 충족하는지 검증해주세요:
+        return {
+            'requirements': lambda input_text: self.parsing_agent.parse_natural_language(input_text),
+            'code': lambda requirements: collect(
+                'code', self.middleware_agent.generate_middleware_stream(requirements)),
+            'documentation': lambda code: collect(
+                'documentation', self.documentation_agent.generate_documentation_stream(code)),
+            'validation_report': lambda code, requirements: self.validation_agent.validate_middleware_report(
+                code, requirements),
+            'validation': lambda validation_report: render_validation_report(validation_report),
+            'improved_code': lambda code, validation_report: self.middleware_agent.generate_improved_code(
+                code, validation_report),
+            'improved_documentation': lambda improved_code: collect(
+                'improved_documentation', self.documentation_agent.generate_documentation_stream(improved_code)),
+        }
 
-        코드: {code}
+    def create_pipeline(self, thread_initializer: Optional[Callable] = None,
+                        on_progress: Optional[Callable[[str, str], None]] = None,
+                        reuse_generated: bool = True) -> PipelineExecutor:
+        """reuse_generated가 False이면 생성 결과 캐시를 읽지 않고 모든 단계를 새로 생성합니다. (결과는 저장)"""
+        return PipelineExecutor(PIPELINE_GRAPH, self.pipeline_stages(on_progress),
+                                thread_initializer=thread_initializer,
+                                on_stage_complete=lambda stage, results: self._use_generation_cache(
+                                    stage, results, reuse_generated))
 
-        요구사항: {json.dumps(requirements, ensure_ascii=False, indent=2)}
+    def _use_generation_cache(self, stage: str, results: Dict, lookup: bool = True) -> Dict:
+        """요구사항이 나오면 같은 캐시 키로 저장된 코드/문서/검증 결과를 채우고, 새로 생성한 결과는 저장합니다."""
+        requirements = results.get('requirements')
+        if not isinstance(requirements, dict) or not requirements:
+            # 분석에 실패한 빈 요구사항끼리 결과를 공유하지 않도록 캐시하지 않음
+            return {}
+        if stage == 'requirements':
+            return self.generation_cache.get(generation_cache_key(requirements)) if lookup else {}
+        report = results.get('validation_report')
+        if stage in ('validation_report', 'validation') and isinstance(report, dict) and report.get('failed'):
+            # 검증에 실패한 결과는 다음 실행에서 다시 검증하도록 저장하지 않음
+            return {}
+        if stage in GENERATION_CACHE_STAGES:
+            self.generation_cache.put(generation_cache_key(requirements), requirements, stage, results[stage])
+        return {}
+
+    @traced
+    def find_duplicate(self, user_input: str, targets: List[str] = None,
+                       threshold: float = DUPLICATE_SIMILARITY_THRESHOLD) -> Optional[Dict]:
+        """입력과 거의 같은 이전 요청이 있으면 저장된 결과를 파이프라인 결과 형태로 반환합니다.
 
-        검증 결과와 개선 사항을 알려주세요.
+        핵심 파라미터(request_signature)가 같고, 임베딩 유사도가 threshold 이상이거나 두 요청을 규칙으로
+        분석한 결과가 같은 기록만 재사용합니다. targets의 결과가 모두 저장되어 있어야 하며,
+        'duplicate_of'(히스토리 id), 'similarity', 'llm_calls_saved'(건너뛴 LLM 단계 수, 단계마다 LLM을 한 번 호출)를
+        함께 담습니다.
         """
+        targets = targets or INITIAL_PIPELINE_TARGETS
+        signature = request_signature(user_input)
+        rule_result = self.parsing_agent.rule_parser.match(user_input)
+        for case in self.search_manager.semantic_search(user_input, top_k=DUPLICATE_CANDIDATES):
+            if request_signature(case['input_text']) != signature:
+                continue
+            # 표현이 달라 유사도가 낮아도 규칙 분석 결과가 같으면 같은 요청
+            if case['similarity'] < threshold and (
+                    rule_result is None or self.parsing_agent.rule_parser.match(case['input_text']) != rule_result):
+                continue
+            result = {stage: case[column] for stage, column in HISTORY_RESULT_COLUMNS.items() if case[column]}
+            if not all(stage in result for stage in targets):
+                continue
+            try:
+                result['requirements'] = json.loads(result['requirements'])
+                if 'validation_report' in result:
+                    result['validation_report'] = check_validation_report(json.loads(result['validation_report']))
+            except (KeyError, ValueError):
+                continue
+            result.update(input_text=user_input, duplicate_of=case['id'], duplicate_input=case['input_text'],
+                          similarity=case['similarity'],
+                          llm_calls_saved=sum(1 for stage in targets if stage not in LOCAL_PIPELINE_STAGES))
+            return result
+        return None
+
+    @traced
+    def run_pipeline(self, user_input: str, targets: List[str] = None, reuse_generated: bool = True) -> Dict:
+        """UI 없이 생성 파이프라인을 실행합니다. 단계별 소요 시간은 'timings'에 담깁니다.
+
+        targets를 주지 않으면 초기 생성 단계(INITIAL_PIPELINE_TARGETS)까지만 실행합니다.
+        """
+        pipeline = self.create_pipeline(reuse_generated=reuse_generated)
+        result = pipeline.run({'input_text': user_input}, targets or INITIAL_PIPELINE_TARGETS)
+        result['timings'] = dict(pipeline.timings, total=pipeline.total_time)
+        result['cached_stages'] = pipeline.seeded_stages
+        return result
+
+
+    @traced
+    def generate_with_rag(self, user_input: str) -> Dict:
+        # 유사한 이전 사례 검색
+        similar_cases = self.search_manager.semantic_search(user_input)
         
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=1000,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-        )
+        # 컨텍스트 구성
+        context = self._prepare_context(similar_cases)
         
-        return response.content[0].text
+        # RAG 기반 생성
+        return self._generate_with_context(user_input, context)
 
-class MiddlewareAgent:
-    def __init__(self):
-        self.client = anthropic
+    def _prepare_context(self, similar_cases: List[Dict]) -> List[Dict]:
+        """검색된 사례에서 생성에 참고할 항목만 추립니다."""
+        return [
+            {
+                'input_text': case['input_text'],
+                'requirements': case['requirements'],
+                'initial_code': case['improved_code'] or case['initial_code'],
+                'similarity': case['similarity'],
+            }
+            for case in similar_cases
+        ]
+
+    def _generate_with_context(self, user_input: str, context: List[Dict]) -> Dict:
+        retrieval_manager = RetrievalManager(self.db)
+        requirements = retrieval_manager.generate_enhanced_requirements(user_input, context)
+        code = retrieval_manager.generate_enhanced_code(requirements, context)
+        return {
+            'input_text': user_input,
+            'similar_cases': context,
+            'requirements': requirements,
+            'code': code,
+        }
+
+# 로컬 해싱 임베딩 설정
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", 512))
+# 한 기록이 여러 조각으로 나뉘므로 중복 제거 후에도 top_k를 채울 수 있게 후보를 더 뽑음
+SEARCH_OVERSAMPLE = 4
+
+# 청크 하나의 최대 토큰 수와 이웃 청크와 겹치는 토큰 수
+EMBEDDING_CHUNK_TOKENS = int(os.getenv("EMBEDDING_CHUNK_TOKENS", 256))
+EMBEDDING_CHUNK_OVERLAP = int(os.getenv("EMBEDDING_CHUNK_OVERLAP", 32))
+# 한 번에 벡터화하는 청크 수
+EMBEDDING_BATCH_SIZE = 64
+
+# 로컬 토큰 추정: 단어 하나 또는 구두점/기호 하나를 토큰 하나로 셈
+LOCAL_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+# 마침표/물음표/느낌표(한국어 종결어미 '다.' 포함) 또는 줄바꿈 뒤에서 문장을 나눔
+# (IP 주소, URL, 소수처럼 바로 뒤에 글자가 오는 마침표에서는 나누지 않음)
+SENTENCE_PATTERN = re.compile(r"(?:[^.!?。\n]|[.!?](?=[^\s.!?]))+(?:[.!?。]+|\n+|$)")
+
+def count_tokens(text: str) -> int:
+    return sum(1 for _ in LOCAL_TOKEN_PATTERN.finditer(text))
+
+def looks_like_code(text: str) -> bool:
+    """파이썬으로 파싱되고 단순 표현식이 아닌 문장(def, class, import, 대입 등)이 있으면 코드로 봅니다."""
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return False
+    return any(not isinstance(node, ast.Expr) for node in tree.body)
+
+def iter_sentences(text: str) -> Iterator[str]:
+    for match in SENTENCE_PATTERN.finditer(text):
+        sentence = match.group().strip()
+        if sentence:
+            yield sentence
+
+def iter_code_blocks(text: str, max_tokens: int) -> Iterator[str]:
+    """최상위 문장(함수, 클래스, import 묶음 등) 단위로 코드를 나눕니다.
+
+    너무 긴 클래스는 메서드 단위로 한 번 더 나누고, 그래도 긴 블록은 줄 단위로 나뉘도록 그대로 넘깁니다.
+    """
+    lines = text.splitlines()
+
+    def first_line(node: ast.stmt) -> int:
+        return min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+
+    def segments(nodes: List[ast.stmt], start: int, end: int) -> Iterator[str]:
+        # 문장 사이의 주석/빈 줄도 빠지지 않도록 다음 문장 직전까지를 한 블록으로 봄
+        for index, node in enumerate(nodes):
+            first = start if index == 0 else first_line(node)
+            last = first_line(nodes[index + 1]) - 1 if index + 1 < len(nodes) else end
+            block = "\n".join(lines[first - 1:last])
+            if isinstance(node, ast.ClassDef) and count_tokens(block) > max_tokens:
+                body_start = first_line(node.body[0])
+                yield "\n".join(lines[first - 1:body_start - 1])
+                yield from segments(node.body, body_start, last)
+            elif block.strip():
+                yield block
+
+    tree = ast.parse(text)
+    if tree.body:
+        yield from segments(tree.body, 1, len(lines))
+
+def split_tokens(text: str, max_tokens: int, overlap: int) -> Iterator[str]:
+    """문장이나 블록 하나가 max_tokens보다 길면 토큰 창을 겹쳐 가며 잘라냅니다."""
+    spans = [match.span() for match in LOCAL_TOKEN_PATTERN.finditer(text)]
+    step = max(1, max_tokens - overlap)
+    for start in range(0, len(spans), step):
+        window = spans[start:start + max_tokens]
+        yield text[window[0][0]:window[-1][1]]
+        if start + max_tokens >= len(spans):
+            break
+
+def pack_segments(segments: Iterable[str], max_tokens: int, overlap: int, separator: str) -> Iterator[str]:
+    """문장/코드 블록을 max_tokens 이하의 청크로 묶고, 앞 청크 끝의 overlap 토큰 분량 조각을 다음 청크 앞에 다시 넣습니다."""
+    current: List[Tuple[str, int]] = []
+    current_tokens = 0
+    for segment in segments:
+        tokens = count_tokens(segment)
+        if tokens > max_tokens:
+            pieces = [(piece, count_tokens(piece)) for piece in split_tokens(segment, max_tokens, overlap)]
+        else:
+            pieces = [(segment, tokens)]
+        for piece, piece_tokens in pieces:
+            if current and current_tokens + piece_tokens > max_tokens:
+                yield separator.join(text for text, _ in current)
+                # 겹침: 앞 청크의 마지막 조각들을 overlap 토큰 이내에서 이어받음
+                carried, carried_tokens = [], 0
+                for text, count in reversed(current):
+                    if carried_tokens + count > overlap or carried_tokens + count + piece_tokens > max_tokens:
+                        break
+                    carried.insert(0, (text, count))
+                    carried_tokens += count
+                current, current_tokens = carried, carried_tokens
+            current.append((piece, piece_tokens))
+            current_tokens += piece_tokens
+    if current:
+        yield separator.join(text for text, _ in current)
+
+class EmbeddingManager:
+    """외부 API 없이 단어와 글자 n-gram을 해싱해 고정 길이 벡터를 만드는 로컬 임베딩입니다.
+
+    한국어는 조사가 붙어 단어 형태가 자주 바뀌므로 글자 2~3-gram을 함께 사용합니다.
+    텍스트는 토큰 수 기준으로, 코드는 파이썬 AST 경계, 문서는 문장 경계에서 겹치게 나눈 뒤
+    여러 청크를 묶어서 한 번에 벡터화합니다.
+    """
+    TOKEN_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, dim: int = EMBEDDING_DIM, chunk_tokens: int = EMBEDDING_CHUNK_TOKENS,
+                 overlap: int = EMBEDDING_CHUNK_OVERLAP, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.dim = dim
+        self.chunk_tokens = chunk_tokens
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self._hash_feature = lru_cache(maxsize=1 << 16)(self._hash_feature_uncached)
+    
+    def create_embeddings(self, text: str) -> List[Dict]:
+        return self.create_embeddings_many([text])[0]
+
+    def create_query_embedding(self, text: str) -> Optional[np.ndarray]:
+        """청크 벡터의 평균을 다시 정규화해 여러 청크로 나뉘는 긴 질의 전체를 벡터 하나로 나타냅니다."""
+        chunks = self.create_embeddings(text)
+        if not chunks:
+            return None
+        vector = np.mean([chunk['embedding'] for chunk in chunks], axis=0)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else None
+
+    @traced
+    def create_embeddings_many(self, texts: List[str]) -> List[List[Dict]]:
+        """여러 텍스트의 청크를 batch_size개씩 모아 벡터화하고, 텍스트별 [{text, embedding}] 목록을 반환합니다."""
+        results: List[List[Dict]] = [[] for _ in texts]
+        batch: List[Tuple[int, str]] = []
+
+        def flush():
+            vectors = self._get_embeddings([chunk for _, chunk in batch])
+            for (index, chunk), vector in zip(batch, vectors):
+                results[index].append({'text': chunk, 'embedding': vector})
+            batch.clear()
+
+        for index, text in enumerate(texts):
+            for chunk in self.iter_chunks(text):
+                batch.append((index, chunk))
+                if len(batch) >= self.batch_size:
+                    flush()
+        if batch:
+            flush()
+        return results
+
+    def iter_chunks(self, text: str) -> Iterator[str]:
+        """코드는 AST 블록, 그 외에는 문장을 단위로 겹치는 청크를 하나씩 만들어 냅니다."""
+        if not text or not text.strip():
+            return
+        if looks_like_code(text):
+            yield from pack_segments(iter_code_blocks(text, self.chunk_tokens), self.chunk_tokens, self.overlap, "\n")
+        else:
+            yield from pack_segments(iter_sentences(text), self.chunk_tokens, self.overlap, " ")
+
+    def _features(self, text: str) -> Iterator[str]:
+        for word in self.TOKEN_PATTERN.findall(text.lower()):
+            yield f"w:{word}"
+            padded = f"<{word}>"
+            for n in (2, 3):
+                for i in range(len(padded) - n + 1):
+                    yield f"c:{padded[i:i + n]}"
+
+    def _hash_feature_uncached(self, feature: str) -> Tuple[int, float]:
+        h = zlib.crc32(feature.encode('utf-8'))
+        return h % self.dim, 1.0 if h & 0x80000000 else -1.0
+
+    def _get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """signed feature hashing으로 텍스트마다 L2 정규화된 float32 벡터를 계산해 (len(texts), dim) 행렬로 반환합니다."""
+        rows, columns, signs = [], [], []
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                column, sign = self._hash_feature(feature)
+                rows.append(row)
+                columns.append(column)
+                signs.append(sign)
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        np.add.at(matrix, (rows, columns), np.array(signs, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return np.divide(matrix, norms, out=matrix, where=norms > 0)
+
+    def _get_embedding(self, text: str) -> np.ndarray:
+        return self._get_embeddings([text])[0]
+
+# 근사 최근접 이웃(ANN) 인덱스 설정
+# VECTOR_INDEX_TYPE: 'ivf'(군집 기반 근사 검색) 또는 'exact'(전체 스캔)
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "ivf")
+# 이 개수보다 벡터가 적으면 전체 스캔이 더 빠르므로 IVF를 학습하지 않습니다.
+IVF_MIN_TRAIN_SIZE = int(os.getenv("IVF_MIN_TRAIN_SIZE", 4096))
+# 군집 수 (0이면 벡터 수의 제곱근), 검색 시 탐색할 군집 수
+IVF_NLIST = int(os.getenv("IVF_NLIST", 0))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", 8))
+# 학습 이후 벡터 수가 이 배수만큼 늘면 군집이 치우치므로 다시 학습
+IVF_RETRAIN_GROWTH = 4
+
+# 임베딩 저장/검색 형식: 'float32', 'int8'(스칼라 양자화), 'binary'(부호 비트 + DB 재채점)
+EMBEDDING_QUANTIZATION = os.getenv("EMBEDDING_QUANTIZATION", "float32")
+# 해밍 거리 1차 필터가 남기는 후보 수 = top_k * SEARCH_OVERSAMPLE * 이 값
+QUANTIZATION_RESCORE_FACTOR = int(os.getenv("QUANTIZATION_RESCORE_FACTOR", 10))
+
+# 전체 스캔, IVF 배정, 재채점에서 memmap으로부터 한 번에 읽는 행 수 (전체 float32 행렬을 만들지 않음)
+VECTOR_SCAN_CHUNK_ROWS = int(os.getenv("VECTOR_SCAN_CHUNK_ROWS", 8192))
+
+# 바이트별 1비트 개수 (np.bitwise_count가 없는 NumPy 1.x용)
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """벡터별 최대 절댓값을 127에 맞추는 대칭 int8 양자화입니다. (코드, 스케일)을 반환합니다."""
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+def pack_bits(vectors: np.ndarray) -> np.ndarray:
+    """각 차원의 부호를 1비트로 묶어 행마다 uint64 배열로 반환합니다."""
+    packed = np.packbits(vectors > 0, axis=1)
+    padding = (-packed.shape[1]) % 8
+    if padding:
+        packed = np.pad(packed, ((0, 0), (0, padding)))
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+def hamming_distances(codes: np.ndarray, query_code: np.ndarray) -> np.ndarray:
+    """XOR 후 popcount로 각 행과 질의 비트 사이의 해밍 거리를 계산합니다."""
+    xor = np.bitwise_xor(codes, query_code)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor).sum(axis=1, dtype=np.int32)
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].sum(axis=1, dtype=np.int32)
+
+def encode_embedding(vector: np.ndarray, quantization: str = EMBEDDING_QUANTIZATION) -> Tuple[bytes, Optional[float]]:
+    """DB에 저장할 (BLOB, 스케일)을 만듭니다. float32는 스케일이 None이고 그 외에는 int8로 저장합니다."""
+    if quantization == 'float32':
+        return vector.astype(np.float32).tobytes(), None
+    codes, scales = quantize_int8(vector[None, :].astype(np.float32))
+    return codes.tobytes(), float(scales[0])
+
+def decode_embeddings(blobs: List[bytes], scales: List[Optional[float]], dim: int) -> np.ndarray:
+    """float32 BLOB과 int8 BLOB(스케일 있음)이 섞여 있어도 float32 행렬로 복원합니다."""
+    vectors = np.zeros((len(blobs), dim), dtype=np.float32)
+    is_int8 = np.array([scale is not None for scale in scales], dtype=bool)
+    if (~is_int8).any():
+        raw = b"".join(blob for blob, scale in zip(blobs, scales) if scale is None)
+        vectors[~is_int8] = np.frombuffer(raw, dtype=np.float32).reshape(-1, dim)
+    if is_int8.any():
+        raw = b"".join(blob for blob, scale in zip(blobs, scales) if scale is not None)
+        codes = np.frombuffer(raw, dtype=np.int8).reshape(-1, dim).astype(np.float32)
+        vectors[is_int8] = codes * np.array([scale for scale in scales if scale is not None],
+                                            dtype=np.float32)[:, None]
+    return vectors
+
+def scan_in_chunks(rows: np.ndarray, score: Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+    """rows를 VECTOR_SCAN_CHUNK_ROWS개씩 나눠 score를 적용하고 결과를 이어 붙입니다."""
+    if not len(rows):
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate([score(rows[i:i + VECTOR_SCAN_CHUNK_ROWS])
+                           for i in range(0, len(rows), VECTOR_SCAN_CHUNK_ROWS)])
+
+class DequantizedRows:
+    """int8 코드 행렬과 행별 스케일을 float32 행렬처럼 인덱싱합니다. 인덱싱한 행만 float32로 복원합니다."""
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        self.codes = codes
+        self.scales = scales
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.codes.shape
+
+    def __getitem__(self, rows) -> np.ndarray:
+        return self.codes[rows].astype(np.float32) * self.scales[rows][..., None]
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """점수가 높은 k개의 위치를 내림차순으로 반환합니다."""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+class IVFIndex:
+    """k-means로 벡터를 군집(inverted list)으로 나누고, 질의와 가까운 nprobe개 군집만 탐색합니다.
+
+    nprobe를 늘리면 재현율이 오르고 지연 시간이 늘어납니다.
+    """
+    def __init__(self, n_lists: int = IVF_NLIST, train_iterations: int = 10, sample_per_list: int = 64):
+        self.n_lists = n_lists
+        self.train_iterations = train_iterations
+        self.sample_per_list = sample_per_list
+        self.reset()
+
+    def reset(self):
+        self.centroids = None
+        self.list_ids = np.zeros(0, dtype=np.int32)
+        self.lists = []
+        self.trained_size = 0
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def train(self, matrix: np.ndarray):
+        """표본에 구면 k-means를 적용해 중심을 구하고 모든 벡터를 군집에 배정합니다.
+
+        matrix는 memmap이나 DequantizedRows여도 되며, 표본과 배정할 구간의 행만 읽습니다.
+        """
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(matrix))))
+        rng = np.random.default_rng(0)
+        sample_size = min(len(matrix), n_lists * self.sample_per_list)
+        sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+        centroids = sample[rng.choice(len(sample), min(n_lists, len(sample)), replace=False)].copy()
+
+        for _ in range(self.train_iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # 비어 있는 군집은 이전 중심을 유지
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        self.centroids = centroids.astype(np.float32)
+        self.trained_size = len(matrix)
+        self.list_ids = self._assign(matrix)
+        self._build_lists()
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.concatenate([
+            np.argmax(vectors[i:i + VECTOR_SCAN_CHUNK_ROWS] @ self.centroids.T, axis=1).astype(np.int32)
+            for i in range(0, len(vectors), VECTOR_SCAN_CHUNK_ROWS)
+        ]) if len(vectors) else np.zeros(0, dtype=np.int32)
+
+    def _build_lists(self):
+        order = np.argsort(self.list_ids, kind='stable')
+        bounds = np.searchsorted(self.list_ids[order], np.arange(len(self.centroids) + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(len(self.centroids))]
+
+    def add(self, start_row: int, vectors: np.ndarray):
+        """start_row부터 이어지는 새 벡터들을 가장 가까운 군집에 추가합니다."""
+        new_ids = self._assign(vectors)
+        self.list_ids = np.concatenate([self.list_ids, new_ids])
+        rows = np.arange(start_row, start_row + len(vectors))
+        for list_id in np.unique(new_ids):
+            self.lists[list_id] = np.concatenate([self.lists[list_id], rows[new_ids == list_id]])
+
+    def candidates(self, query_vector: np.ndarray, nprobe: int) -> np.ndarray:
+        """질의와 가까운 nprobe개 군집에 속한 행 번호를 반환합니다."""
+        probe = top_k_indices(self.centroids @ query_vector, nprobe)
+        return np.concatenate([self.lists[i] for i in probe])
+
+    def save(self, path: str, row_count: int, last_row_id: int, epoch: int):
+        np.savez(path, centroids=self.centroids, list_ids=self.list_ids, trained_size=self.trained_size,
+                 row_count=row_count, last_row_id=last_row_id, epoch=epoch)
+
+    def load(self, path: str, matrix: np.ndarray, last_row_id: int, epoch: int) -> bool:
+        """저장된 중심과 배정을 불러옵니다. 저장 이후 추가된 행은 새로 배정합니다.
+
+        epoch는 벡터 파일이 압축될 때마다 바뀌므로, 다른 epoch에 저장된 배정(이전 행 위치)은 쓰지 않습니다.
+        """
+        try:
+            with np.load(path) as data:
+                centroids = data['centroids']
+                list_ids = data['list_ids']
+                trained_size = int(data['trained_size'])
+                row_count = int(data['row_count'])
+                saved_last_row_id = int(data['last_row_id'])
+                saved_epoch = int(data['epoch'])
+        except Exception:
+            # 없거나 손상된 파일은 무시하고 다시 학습
+            return False
+        if (saved_epoch != epoch or row_count > len(matrix) or saved_last_row_id > last_row_id
+                or centroids.shape[1:] != matrix.shape[1:]):
+            return False
+        self.centroids = centroids
+        self.trained_size = trained_size
+        self.list_ids = list_ids[:row_count]
+        self._build_lists()
+        for start in range(row_count, len(matrix), VECTOR_SCAN_CHUNK_ROWS):
+            self.add(start, matrix[start:start + VECTOR_SCAN_CHUNK_ROWS])
+        return True
+
+# 선택 가능한 ANN 인덱스 종류 ('exact'는 ANN 없이 전체 스캔)
+ANN_INDEX_TYPES = {
+    'ivf': IVFIndex,
+}
+
+class EmbeddingStore:
+    """VectorIndex의 배열을 DB 파일 옆의 추가 전용 바이너리 파일로 보관하고 np.memmap으로 엽니다.
+
+    열마다 raw 파일 하나(<store>/<열 이름>.bin)를 두고, row_id 열을 항상 마지막에 기록해
+    행 수의 기준으로 삼습니다. 새 프로세스는 SQLite BLOB을 디코딩하지 않고 파일을 매핑해 바로 검색합니다.
+    여러 프로세스가 같은 파일을 쓰므로 추가와 압축은 locked() 안에서 하고, 압축하거나 비울 때마다
+    <store>/epoch의 세대 번호를 올려 다른 프로세스가 행 위치가 바뀐 것을 알 수 있게 합니다.
+    """
+    def __init__(self, path: str, columns: Dict[str, Tuple[Any, int]]):
+        # columns: 열 이름 -> (dtype, 행당 원소 수). 원소 수가 0이면 1차원 열
+        self.path = path
+        self.columns = dict(columns, row_id=(np.int64, 0))
+        self.arrays: Dict[str, np.ndarray] = {}
+        self.size = 0
+        self.epoch = 0
+        os.makedirs(path, exist_ok=True)
+        with self.locked():
+            self.open()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, f"{name}.bin")
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """다른 프로세스의 추가/압축과 겹치지 않도록 저장소 파일 잠금을 잡습니다."""
+        with open(os.path.join(self.path, '.lock'), 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_epoch(self) -> int:
+        try:
+            with open(os.path.join(self.path, 'epoch'), encoding='utf-8') as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _bump_epoch(self):
+        path = os.path.join(self.path, 'epoch')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(str(self._read_epoch() + 1))
+        os.replace(path + '.tmp', path)
+
+    def _row_bytes(self, name: str) -> int:
+        dtype, width = self.columns[name]
+        return np.dtype(dtype).itemsize * max(width, 1)
+
+    def _write_order(self) -> List[str]:
+        return sorted(self.columns, key=lambda name: name == 'row_id')
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def open(self):
+        """파일을 매핑합니다. 추가가 중간에 끊겨 열 길이가 row_id보다 길면 잘라내고, 짧으면 비웁니다."""
+        self.epoch = self._read_epoch()
+        sizes = {
+            name: (os.path.getsize(self._file(name)) if os.path.exists(self._file(name)) else 0) // self._row_bytes(name)
+            for name in self.columns
+        }
+        size = sizes['row_id']
+        if any(column_size < size for column_size in sizes.values()):
+            self.clear()
+            return
+        for name, column_size in sizes.items():
+            if column_size > size:
+                os.truncate(self._file(name), size * self._row_bytes(name))
+        self._map(size)
+
+    def changed(self) -> bool:
+        """다른 프로세스가 행을 추가하거나 압축했는지 확인합니다."""
+        path = self._file('row_id')
+        file_size = os.path.getsize(path) if os.path.exists(path) else 0
+        return file_size != self.size * self._row_bytes('row_id') or self._read_epoch() != self.epoch
+
+    def _map(self, size: int):
+        self.arrays = {}
+        for name, (dtype, width) in self.columns.items():
+            shape = (size, width) if width else (size,)
+            if size:
+                self.arrays[name] = np.memmap(self._file(name), dtype=dtype, mode='r', shape=shape)
+            else:
+                self.arrays[name] = np.zeros(shape, dtype=dtype)
+        self.size = size
+
+    def append(self, values: Dict[str, np.ndarray]):
+        for name in self._write_order():
+            with open(self._file(name), 'ab') as f:
+                f.write(np.ascontiguousarray(values[name], dtype=self.columns[name][0]).tobytes())
+        self._map(self.size + len(values['row_id']))
+
+    def compact(self, keep: np.ndarray):
+        """keep(불리언 마스크)에 해당하는 행만 남기고 파일을 새로 씁니다."""
+        for name in self._write_order():
+            np.ascontiguousarray(self.arrays[name][keep]).tofile(self._file(name) + '.tmp')
+        size = int(keep.sum())
+        self.arrays = {}
+        for name in self._write_order():
+            os.replace(self._file(name) + '.tmp', self._file(name))
+        self._bump_epoch()
+        self.epoch = self._read_epoch()
+        self._map(size)
+
+    def clear(self):
+        self.arrays = {}
+        for name in self.columns:
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+        self._bump_epoch()
+        self.epoch = self._read_epoch()
+        self._map(0)
+
+def field_code(field: str) -> int:
+    """벡터 저장소의 field 열 값입니다. HISTORY_EMBEDDING_FIELDS에 없는 열은 -1입니다."""
+    return HISTORY_EMBEDDING_FIELDS.index(field) if field in HISTORY_EMBEDDING_FIELDS else -1
+
+class VectorIndex:
+    """embeddings 테이블을 NumPy 배열로 올려 코사인 유사도 top-k를 계산합니다.
+
+    배열은 DB 파일 옆의 추가 전용 파일(<db>.vectors.<quantization>/)에 저장하고 np.memmap으로 열어,
+    새 프로세스도 BLOB 디코딩 없이 바로 검색합니다. 검색할 때마다 새로 추가된 임베딩 행만 파일에 덧붙이고,
+    삭제가 감지되면 남은 행만으로 파일을 압축합니다.
+    벡터가 충분히 많으면 ANN 인덱스로 후보를 줄인 뒤 후보만 재채점해 순위를 매기며,
+    ANN 인덱스는 DB 파일 옆(<db>.ivf.npz)에 저장해 다음 프로세스가 재학습 없이 사용합니다.
 
-    def generate_middleware(self, requirements: Dict) -> str:
-        prompt = f"""
-        다음 요구사항에 맞는 HTTP 미들웨어 코드를 생성해주세요:
-        {json.dumps(requirements, ensure_ascii=False, indent=2)}
+    quantization에 따라 보관하는 형태가 달라집니다.
+    - float32: float32 행렬
+    - int8: 벡터별 스케일을 둔 int8 행렬(1/4) + 부호 비트
+    - binary: 부호 비트(1/32)만 보관하고, 후보의 점수는 DB의 벡터로 다시 계산
+    int8/binary는 해밍 거리로 후보를 먼저 추린 뒤 짧은 후보 목록만 재채점합니다. 이 모드에서는 DB에도
+    int8로 저장하므로 재채점 점수는 int8로 복원한 벡터의 근사 코사인 유사도입니다.
+    학습과 스캔은 memmap에서 VECTOR_SCAN_CHUNK_ROWS행씩 읽어 전체 float32 행렬을 만들지 않습니다.
+    """
+    def __init__(self, db_name: str, dim: int = EMBEDDING_DIM, index_type: str = VECTOR_INDEX_TYPE,
+                 nprobe: int = IVF_NPROBE, quantization: str = EMBEDDING_QUANTIZATION):
+        self.connections = get_connection_manager(db_name)
+        self.dim = dim
+        self.nprobe = nprobe
+        self.quantization = quantization
+        # binary 모드는 해밍 거리 스캔이 1차 후보 선정을 대신하므로 ANN 인덱스를 쓰지 않음
+        use_ann = index_type in ANN_INDEX_TYPES and quantization != 'binary'
+        self.ann = ANN_INDEX_TYPES[index_type]() if use_ann else None
+        base_path = os.path.splitext(db_name)[0]
+        self.ann_path = f"{base_path}.{index_type}.npz"
+        self._lock = threading.Lock()
+        self._ann_loaded = False
 
-        규칙:
-        1. 코드는 Python으로 작성해주세요.
-        2. 필요한 주석을 포함해주세요.
-        3. 코드외에 다른 설명은 포함하지 마세요.
-        4. 함수는 "HTTP Request" 형태를 입력받습니다.
-        """
-        
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=2000,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,
-        )
-        return response.content[0].text
+        bit_words = pack_bits(np.zeros((1, dim))).shape[1]
+        # field: HISTORY_EMBEDDING_FIELDS 안의 위치 (그 외 열은 -1)
+        columns = {'history_id': (np.int64, 0), 'field': (np.int8, 0)}
+        if quantization == 'float32':
+            columns['matrix'] = (np.float32, dim)
+        if quantization == 'int8':
+            columns.update(matrix=(np.int8, dim), scale=(np.float32, 0))
+        if quantization in ('int8', 'binary'):
+            columns['bits'] = (np.uint64, bit_words)
+        self.store = EmbeddingStore(f"{base_path}.vectors.{quantization}", columns)
+        with self.store.locked():
+            self._validate_store()
 
-    def generate_improved_code(self, original_code: str, validation_feedback: str) -> str:
-        """검증 결과를 바탕으로 개선된 코드를 생성합니다."""
-        improvement_analysis = self._analyze_feedback(validation_feedback)
-        
-        prompt = f"""
-        주어진 코드를 다음 검증 결과와 분석을 바탕으로 개선해주세요:
+    @property
+    def history_ids(self) -> np.ndarray:
+        return self.store['history_id']
 
-        원본 코드:
-        {original_code}
+    @property
+    def row_ids(self) -> np.ndarray:
+        return self.store['row_id']
 
-        검증 결과:
-        {validation_feedback}
-
-        개선 필요 영역:
-        {json.dumps(improvement_analysis, ensure_ascii=False, indent=2)}
-
-        개선 규칙:
-        1. 검증 결과에서 지적된 모든 문제를 해결해야 합니다.
-        2. 에러 처리와 예외 상황 대응을 강화해야 합니다.
-        3. 코드 성능과 보안을 개선해야 합니다.
-        4. 기존 기능은 모두 유지하면서 개선해야 합니다.
-        5. 모든 변경사항에 대해 주석으로 설명을 추가해야 합니다.
-        6. HTTP 미들웨어의 표준 패턴을 따라야 합니다.
-
-        응답 형식:
-        1. Python 코드만 제공해주세요.
-        2. 추가 설명이나 마크다운은 포함하지 마세요.
-        """
+    @property
+    def fields(self) -> np.ndarray:
+        return self.store['field']
 
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=2000,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,
-        )
-        return response.content[0].text
+    @property
+    def matrix(self) -> Optional[np.ndarray]:
+        return self.store.arrays.get('matrix')
 
-    def _analyze_feedback(self, validation_feedback: str) -> Dict[str, List[str]]:
-        """검증 피드백을 분석하여 개선이 필요한 영역을 식별합니다."""
-        prompt = f"""
-        다음 검증 피드백을 분석하여 개선이 필요한 영역을 JSON 형식으로 분류해주세요:
+    @property
+    def scales(self) -> Optional[np.ndarray]:
+        return self.store.arrays.get('scale')
 
-        피드백:
-        {validation_feedback}
+    @property
+    def bits(self) -> Optional[np.ndarray]:
+        return self.store.arrays.get('bits')
 
-        다음 카테고리로 분류해주세요:
-        1. "security_issues": 보안 관련 문제점
-        2. "performance_issues": 성능 관련 문제점
-        3. "error_handling": 에러 처리 관련 문제점
-        4. "code_structure": 코드 구조 관련 문제점
-        5. "functionality_issues": 기능 관련 문제점
+    @property
+    def last_row_id(self) -> int:
+        return int(self.row_ids[-1]) if self.store.size else 0
 
-        각 카테고리는 구체적인 문제점들의 배열이어야 합니다.
-        """
+    def _validate_store(self):
+        """파일의 마지막 행이 DB의 같은 id 행과 일치하는지 확인하고, 다르면(DB 교체 등) 파일을 비웁니다."""
+        if not self.store.size:
+            return
+        row = self.connections.connection().execute(
+            "SELECT history_id, embedding, embedding_scale FROM embeddings WHERE id = ?", (self.last_row_id,)
+        ).fetchone()
+        if row is not None and row['history_id'] == self.history_ids[-1]:
+            vector = decode_embeddings([row['embedding']], [row['embedding_scale']], self.dim)
+            stored = self.bits[-1:] if self.bits is not None else pack_bits(self.matrix[-1:])
+            if np.array_equal(pack_bits(vector), stored):
+                return
+        self.reset()
 
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=1000,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-        )
+    def reset(self):
+        """히스토리가 포맷되면 벡터 파일과 저장된 ANN 인덱스를 모두 지웁니다."""
+        self.store.clear()
+        self._reset_ann()
 
-        try:
-            return json.loads(response.content[0].text)
-        except json.JSONDecodeError:
-            return {
-                "security_issues": [],
-                "performance_issues": [],
-                "error_handling": [],
-                "code_structure": [],
-                "functionality_issues": []
-            }
+    def _reset_ann(self):
+        if self.ann is not None:
+            self.ann.reset()
+            if os.path.exists(self.ann_path):
+                os.remove(self.ann_path)
 
-    def verify_improvements(self, original_code: str, improved_code: str, requirements: Dict) -> bool:
-        """개선된 코드가 원래 요구사항을 충족하면서 실제로 개선되었는지 확인합니다."""
-        prompt = f"""
-        개선된 코드가 원래 요구사항을 충족하면서 실제로 개선되었는지 검증해주세요.
+    def memory_bytes(self) -> int:
+        """검색용으로 매핑한 벡터 데이터의 크기입니다."""
+        arrays = [self.matrix, self.scales, self.bits]
+        return sum(array.nbytes for array in arrays if array is not None)
 
-        원본 코드:
-        {original_code}
+    def refresh(self):
+        with self._lock, self.store.locked():
+            if self.store.changed():
+                # 다른 프로세스가 행을 추가하거나 압축함: 그 프로세스가 저장한 ANN 인덱스를 다시 불러옴
+                self.store.open()
+                self._ann_loaded = False
+            conn = self.connections.connection()
+            count, max_row_id = conn.execute("SELECT COUNT(*), COALESCE(MAX(id), 0) FROM embeddings").fetchone()
+            if max_row_id < self.last_row_id or count < self.store.size:
+                # 포맷 등으로 행이 삭제됨: 남아 있는 행만으로 파일을 압축 (중복 행도 함께 제거)
+                self._compact(conn)
+            start_row = self.store.size
+            vectors = np.zeros((0, self.dim), dtype=np.float32)
+            if max_row_id > self.last_row_id:
+                rows = conn.execute(
+                    "SELECT id, history_id, field, embedding, embedding_scale FROM embeddings WHERE id > ? ORDER BY id",
+                    (self.last_row_id,)
+                ).fetchall()
+                vectors = decode_embeddings([row['embedding'] for row in rows],
+                                            [row['embedding_scale'] for row in rows], self.dim)
+                self._append(rows, vectors)
+            if start_row < self.store.size or not self._ann_loaded:
+                self._update_ann(start_row, vectors)
 
-        개선된 코드:
-        {improved_code}
+    def _compact(self, conn: sqlite3.Connection):
+        existing = np.array([row[0] for row in conn.execute("SELECT id FROM embeddings")], dtype=np.int64)
+        keep = np.isin(self.row_ids, existing)
+        keep[np.setdiff1d(np.arange(self.store.size), np.unique(self.row_ids, return_index=True)[1])] = False
+        self.store.compact(keep)
+        # 행 위치가 바뀌었으므로 ANN 인덱스는 다시 학습
+        self._reset_ann()
 
-        요구사항:
-        {json.dumps(requirements, ensure_ascii=False, indent=2)}
+    def _append(self, rows: List[sqlite3.Row], vectors: np.ndarray):
+        values = {
+            'row_id': [row['id'] for row in rows],
+            'history_id': [row['history_id'] for row in rows],
+            'field': [field_code(row['field']) for row in rows],
+        }
+        if self.quantization == 'float32':
+            values['matrix'] = vectors
+        elif self.quantization == 'int8':
+            values['matrix'], values['scale'] = quantize_int8(vectors)
+        if 'bits' in self.store.columns:
+            values['bits'] = pack_bits(vectors)
+        self.store.append(values)
 
-        True 또는 False로만 응답해주세요.
-        """
+    def _float_rows(self):
+        """저장된 행렬을 float32 행렬처럼 인덱싱할 수 있는 객체입니다. int8은 읽는 행만 복원합니다."""
+        if self.quantization == 'int8':
+            return DequantizedRows(self.matrix, self.scales)
+        return self.matrix
 
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=100,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.1,
-        )
+    def _update_ann(self, start_row: int, new_vectors: np.ndarray):
+        """새 행을 ANN 인덱스에 반영하고, 처음이거나 많이 커졌으면 다시 학습합니다."""
+        if self.ann is None:
+            return
+        size = self.store.size
+        if not self._ann_loaded:
+            self._ann_loaded = True
+            self.ann.reset()
+            if self.ann.load(self.ann_path, self._float_rows(), self.last_row_id, self.store.epoch):
+                start_row = size
 
-        return "true" in response.content[0].text.lower()
-    
-class DocumentationAgent:
-    def __init__(self):
-        self.client = anthropic
-    def generate_documentation(self, code: str, is_improved: bool = False, original_code: str = None) -> str:
-        """코드에 대한 문서를 생성합니다."""
-        prompt = f"""
-        다음 Python 코드에 대한 문서를 생성해주세요:
-        
-        코드: {code}
-        """
-        
-        if is_improved and original_code:
-            prompt += f"""
-            이 코드는 다음 원본 코드의 개선 버전입니다:
-            {original_code}
-            
-            문서에 다음 내용을 포함해주세요:
-            1. 개선된 부분 설명
-            2. 성능/보안 개선사항
-            3. 변경된 로직 설명
-            """
-        
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=1500,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3,
-        )
-        
-        return response.content[0].text
-    
-    def generate_changes_summary(self, original_code: str, improved_code: str, validation_feedback: str) -> str:
-        """코드 변경사항을 요약합니다."""
-        prompt = f"""
-            다음 두 버전의 코드 차이점을 분석하여 요약해주세요:
-            
-            원본 코드:
-            {original_code}
-            
-            개선된 코드:
-            {improved_code}
-            
-            검증 피드백:
-            {validation_feedback}
-            
-            요약 포함 사항:
-            1. 주요 변경사항 목록
-            2. 개선된 기능/성능
-            3. 보안 강화 사항
-            4. 코드 구조 변경
-            5. 새로운 예외 처리
-            
-            응답 형식:
-            1. Markdown 형식
-            2. 명확한 섹션 구분
-            3. 중요 변경사항 강조
-            """
+        if size < IVF_MIN_TRAIN_SIZE:
+            return
+        if not self.ann.is_trained or size > self.ann.trained_size * IVF_RETRAIN_GROWTH:
+            self.ann.train(self._float_rows())
+        elif start_row < size:
+            self.ann.add(start_row, new_vectors[len(new_vectors) - (size - start_row):])
+        else:
+            return
+        self.ann.save(self.ann_path, size, self.last_row_id, self.store.epoch)
 
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=1000,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
-        )
-        
-        return response.content.text
+    def _rescore(self, rows: np.ndarray, query_vector: np.ndarray) -> np.ndarray:
+        """후보 행의 코사인 유사도를 계산합니다. float32는 정확한 값, int8/binary는 int8로 복원한 근사값입니다."""
+        if self.quantization == 'float32':
+            return scan_in_chunks(rows, lambda chunk: self.matrix[chunk] @ query_vector)
+        if self.quantization == 'int8':
+            return scan_in_chunks(
+                rows, lambda chunk: (self.matrix[chunk].astype(np.float32) @ query_vector) * self.scales[chunk])
+        # binary: 메모리에는 부호 비트만 있으므로 후보 벡터를 DB에서 읽어 재채점 (DB에는 int8로 저장됨)
+        row_ids = self.row_ids[rows].tolist()
+        placeholders = ",".join("?" * len(row_ids))
+        stored = {
+            row['id']: row for row in self.connections.connection().execute(
+                f"SELECT id, embedding, embedding_scale FROM embeddings WHERE id IN ({placeholders})", row_ids
+            )
+        }
+        present = [row_id for row_id in row_ids if row_id in stored]
+        vectors = decode_embeddings([stored[row_id]['embedding'] for row_id in present],
+                                    [stored[row_id]['embedding_scale'] for row_id in present], self.dim)
+        scores = np.full(len(row_ids), -np.inf, dtype=np.float32)
+        scores[[i for i, row_id in enumerate(row_ids) if row_id in stored]] = vectors @ query_vector
+        return scores
 
-    def generate_api_documentation(self, code: str, requirements: Dict) -> str:
-        """API 문서를 생성합니다."""
-        prompt = f"""
-            다음 미들웨어 코드에 대한 API 문서를 생성해주세요:
-            
-            코드:
-            {code}
-            
-            요구사항:
-            {json.dumps(requirements, ensure_ascii=False, indent=2)}
-            
-            문서 포함 사항:
-            1. API 엔드포인트 설명
-            2. 요청/응답 형식
-            3. 미들웨어 동작 방식
-            4. 에러 처리 방법
-            5. 설정 옵션
-            6. 사용 예시
-            
-            응답 형식:
-            1. Markdown 형식
-            2. OpenAPI 스펙 호환
-            3. 명확한 예시 포함
-            """
+    @traced
+    def search(self, query_vector: np.ndarray, top_k: int = 3, nprobe: int = None,
+               fields: Optional[Iterable[str]] = None) -> List[Tuple[int, float]]:
+        """(history_id, 코사인 유사도)를 유사도가 높은 순서로 반환합니다. fields를 주면 그 열의 임베딩만 찾습니다."""
+        self.refresh()
+        query_vector = query_vector.astype(np.float32)
+        with self._lock:
+            if not len(self.history_ids):
+                return []
+            if self.ann is not None and self.ann.is_trained:
+                rows = self.ann.candidates(query_vector, nprobe or self.nprobe)
+            else:
+                rows = np.arange(len(self.history_ids))
+            if fields is not None:
+                codes = [field_code(field) for field in fields]
+                rows = rows[scan_in_chunks(rows, lambda chunk: np.isin(self.fields[chunk], codes))]
 
-        response = self.client.messages.create(
-            model=MODEL,
-            max_tokens=1500,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        
-        return response.content.text
+            # 1단계: 해밍 거리로 짧은 후보 목록을 만듦
+            shortlist_size = top_k * SEARCH_OVERSAMPLE * QUANTIZATION_RESCORE_FACTOR
+            if self.bits is not None and len(rows) > shortlist_size:
+                query_code = pack_bits(query_vector[None, :])[0]
+                distances = scan_in_chunks(rows, lambda chunk: hamming_distances(self.bits[chunk], query_code))
+                rows = rows[top_k_indices(-distances.astype(np.float32), shortlist_size)]
 
-class NLPMiddlewareGenerator:
-    def __init__(self):
-        self.parsing_agent = ParsingAgent()
-        self.sample_request_agent = SampleRequestAgent()
-        self.middleware_agent = MiddlewareAgent()
-        self.documentation_agent = DocumentationAgent()
-        self.validation_agent = ValidationAgent()
-        self.db = MiddlewareDatabase()
-        self.search_manager = SearchManager(self.db)
-    
+            # 2단계: 후보만 재채점 (벡터가 정규화되어 있으므로 내적이 곧 코사인 유사도)
+            scores = self._rescore(rows, query_vector)
+            top = top_k_indices(scores, top_k * SEARCH_OVERSAMPLE)
+            candidates = [(int(self.history_ids[rows[i]]), float(scores[i])) for i in top]
 
-    def generate_with_rag(self, user_input: str) -> Dict:
-        # 유사한 이전 사례 검색
-        similar_cases = self.search_manager.semantic_search(user_input)
-        
-        # 컨텍스트 구성
-        context = self._prepare_context(similar_cases)
-        
-        # RAG 기반 생성
-        return self._generate_with_context(user_input, context)
+        results, seen = [], set()
+        for history_id, score in candidates:
+            if history_id in seen:
+                continue
+            seen.add(history_id)
+            results.append((history_id, score))
+            if len(results) >= top_k:
+                break
+        return results
 
-class EmbeddingManager:
-    def __init__(self):
-        self.client = anthropic
-    
-    def create_embeddings(self, text: str, chunk_size: int = 1000) -> List[Dict]:
-        chunks = self._create_chunks(text, chunk_size)
-        embeddings = []
-        
-        for chunk in chunks:
-            embedding = self._get_embedding(chunk)
-            embeddings.append({
-                'text': chunk,
-                'embedding': embedding
-            })
-        
-        return embeddings
-    
-    def _create_chunks(self, text: str, chunk_size: int) -> List[str]:
-        words = text.split()
-        chunks = []
-        current_chunk = []
-        current_size = 0
-        
-        for word in words:
-            current_chunk.append(word)
-            current_size += len(word) + 1
-            if current_size >= chunk_size:
-                chunks.append(' '.join(current_chunk))
-                current_chunk = []
-                current_size = 0
-        
-        if current_chunk:
-            chunks.append(' '.join(current_chunk))
-        
-        return chunks
+@st.cache_resource
+def get_vector_index(db_name: str) -> VectorIndex:
+    """프로세스 안의 모든 세션이 같은 메모리 벡터 인덱스를 공유합니다."""
+    return VectorIndex(db_name)
 
 class SearchManager:
     def __init__(self, db: MiddlewareDatabase):
         self.db = db
-        self.embedding_manager = EmbeddingManager()
+        self.embedding_manager = db.embedding_manager
+        self.vector_index = get_vector_index(db.db_name)
     
+    @traced
     def semantic_search(self, query: str, top_k: int = 3) -> List[Dict]:
-        query_embedding = self.embedding_manager.create_embeddings(query)[0]
-        
-        conn = sqlite3.connect(self.db.db_name)
-        cursor = conn.cursor()
-        
+        """요청은 이전 요청(input_text)과, 코드 조각은 이전에 생성/개선된 코드와 비교합니다."""
+        query_vector = self.embedding_manager.create_query_embedding(query)
+        if query_vector is None:
+            return []
+        fields = CODE_EMBEDDING_FIELDS if looks_like_code(query) else ('input_text',)
+
         # 벡터 유사도 검색
-        cursor.execute('''
-            SELECT h.*, vector_distance(e.embedding, ?) as distance
-            FROM middleware_history h
-            JOIN embeddings e ON h.id = e.history_id
-            ORDER BY distance ASC
-            LIMIT ?
-        ''', (query_embedding['embedding'], top_k))
-        
-        results = cursor.fetchall()
-        conn.close()
+        results = []
+        for history_id, similarity in self.vector_index.search(query_vector, top_k, fields=fields):
+            entry = self.db.get_entry(history_id)
+            if entry:
+                entry['similarity'] = similarity
+                results.append(entry)
         
         return results
 
@@ -541,40 +4030,24 @@ class RetrievalManager:
         self.client = anthropic
         
     def retrieve_similar_cases(self, query: str, top_k: int = 3) -> List[Dict]:
-        """유사한 이전 사례를 검색합니다."""
-        history = self.db.get_all_history()
-        similar_cases = []
-        
-        for case in history:
-            if any(keyword in case['input_text'].lower() 
-                  for keyword in query.lower().split()):
-                similar_cases.append(case)
-                if len(similar_cases) >= top_k:
-                    break
-        
-        return similar_cases
+        """유사한 이전 사례를 bm25 순위로 검색합니다."""
+        return self.db.search_history(query, top_k)
 
+    @track_llm_calls
     def generate_enhanced_requirements(self, query: str, similar_cases: List[Dict]) -> Dict:
         """유사 사례를 바탕으로 향상된 요구사항을 생성합니다."""
         prompt = f"""
-            다음 요청과 유사한 이전 사례들을 바탕으로 향상된 요구사항을 생성해주세요:
-            
             새로운 요청: {query}
             
             유사 사례들:
             {json.dumps([case['requirements'] for case in similar_cases], indent=2)}
-            
-            응답 규칙:
-            1. 반드시 유효한 JSON 형식으로 응답해야 합니다
-            2. 모든 키는 영문 소문자로 작성하세요
-            3. JSON 외의 다른 텍스트는 포함하지 마세요
-            4. 빈 응답은 허용되지 않습니다
             """
         
         try:
             response = self.client.messages.create(
-                model=MODEL,
+                model=ROUTED_MODEL,
                 max_tokens=1000,
+                system=prompt_prefix('enhanced_requirements'),
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.3
             )
@@ -600,32 +4073,38 @@ class RetrievalManager:
             return {"error": f"Failed to generate requirements: {str(e)}"}
 
     
+    @track_llm_calls
     def generate_enhanced_code(self, requirements: Dict, similar_cases: List[Dict]) -> str:
         """유사 사례를 바탕으로 향상된 코드를 생성합니다."""
         prompt = f"""
-        다음 요구사항과 유사한 이전 사례들을 참고하여 향상된 코드를 생성해주세요:
-        
         요구사항: {json.dumps(requirements, indent=2)}
 
-        규칙:
-        1. 코드는 Python으로 작성해주세요.
-        2. 필요한 주석을 포함해주세요.
-        3. 코드외에 다른 설명은 포함하지 마세요.
-        4. 함수는 "HTTP Request" 형태를 입력받습니다.
-        
-        참고할 이전 코드들:
+        유사한 이전 사례의 코드 (참고용):
         {json.dumps([case['initial_code'] for case in similar_cases], indent=2)}
         """
         
         response = self.client.messages.create(
-            model=MODEL,
+            model=ROUTED_MODEL,
             max_tokens=2000,
+            system=prompt_prefix('middleware'),
             messages=[{"role": "user", "content": prompt}],
             temperature=0.2
         )
         
         return response.content[0].text
 
+def streamlit_thread_initializer() -> Optional[Callable]:
+    """작업 스레드에서도 st.* 호출이 현재 세션에 표시되도록 실행 컨텍스트를 전달합니다."""
+    ctx = get_script_run_ctx()
+    if ctx is None:
+        return None
+    return lambda: add_script_run_ctx(threading.current_thread(), ctx)
+
+def format_stage_timings(timings: Dict[str, float], total_time: float, seeded_stages: List[str] = ()) -> str:
+    stages = " · ".join(f"{stage} {seconds:.1f}s" for stage, seconds in timings.items())
+    cached = f" · 요구사항 캐시 재사용: {', '.join(seeded_stages)}" if seeded_stages else ""
+    return f"⏱️ 전체 {total_time:.1f}s ({stages}){cached}"
+
 def rag_middleware_tab():
     st.header("RAG 기반 미들웨어 생성")
     
@@ -639,8 +4118,7 @@ def rag_middleware_tab():
             st.error("요구사항을 입력해주세요.")
             return
             
-        history = db.get_all_history()
-        if not history:
+        if not db.list_history(limit=1):
             st.warning("학습할 이전 데이터가 없습니다. 기본 생성으로 진행합니다.")
             return
         
@@ -677,16 +4155,10 @@ def show_history_tab():
      # 데이터베이스 관리 버튼들
     if st.button("🔄 데이터베이스 포맷"):
         try:
-            db = MiddlewareDatabase()
-            conn = sqlite3.connect(db.db_name)
-            cursor = conn.cursor()
-            
             # 테이블 재생성
-            cursor.execute("DROP TABLE IF EXISTS middleware_history")
-            db.create_schema()
+            MiddlewareDatabase().reset()
             
             st.success("데이터베이스가 포맷되었습니다.")
-            conn.close()
         except Exception as e:
             st.error(f"포맷 중 오류가 발생했습니다: {str(e)}")
     
@@ -694,25 +4166,29 @@ def show_history_tab():
     st.divider()
 
     db = MiddlewareDatabase()
-    history = db.get_all_history()
+    unique_dates = db.get_history_dates()
     
-    if not history:
+    if not unique_dates:
         st.info("저장된 미들웨어 정보가 없습니다.")
         return
     
     # 날짜별 필터링
-    dates = [datetime.fromisoformat(h['timestamp']).date() for h in history]
-    unique_dates = sorted(set(dates), reverse=True)
     selected_date = st.selectbox("날짜 선택", unique_dates)
     
-    # 선택된 날짜의 기록만 표시
-    filtered_history = [
-        h for h in history 
-        if datetime.fromisoformat(h['timestamp']).date() == selected_date
-    ]
+    # 선택된 날짜의 기록을 페이지 단위로 조회 (페이지마다 마지막 (timestamp, id)를 커서로 보관)
+    cursors = st.session_state.setdefault(f"history_cursors_{selected_date}", [None])
+    page = db.list_history(limit=HISTORY_PAGE_SIZE + 1, before=cursors[-1], date=selected_date)
+    has_next_page = len(page) > HISTORY_PAGE_SIZE
+    page = page[:HISTORY_PAGE_SIZE]
     
-    for entry in filtered_history:
-        with st.expander(f"📝 {entry['timestamp']} - {entry['input_text'][:50]}..."):
+    for summary in page:
+        # 개선된 버전이 있는 항목은 본문을 불러오지 않고도 알 수 있게 제목에 표시
+        marker = " ✨ 개선됨" if summary['has_improvement'] else ""
+        with st.expander(f"📝 {summary['timestamp']} - {summary['input_text'][:50]}...{marker}"):
+            # 본문(코드, 문서, 검증 결과)은 펼쳐 보기를 선택한 항목만 불러옴
+            if not st.toggle("내용 보기", key=f"history_entry_{summary['id']}"):
+                continue
+            entry = db.get_entry(summary['id'])
             col1, col2 = st.columns(2)
             
             with col1:
@@ -730,6 +4206,14 @@ def show_history_tab():
                 else:
                     st.info("개선된 버전이 없습니다.")
 
+    prev_col, next_col = st.columns(2)
+    if len(cursors) > 1 and prev_col.button("◀ 이전 페이지"):
+        cursors.pop()
+        st.rerun()
+    if has_next_page and next_col.button("다음 페이지 ▶"):
+        cursors.append((page[-1]['timestamp'], page[-1]['id']))
+        st.rerun()
+
 def generate_middleware_tab():
     # 세션 상태 초기화를 가장 먼저 수행
     if 'initial_result' not in st.session_state:
@@ -773,48 +4257,61 @@ def generate_middleware_tab():
         # 사용자 입력
         user_input = st.text_area("미들웨어 요구사항을 자연어로 입력하세요:", height=100)
         
-        if st.button("미들웨어 생성"):
+        # "그래도 새로 생성"을 누르면 유사 요청 재사용을 건너뛰고 다시 생성
+        regenerate = bool(user_input) and st.session_state.pop('regenerate_request', None) == user_input
+        if st.button("미들웨어 생성") or regenerate:
             if not user_input:
                 st.error("요구사항을 입력해주세요.")
                 return
                 
-            generator = NLPMiddlewareGenerator()
-            
-            # 진행 상황을 보여줄 컨테이너
-            progress_container = st.empty()
-            
-            # 1. 요구사항 분석
-            with st.spinner("요구사항 분석 중..."):
-                requirements = generator.parsing_agent.parse_natural_language(user_input)
-                st.session_state['initial_result']['requirements'] = requirements
-                
-                st.subheader("📋 요구사항 분석")
-                st.json(requirements)
-            
-            # 2. 코드 생성
-            with st.spinner("미들웨어 코드 생성 중..."):
-                code = generator.middleware_agent.generate_middleware(requirements)
-                st.session_state['initial_result']['code'] = code
-                
-                st.subheader("💻 생성된 코드")
-                st.code(code, language="python")
-            
-            # 3. 문서 생성
-            with st.spinner("문서 생성 중..."):
-                documentation = generator.documentation_agent.generate_documentation(code)
-                st.session_state['initial_result']['documentation'] = documentation
-                
-                st.subheader("📚 문서")
-                st.markdown(documentation)
-            
-            # 4. 검증
-            with st.spinner("코드 검증 중..."):
-                validation = generator.validation_agent.validate_middleware(code, requirements)
-                st.session_state['initial_result']['validation'] = validation
-                
-                st.subheader("✅ 검증 결과")
-                st.markdown(validation)
-        
+            # 단계가 끝나는 순서와 관계없이 화면 순서를 유지하기 위한 자리
+            sections = {
+                'requirements': ("📋 요구사항 분석", st.json),
+                'code': ("💻 생성된 코드", lambda code: st.code(code, language="python")),
+                'documentation': ("📚 문서", st.markdown),
+                'validation': ("✅ 검증 결과", st.markdown),
+            }
+            placeholders = {stage: st.empty() for stage in sections}
+
+            def show_stage(stage: str, value):
+                if stage not in sections:
+                    return
+                title, render = sections[stage]
+                with placeholders[stage].container():
+                    st.subheader(title)
+                    render(value)
+
+            # 요청 하나를 최상위 span으로 기록 (샘플링된 경우에만)
+            with tracer.span('generate_request'):
+                generator = NLPMiddlewareGenerator()
+                # 거의 같은 요청을 이미 처리했다면 LLM을 호출하지 않고 저장된 결과를 보여줌
+                duplicate = None if regenerate else generator.find_duplicate(user_input)
+                if duplicate:
+                    for stage in INITIAL_PIPELINE_TARGETS:
+                        st.session_state['initial_result'][stage] = duplicate[stage]
+                        show_stage(stage, duplicate[stage])
+                    st.session_state['duplicate_stats'] = {
+                        'hits': st.session_state.get('duplicate_stats', {}).get('hits', 0) + 1,
+                        'llm_calls_saved': st.session_state.get('duplicate_stats', {}).get('llm_calls_saved', 0)
+                                           + duplicate['llm_calls_saved'],
+                    }
+                    st.info(f"유사도 {duplicate['similarity']:.2f}인 이전 요청 \"{duplicate['duplicate_input']}\"의 "
+                            f"결과를 재사용해 LLM 호출 {duplicate['llm_calls_saved']}회를 절약했습니다.")
+                    st.button("🔄 그래도 새로 생성",
+                              on_click=lambda: st.session_state.update(regenerate_request=user_input))
+                    return
+
+                pipeline = generator.create_pipeline(thread_initializer=streamlit_thread_initializer(),
+                                                     on_progress=show_stage, reuse_generated=not regenerate)
+
+                # 요구사항 분석 → 코드 생성 → (문서 생성 | 검증) 동시 실행, 생성 중인 텍스트는 바로 표시
+                with st.spinner("미들웨어 생성 파이프라인 실행 중..."):
+                    for stage, value in pipeline.iter_run({'input_text': user_input}, INITIAL_PIPELINE_TARGETS):
+                        st.session_state['initial_result'][stage] = value
+                        show_stage(stage, value)
+
+                st.caption(format_stage_timings(pipeline.timings, pipeline.total_time, pipeline.seeded_stages))
+
         # 저장된 결과가 있으면 표시
         elif st.session_state['initial_result']['code']:
             st.subheader("📋 요구사항 분석")
@@ -836,22 +4333,14 @@ def generate_middleware_tab():
             if st.button("💡 개선된 버전 생성"):
                 generator = NLPMiddlewareGenerator()
                 
-                with st.spinner("개선된 버전 생성 중..."):
-                    # 개선된 코드 생성
-                    improved_code = generator.middleware_agent.generate_improved_code(
-                        st.session_state['initial_result']['code'],
-                        st.session_state['initial_result']['validation']
-                    )
-                    
-                    # 개선된 문서 생성
-                    improved_documentation = generator.documentation_agent.generate_documentation(
-                        improved_code
-                    )
+                with st.spinner("개선된 버전 생성 중..."), tracer.span('improve_request'):
+                    # 초기 결과를 입력으로 개선된 코드 → 개선된 문서 생성
+                    pipeline = generator.create_pipeline()
+                    improved = pipeline.run(st.session_state['initial_result'], IMPROVEMENT_PIPELINE_TARGETS)
                     
                     # 세션 상태 업데이트
                     st.session_state['improved_result'].update({
-                        'improved_code': improved_code,
-                        'improved_documentation': improved_documentation
+                        stage: improved[stage] for stage in IMPROVEMENT_PIPELINE_TARGETS
                     })
             
             # 개선된 결과가 있으면 표시
@@ -874,14 +4363,108 @@ def generate_middleware_tab():
                 except Exception as e:
                     st.error(f"저장 중 오류가 발생했습니다: {str(e)}")
 
+# 메트릭 탭의 조회 기간: (표시 이름, 기간(초), 그래프 구간(초))
+METRICS_WINDOWS = [("최근 1시간", 3600, 60), ("최근 24시간", 86400, 3600), ("최근 7일", 7 * 86400, 6 * 3600),
+                   ("최근 30일", 30 * 86400, 86400)]
+
+def show_metrics_tab():
+    st.header("📈 LLM 호출 메트릭")
+    label = st.selectbox("조회 기간", [window[0] for window in METRICS_WINDOWS], key="metrics_window")
+    _, window_seconds, bucket_seconds = next(window for window in METRICS_WINDOWS if window[0] == label)
+
+    calls = anthropic.telemetry.get_calls(time.time() - window_seconds)
+    if not calls:
+        st.info("선택한 기간에 기록된 LLM 호출이 없습니다.")
+        return
+
+    summary = LLMTelemetry.summarize(calls)
+    total_calls = len(calls)
+    completed = [call for call in calls if call['outcome'] == 'ok']
+    prompt_tokens = sum(call['input_tokens'] + call['cache_read_tokens'] + call['cache_write_tokens'] for call in completed)
+    col1, col2, col3, col4, col5 = st.columns(5)
+    col1.metric("호출 수", total_calls)
+    col2.metric("오류율", f"{sum(1 for call in calls if call['outcome'] == 'error') / total_calls:.1%}")
+    col3.metric("캐시 적중", sum(1 for call in calls if call['outcome'] == 'cache_hit'))
+    col4.metric("접두사 캐시 읽기 비율",
+                f"{sum(call['cache_read_tokens'] for call in completed) / prompt_tokens:.1%}" if prompt_tokens else "-")
+    col5.metric("p95 지연 시간", f"{percentile([call['latency_ms'] for call in completed], 95) / 1000:.2f}s")
+
+    st.subheader("에이전트/메서드별 지연 시간과 토큰 사용량")
+    st.dataframe([
+        {
+            '에이전트': row['agent'], '메서드': row['method'], '호출': row['calls'],
+            '오류': row['errors'], '캐시 적중': row['cache_hits'],
+            'p50 (s)': round(row['p50_ms'] / 1000, 2), 'p95 (s)': round(row['p95_ms'] / 1000, 2),
+            'p99 (s)': round(row['p99_ms'] / 1000, 2), '첫 토큰 p50 (s)': round(row['p50_first_token_ms'] / 1000, 2),
+            '입력 토큰': row['input_tokens'], '출력 토큰': row['output_tokens'],
+            '캐시 읽기 토큰': row['cache_read_tokens'], '캐시 쓰기 토큰': row['cache_write_tokens'],
+            '캐시 읽기 비율': f"{row['prompt_cache_read_ratio']:.1%}",
+            '출력 토큰/s': round(row['output_tokens_per_second'], 1),
+        }
+        for row in summary
+    ], use_container_width=True)
+
+    # 라우팅 규칙(MODEL_ROUTES) 조정용: 같은 메서드라도 모델별로 나누어 표시
+    st.subheader("모델 라우트별 지연 시간")
+    st.dataframe([
+        {
+            '에이전트': row['agent'], '메서드': row['method'], '모델': row['model'], '호출': row['calls'],
+            '승격 호출': row['escalations'], '오류': row['errors'],
+            'p50 (s)': round(row['p50_ms'] / 1000, 2), 'p95 (s)': round(row['p95_ms'] / 1000, 2),
+            '첫 토큰 p50 (s)': round(row['p50_first_token_ms'] / 1000, 2),
+            '출력 토큰/s': round(row['output_tokens_per_second'], 1),
+        }
+        for row in LLMTelemetry.summarize(calls, keys=('agent', 'method', 'model'))
+    ], use_container_width=True)
+
+    # 구간별 에이전트 p95 지연 시간과 토큰 처리량
+    buckets = {}
+    for call in completed:
+        bucket = int(call['created_at'] // bucket_seconds) * bucket_seconds
+        buckets.setdefault(bucket, {}).setdefault(call['agent'], []).append(call)
+    agents = sorted({call['agent'] for call in completed})
+    times = sorted(buckets)
+    latency_chart = {'시간': [datetime.fromtimestamp(bucket) for bucket in times]}
+    token_chart = dict(latency_chart)
+    for agent in agents:
+        latency_chart[agent] = [
+            percentile([call['latency_ms'] / 1000 for call in buckets[bucket].get(agent, [])], 95) or None
+            for bucket in times
+        ]
+        token_chart[agent] = [
+            sum(call['input_tokens'] + call['output_tokens'] for call in buckets[bucket].get(agent, []))
+            / (bucket_seconds / 60)
+            for bucket in times
+        ]
+    if times:
+        st.subheader("에이전트별 p95 지연 시간 (초)")
+        st.line_chart(latency_chart, x='시간', y=agents)
+        st.subheader("에이전트별 토큰 처리량 (토큰/분)")
+        st.line_chart(token_chart, x='시간', y=agents)
+
 # 페이지 레이아웃을 wide로 설정
 st.set_page_config(layout="wide")
 
 def main():
     st.title("LLM Based 미들웨어 생성 Agent")
-    
+
+    # LLM 응답 캐시 현황
+    cache_stats = anthropic.cache.get_stats()
+    st.sidebar.subheader("🗃️ LLM 응답 캐시")
+    st.sidebar.write(f"적중 {cache_stats['hits']}회 / 미스 {cache_stats['misses']}회")
+    st.sidebar.caption(f"저장된 응답 {cache_stats['entries']}개 ({cache_stats['bytes'] / 1024:.0f} KB)")
+    rule_stats = get_rule_parser().get_stats()
+    st.sidebar.caption(f"규칙 기반 요구사항 분석 적중률 {rule_stats['hit_rate']:.0%} "
+                       f"({rule_stats['rule_hits']}/{rule_stats['rule_hits'] + rule_stats['llm_fallbacks']})")
+    generation_stats = get_generation_cache().get_stats()
+    st.sidebar.caption(f"요구사항 해시 캐시 {generation_stats['entries']}개 / 적중 {generation_stats['hits']}회")
+    template_stats = get_template_library().get_stats()
+    st.sidebar.caption(f"템플릿 코드 생성 {template_stats['template_hits']}건 / LLM 코드 생성 {template_stats['llm_generations']}건")
+    if tracer.sample_rate > 0:
+        st.sidebar.caption(f"트레이스 샘플링 {tracer.sample_rate:.0%} → {tracer.output_dir}/")
+
     # 탭 생성
-    tab1, tab2, tab3 = st.tabs(["미들웨어 생성", "히스토리 조회", "RAG 기반 생성"])
+    tab1, tab2, tab3, tab4 = st.tabs(["미들웨어 생성", "히스토리 조회", "RAG 기반 생성", "메트릭"])
     
     with tab1:
         generate_middleware_tab()
@@ -892,6 +4475,15 @@ def main():
     with tab3:
         rag_middleware_tab()
 
+    with tab4:
+        show_metrics_tab()
+
+    # 유사 요청 재사용 현황
+    duplicate_stats = st.session_state.get('duplicate_stats')
+    if duplicate_stats:
+        st.sidebar.subheader("♻️ 유사 요청 재사용")
+        st.sidebar.write(f"재사용 {duplicate_stats['hits']}회 / 절약한 LLM 호출 {duplicate_stats['llm_calls_saved']}회")
+
     # 세션 상태 초기화
     if 'initial_result' not in st.session_state:
         st.session_state['initial_result'] = {
@@ -907,5 +4499,449 @@ def main():
             'improved_documentation': None
         }
 
+# 배치 실행 시 동시에 처리할 요청 수 기본값
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+def read_batch_requests(input_path: str) -> Iterator[Dict]:
+    """JSONL 파일에서 요청을 한 줄씩 읽습니다. 각 줄은 {"id", "input_text"} 객체나 문자열입니다.
+
+    형식이 잘못된 줄은 배치를 멈추지 않도록 error가 담긴 요청으로 반환해 실패로 기록하게 합니다.
+    """
+    with open(input_path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield {'id': str(line_number), 'error': f"JSON 형식 오류: {e}"}
+                continue
+            if isinstance(record, str):
+                record = {'input_text': record}
+            if not isinstance(record, dict):
+                yield {'id': str(line_number), 'error': "요청은 객체나 문자열이어야 합니다"}
+                continue
+            request_id = str(record.get('id', line_number))
+            input_text = record.get('input_text')
+            if not isinstance(input_text, str) or not input_text.strip():
+                yield {'id': request_id, 'error': "input_text가 없습니다"}
+                continue
+            yield {'id': request_id, 'input_text': input_text}
+
+def load_completed_ids(output_path: str) -> set:
+    """이전 실행에서 성공적으로 끝난 요청 id를 읽어 재시작 시 건너뜁니다."""
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 중단되며 잘린 마지막 줄은 무시
+                continue
+            if record.get('status') == 'ok':
+                completed.add(record['id'])
+    return completed
+
+def run_batch(input_path: str, output_path: str, concurrency: int = BATCH_CONCURRENCY, reuse: bool = False) -> Dict:
+    """JSONL 요청 전체에 대해 분석 → 생성 → 검증 → 문서화 → 개선 파이프라인을 실행합니다.
+
+    결과는 완료될 때마다 DB와 결과 JSONL에 기록되므로, 중단 후 다시 실행하면 남은 요청만 처리합니다.
+    DB에는 (결과 파일, 요청 id) 키로 저장하므로 두 기록 사이에 중단되어 다시 처리해도 히스토리가 중복되지 않습니다.
+    배치는 모델 변경 뒤 다시 생성하는 데 쓰이므로 기본으로 모든 요청을 새로 생성하고, reuse가 True일 때만
+    유사한 이전 요청과 생성 결과 캐시를 재사용합니다.
+    """
+    generator = NLPMiddlewareGenerator()
+    completed_ids = load_completed_ids(output_path)
+    stage_timings = {}
+    stats = {'ok': 0, 'error': 0, 'skipped': 0, 'duplicates': 0, 'llm_calls_saved': 0}
+    started_at = time.perf_counter()
+    batch_started_at = time.time()
+
+    def process(request: Dict) -> Dict:
+        started = time.perf_counter()
+        with tracer.span('batch_request', request_id=str(request['id'])):
+            duplicate = reuse and generator.find_duplicate(request['input_text'], list(PIPELINE_GRAPH))
+            if duplicate:
+                return dict(request, status='ok', **duplicate,
+                            timings={'duplicate_lookup': time.perf_counter() - started})
+            result = generator.run_pipeline(request['input_text'], list(PIPELINE_GRAPH), reuse_generated=reuse)
+            return dict(request, status='ok', **result)
+
+    with open(output_path, 'a', encoding='utf-8') as output, \
+            ThreadPoolExecutor(max_workers=concurrency) as pool:
+
+        request_key_prefix = os.path.abspath(output_path)
+
+        def record_result(record: Dict):
+            """결과 하나를 DB에 저장하고 결과 JSONL에 바로 기록합니다."""
+            stats[record['status']] += 1
+            if 'duplicate_of' in record:
+                stats['duplicates'] += 1
+                stats['llm_calls_saved'] += record['llm_calls_saved']
+            # 재사용한 결과는 이미 히스토리에 있으므로 다시 저장하지 않음
+            elif record['status'] == 'ok':
+                saved = dict(record, request_key=f"{request_key_prefix}#{record['id']}")
+                generator.db.save_many([(saved, saved)])
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+
+        def collect_result(future, request: Dict):
+            try:
+                record = future.result()
+                for stage, seconds in record['timings'].items():
+                    stage_timings.setdefault(stage, []).append(seconds)
+            except Exception as e:
+                record = dict(request, status='error', error=str(e))
+            record_result(record)
+
+        running = {}
+        for request in read_batch_requests(input_path):
+            if request['id'] in completed_ids:
+                stats['skipped'] += 1
+                continue
+            if 'error' in request:
+                record_result(dict(request, status='error'))
+                continue
+            # 파일 전체를 메모리에 올리지 않도록 제출 대기열 크기를 제한
+            while len(running) >= concurrency * 2:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect_result(future, running.pop(future))
+            running[pool.submit(process, request)] = request
+
+        for future in list(running):
+            wait([future])
+            collect_result(future, running.pop(future))
+        # 종료 전에 남은 변경을 색인해 다음 검색이 바로 최신 결과를 보도록 함
+        generator.db.indexer.process_pending()
+
+    elapsed = time.perf_counter() - started_at
+    processed = stats['ok'] + stats['error']
+    stats['elapsed_seconds'] = elapsed
+    stats['requests_per_minute'] = processed / elapsed * 60 if elapsed > 0 else 0.0
+    stats['rule_parser'] = get_rule_parser().get_stats()
+    stats['templates'] = get_template_library().get_stats()
+    stats['stage_latency'] = {
+        stage: {f"p{q}": percentile(values, q) for q in (50, 95, 99)}
+        for stage, values in stage_timings.items()
+    }
+    # 이번 배치에서 기록된 LLM 호출의 모델 라우트별 지연 시간 (MODEL_ROUTES 조정용)
+    stats['model_routes'] = LLMTelemetry.summarize(anthropic.telemetry.get_calls(batch_started_at),
+                                                   keys=('agent', 'method', 'model'))
+    return stats
+
+def print_batch_report(stats: Dict):
+    print(f"완료 {stats['ok']}건, 실패 {stats['error']}건, 건너뜀 {stats['skipped']}건 "
+          f"({stats['elapsed_seconds']:.1f}s, {stats['requests_per_minute']:.1f} requests/min)")
+    print(f"유사 요청 재사용 {stats['duplicates']}건 (절약한 LLM 호출 {stats['llm_calls_saved']}회)")
+    print(f"규칙 기반 요구사항 분석 적중률 {stats['rule_parser']['hit_rate']:.0%} "
+          f"(규칙 {stats['rule_parser']['rule_hits']}건, LLM {stats['rule_parser']['llm_fallbacks']}건)")
+    print(f"템플릿 코드 생성 적중률 {stats['templates']['hit_rate']:.0%} "
+          f"(템플릿 {stats['templates']['template_hits']}건, LLM {stats['templates']['llm_generations']}건)")
+    print(f"{'stage':<24}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, latency in stats['stage_latency'].items():
+        print(f"{stage:<24}{latency['p50']:>9.2f}s{latency['p95']:>9.2f}s{latency['p99']:>9.2f}s")
+    if stats['model_routes']:
+        print(f"{'route':<80}{'calls':>7}{'escalated':>11}{'p50':>10}{'p95':>10}")
+        for route in stats['model_routes']:
+            name = f"{route['agent']}.{route['method']} @ {route['model']}"
+            print(f"{name:<80}{route['calls']:>7}{route['escalations']:>11}"
+                  f"{route['p50_ms'] / 1000:>9.2f}s{route['p95_ms'] / 1000:>9.2f}s")
+
+def synthetic_vectors(size: int, dim: int, n_queries: int) -> Tuple[np.ndarray, np.ndarray]:
+    """벤치마크용으로 군집 구조가 있는 정규화된 벡터와 그 근처의 질의 벡터를 만듭니다."""
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((max(1, size // 100), dim)).astype(np.float32)
+    matrix = centers[rng.integers(0, len(centers), size)] + rng.standard_normal((size, dim)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    queries = matrix[rng.choice(size, n_queries, replace=False)] + 0.1 * rng.standard_normal((n_queries, dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return matrix, queries
+
+def measure_search(queries: np.ndarray, search: Callable) -> Tuple[List[set], List[float]]:
+    """질의마다 search가 반환한 행 번호 집합과 소요 시간을 기록합니다."""
+    found, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found.append(set(search(query).tolist()))
+        latencies.append(time.perf_counter() - start)
+    return found, latencies
+
+def benchmark_ann(size: int, dim: int = EMBEDDING_DIM, n_queries: int = 100, top_k: int = 10,
+                  nprobes: List[int] = (1, 2, 4, 8, 16, 32), n_lists: int = IVF_NLIST) -> List[Dict]:
+    """군집 구조가 있는 합성 벡터로 IVF 인덱스의 nprobe별 재현율과 지연 시간을 전체 스캔과 비교합니다."""
+    matrix, queries = synthetic_vectors(size, dim, n_queries)
+    measure = lambda search: measure_search(queries, search)
+
+    exact, exact_latencies = measure(lambda q: top_k_indices(matrix @ q, top_k))
+    report = [{'index': 'exact', 'nprobe': None, 'recall': 1.0,
+               'p50_ms': percentile(exact_latencies, 50) * 1000, 'p95_ms': percentile(exact_latencies, 95) * 1000}]
+
+    ivf = IVFIndex(n_lists)
+    start = time.perf_counter()
+    ivf.train(matrix)
+    train_seconds = time.perf_counter() - start
+
+    for nprobe in nprobes:
+        def search(query, nprobe=nprobe):
+            rows = ivf.candidates(query, nprobe)
+            return rows[top_k_indices(matrix[rows] @ query, top_k)]
+        found, latencies = measure(search)
+        recall = float(np.mean([len(f & e) / len(e) for f, e in zip(found, exact)]))
+        report.append({'index': 'ivf', 'nprobe': nprobe, 'recall': recall,
+                       'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+                       'train_seconds': train_seconds, 'n_lists': len(ivf.centroids)})
+    return report
+
+def benchmark_quantization(size: int, dim: int = EMBEDDING_DIM, n_queries: int = 100, top_k: int = 10,
+                           rescore_factors: List[int] = (2, 10, 50)) -> List[Dict]:
+    """float32 / int8 / binary 저장 방식의 메모리 사용량, recall@k, 지연 시간을 비교합니다."""
+    matrix, queries = synthetic_vectors(size, dim, n_queries)
+    exact, latencies = measure_search(queries, lambda q: top_k_indices(matrix @ q, top_k))
+    report = [{'mode': 'float32', 'shortlist': None, 'bytes': matrix.nbytes, 'recall': 1.0,
+               'p50_ms': percentile(latencies, 50) * 1000}]
+
+    codes, scales = quantize_int8(matrix)
+    bits = pack_bits(matrix)
+    int8_scores = lambda q: (codes.astype(np.float32) @ q) * scales
+    found, latencies = measure_search(queries, lambda q: top_k_indices(int8_scores(q), top_k))
+    report.append({'mode': 'int8', 'shortlist': None, 'bytes': codes.nbytes + scales.nbytes,
+                   'recall': float(np.mean([len(f & e) / top_k for f, e in zip(found, exact)])),
+                   'p50_ms': percentile(latencies, 50) * 1000})
+
+    for factor in rescore_factors:
+        shortlist_size = top_k * factor
+        def search(query):
+            distances = hamming_distances(bits, pack_bits(query[None, :])[0])
+            rows = top_k_indices(-distances.astype(np.float32), shortlist_size)
+            return rows[top_k_indices(matrix[rows] @ query, top_k)]
+        found, latencies = measure_search(queries, search)
+        report.append({'mode': 'binary', 'shortlist': shortlist_size, 'bytes': bits.nbytes,
+                       'recall': float(np.mean([len(f & e) / top_k for f, e in zip(found, exact)])),
+                       'p50_ms': percentile(latencies, 50) * 1000})
+    return report
+
+def print_quantization_benchmark(report: List[Dict], top_k: int):
+    base_bytes = report[0]['bytes']
+    print(f"{'mode':<9}{'shortlist':>10}{'memory':>12}{'ratio':>8}{f'recall@{top_k}':>12}{'p50':>10}")
+    for row in report:
+        shortlist = row['shortlist'] if row['shortlist'] is not None else '-'
+        print(f"{row['mode']:<9}{shortlist:>10}{row['bytes'] / 1024 / 1024:>10.1f}MB"
+              f"{base_bytes / row['bytes']:>7.0f}x{row['recall']:>12.3f}{row['p50_ms']:>8.2f}ms")
+
+def print_ann_benchmark(report: List[Dict], top_k: int):
+    print(f"{'index':<8}{'nprobe':>8}{f'recall@{top_k}':>12}{'p50':>10}{'p95':>10}")
+    for row in report:
+        nprobe = row['nprobe'] if row['nprobe'] is not None else '-'
+        print(f"{row['index']:<8}{nprobe:>8}{row['recall']:>12.3f}{row['p50_ms']:>8.2f}ms{row['p95_ms']:>8.2f}ms")
+    ivf_rows = [row for row in report if row['index'] == 'ivf']
+    if ivf_rows:
+        print(f"IVF 군집 {ivf_rows[0]['n_lists']}개, 학습 {ivf_rows[0]['train_seconds']:.1f}s")
+
+# 로컬 대체 Messages API 서버(mock-llm) 설정. 실제 API의 캐시 유지 시간을 기본값으로 사용
+MOCK_LLM_CACHE_TTL_SECONDS = 300
+
+class PromptCacheEmulator:
+    """Messages API의 접두사 캐시 토큰 계산을 흉내 냅니다.
+
+    tools → system → messages 순서로 블록을 이어 붙이고 cache_control이 붙은 블록까지를 캐시 항목으로 봅니다.
+    캐시된 가장 긴 접두사는 cache_read_input_tokens, 그 뒤부터 마지막 중단점까지는 cache_creation_input_tokens,
+    나머지는 input_tokens로 계산합니다. 최소 길이(min_tokens, 없으면 모델별 최소 길이)보다 짧은 접두사는 캐시하지 않으며,
+    읽을 때마다 유지 시간이 갱신됩니다.
+    """
+    def __init__(self, ttl_seconds: float = MOCK_LLM_CACHE_TTL_SECONDS,
+                 min_tokens: Optional[int] = None):
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self._expires_at = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _blocks(body: Dict) -> List[Dict]:
+        blocks = list(body.get('tools', []))
+        system = body.get('system') or []
+        blocks += [{"type": "text", "text": system}] if isinstance(system, str) else system
+        for message in body.get('messages', []):
+            content = message['content']
+            if isinstance(content, str):
+                content = [{"type": "text", "text": content}]
+            blocks += [{**block, 'role': message['role']} for block in content]
+        return blocks
+
+    def account(self, body: Dict) -> Dict[str, int]:
+        """요청 본문의 입력 토큰을 캐시 읽기/쓰기/일반 입력으로 나눕니다."""
+        digest = hashlib.sha256(str(body.get('model')).encode())
+        total, breakpoints = 0, []
+        for block in self._blocks(body):
+            payload = json.dumps({key: value for key, value in block.items() if key != 'cache_control'},
+                                 ensure_ascii=False, sort_keys=True)
+            digest.update(payload.encode())
+            total += estimate_prompt_tokens(block['text'] if block.get('type') == 'text' else payload)
+            if 'cache_control' in block:
+                breakpoints.append((digest.hexdigest(), total))
+
+        now = time.monotonic()
+        with self._lock:
+            read = max((tokens for key, tokens in breakpoints if self._expires_at.get(key, 0) > now), default=0)
+            min_tokens = self.min_tokens or min_cacheable_tokens(body.get('model'))
+            cacheable = [(key, tokens) for key, tokens in breakpoints if tokens >= min_tokens]
+            for key, _ in cacheable:
+                self._expires_at[key] = now + self.ttl_seconds
+        write = max(cacheable[-1][1] - read, 0) if cacheable else 0
+        return {'input_tokens': total - read - write, 'cache_read_input_tokens': read,
+                'cache_creation_input_tokens': write}
+
+def placeholder_for_schema(schema: Dict) -> Any:
+    """JSON 스키마의 필수 항목만 채운 가장 단순한 값을 만듭니다. (mock-llm의 도구 호출 응답용)"""
+    kind = schema.get('type')
+    if kind == 'object':
+        properties = schema.get('properties', {})
+        return {name: placeholder_for_schema(properties.get(name, {})) for name in schema.get('required', [])}
+    return {'array': [], 'string': "", 'boolean': False, 'integer': 0, 'number': 0}.get(kind)
+
+def run_mock_llm_server(host: str, port: int, response_text: str, ttl_seconds: float, min_tokens: Optional[int]):
+    """API 키나 네트워크 없이 게이트웨이와 프롬프트 캐시 동작을 확인할 수 있는 /v1/messages 대체 서버를 실행합니다.
+
+    ANTHROPIC_BASE_URL을 이 서버 주소로 지정하면 에이전트 호출이 이 서버로 전달되고, 응답의 usage에는
+    PromptCacheEmulator가 계산한 캐시 읽기/쓰기 토큰이 들어가 llm_calls 테이블에 그대로 기록됩니다.
+    """
+    emulator = PromptCacheEmulator(ttl_seconds, min_tokens)
+
+    class MessagesHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split('?')[0] != '/v1/messages':
+                self.send_error(404)
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            usage = emulator.account(body)
+            tool_choice = body.get('tool_choice') or {}
+            tool = next((tool for tool in body.get('tools', []) if tool['name'] == tool_choice.get('name')), None)
+            if tool is not None:
+                block = {"type": "tool_use", "id": f"toolu_{random.getrandbits(64):016x}", "name": tool['name'],
+                         "input": placeholder_for_schema(tool['input_schema'])}
+                usage['output_tokens'] = estimate_prompt_tokens(json.dumps(block['input']))
+                stop_reason = "tool_use"
+            else:
+                block = {"type": "text", "text": response_text}
+                usage['output_tokens'] = estimate_prompt_tokens(response_text)
+                stop_reason = "end_turn"
+            message = {"id": f"msg_{random.getrandbits(64):016x}", "type": "message", "role": "assistant",
+                       "model": body.get('model'), "content": [block], "stop_reason": stop_reason,
+                       "stop_sequence": None, "usage": usage}
+            print(f"{body.get('model')} 입력 {usage['input_tokens']}, 캐시 읽기 {usage['cache_read_input_tokens']}, "
+                  f"캐시 쓰기 {usage['cache_creation_input_tokens']}, 출력 {usage['output_tokens']}")
+            if body.get('stream'):
+                self._stream(message)
+            else:
+                self._send_json(message)
+
+        def _send_json(self, payload: Dict):
+            data = json.dumps(payload, ensure_ascii=False).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, message: Dict):
+            """messages.stream이 받는 server-sent events 순서로 응답합니다. 텍스트는 단어 단위로 나누어 보냅니다."""
+            block = message['content'][0]
+            events = [('message_start', {"type": "message_start", "message": {
+                **message, "content": [], "stop_reason": None, "usage": {**message['usage'], 'output_tokens': 0}}})]
+            if block['type'] == 'text':
+                events.append(('content_block_start', {"type": "content_block_start", "index": 0,
+                                                       "content_block": {"type": "text", "text": ""}}))
+                events += [('content_block_delta', {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": piece}})
+                           for piece in re.findall(r"\S+\s*|\s+", block['text'])]
+            else:
+                events.append(('content_block_start', {"type": "content_block_start", "index": 0,
+                                                       "content_block": {**block, "input": {}}}))
+                events.append(('content_block_delta', {"type": "content_block_delta", "index": 0, "delta": {
+                    "type": "input_json_delta", "partial_json": json.dumps(block['input'], ensure_ascii=False)}}))
+            events += [
+                ('content_block_stop', {"type": "content_block_stop", "index": 0}),
+                ('message_delta', {"type": "message_delta", "delta": {"stop_reason": message['stop_reason'],
+                                                                      "stop_sequence": None},
+                                   "usage": {"output_tokens": message['usage']['output_tokens']}}),
+                ('message_stop', {"type": "message_stop"}),
+            ]
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for event, data in events:
+                self.wfile.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MessagesHandler)
+    print(f"mock-llm: http://{host}:{port} (ANTHROPIC_BASE_URL로 지정, 최소 캐시 길이 {f'{min_tokens}토큰' if min_tokens else '모델별 기본값'})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def cli_main(argv: List[str]):
+    """Streamlit 없이 실행하는 명령을 처리합니다. 예: python app.py batch requests.jsonl -o results.jsonl"""
+    parser = argparse.ArgumentParser(prog="app.py")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch_parser = subparsers.add_parser('batch', help="JSONL 파일의 자연어 요청으로 미들웨어를 일괄 생성합니다.")
+    batch_parser.add_argument('input', help="요청 JSONL 파일")
+    batch_parser.add_argument('-o', '--output', default='batch_results.jsonl', help="결과 JSONL 파일 (재시작 시 이어서 기록)")
+    batch_parser.add_argument('-c', '--concurrency', type=int, default=BATCH_CONCURRENCY, help="동시에 처리할 요청 수")
+    batch_parser.add_argument('--reuse', action='store_true',
+                              help="유사한 이전 요청과 생성 결과 캐시를 재사용 (기본은 모두 새로 생성)")
+    batch_parser.add_argument('--regenerate', dest='reuse', action='store_false', help="모두 새로 생성 (기본값)")
+
+    bench_parser = subparsers.add_parser('bench-ann', help="ANN 인덱스의 재현율/지연 시간을 전체 스캔과 비교합니다.")
+    bench_parser.add_argument('--size', type=int, default=100000, help="벡터 수")
+    bench_parser.add_argument('--queries', type=int, default=100, help="질의 수")
+    bench_parser.add_argument('--top-k', type=int, default=10)
+    bench_parser.add_argument('--nlist', type=int, default=IVF_NLIST, help="IVF 군집 수 (0이면 벡터 수의 제곱근)")
+    bench_parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+
+    quant_parser = subparsers.add_parser('bench-quant', help="양자화 저장 방식의 메모리/재현율/지연 시간을 비교합니다.")
+    quant_parser.add_argument('--size', type=int, default=100000, help="벡터 수")
+    quant_parser.add_argument('--queries', type=int, default=100, help="질의 수")
+    quant_parser.add_argument('--top-k', type=int, default=10)
+    quant_parser.add_argument('--rescore-factor', type=int, nargs='+', default=[2, 10, 50],
+                              help="해밍 거리 후보 수 = top_k * 이 값")
+
+    mock_parser = subparsers.add_parser('mock-llm', help="프롬프트 캐시 토큰 계산을 흉내 내는 로컬 Messages API 서버를 실행합니다.")
+    mock_parser.add_argument('--host', default='127.0.0.1')
+    mock_parser.add_argument('--port', type=int, default=8765)
+    mock_parser.add_argument('--response', default="mock response", help="텍스트 응답 내용")
+    mock_parser.add_argument('--cache-ttl', type=float, default=MOCK_LLM_CACHE_TTL_SECONDS, help="캐시 유지 시간(초)")
+    mock_parser.add_argument('--min-cache-tokens', type=int, default=None,
+                             help="캐시할 수 있는 최소 접두사 토큰 수 (기본: 모델별 최소 길이)")
+
+    args = parser.parse_args(argv)
+    if args.command == 'batch':
+        print_batch_report(run_batch(args.input, args.output, args.concurrency, args.reuse))
+    elif args.command == 'bench-ann':
+        report = benchmark_ann(args.size, n_queries=args.queries, top_k=args.top_k,
+                               nprobes=args.nprobe, n_lists=args.nlist)
+        print_ann_benchmark(report, args.top_k)
+    elif args.command == 'bench-quant':
+        report = benchmark_quantization(args.size, n_queries=args.queries, top_k=args.top_k,
+                                        rescore_factors=args.rescore_factor)
+        print_quantization_benchmark(report, args.top_k)
+    elif args.command == 'mock-llm':
+        run_mock_llm_server(args.host, args.port, args.response, args.cache_ttl, args.min_cache_tokens)
+
+# CLI에서 사용할 수 있는 명령
+CLI_COMMANDS = {'batch', 'bench-ann', 'bench-quant', 'mock-llm'}
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] in CLI_COMMANDS:
+        cli_main(sys.argv[1:])
+    else:
+        main()
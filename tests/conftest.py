@@ -0,0 +1,22 @@
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+
+APP_PATH = Path(__file__).resolve().parent.parent / "app.py"
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """app.py를 임시 디렉터리에서 불러옵니다. (모듈 로드 시 만드는 DB 파일이 저장소에 남지 않도록)"""
+    os.environ.setdefault("ANTHROPIC_API_KEY", "test")
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("app"))
+    try:
+        spec = importlib.util.spec_from_file_location("app", APP_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
@@ -0,0 +1,24 @@
+import json
+
+
+def test_bad_lines_become_error_requests(app, tmp_path):
+    path = tmp_path / "requests.jsonl"
+    path.write_text("\n".join([
+        json.dumps({"id": "a", "input_text": "러시아 차단"}),
+        "{not json",
+        json.dumps({"id": "b"}),
+        json.dumps("문자열 요청"),
+        json.dumps(["목록"]),
+    ]), encoding='utf-8')
+    requests = list(app.read_batch_requests(str(path)))
+    assert [request['id'] for request in requests] == ["a", "2", "b", "4", "5"]
+    assert [('error' in request) for request in requests] == [False, True, True, False, True]
+
+
+def test_save_with_request_key_is_idempotent(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    result = {'input_text': "러시아 차단", 'requirements': {}, 'code': "pass", 'request_key': "out.jsonl#1"}
+    db.save_many([(result, result)])
+    db.save_many([(result, result)])
+    db.save_many([(dict(result, request_key=None), None)])
+    assert len(db.get_all_history()) == 2
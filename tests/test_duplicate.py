@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.mark.parametrize("first, second", [
+    ("러시아에서 오는 요청을 차단해줘", "러시아에서 오는 요청을 막아줘"),
+    ("러시아에서 오는 요청을 차단해줘", "러시아에서 들어오는 요청은 차단해 주세요"),
+    ("IP당 분당 100회로 요청 수 제한", "IP마다 분당 100회로 요청 횟수를 제한해줘"),
+])
+def test_paraphrases_share_signature(app, first, second):
+    assert app.request_signature(first) == app.request_signature(second)
+
+
+@pytest.mark.parametrize("first, second", [
+    ("러시아에서 오는 요청을 차단해줘", "중국에서 오는 요청을 차단해줘"),
+    ("러시아에서 오는 요청을 차단해줘", "러시아에서 오는 요청만 허용해줘"),
+    ("러시아에서 오는 요청을 차단해줘", "러시아에서 오는 요청은 차단하지 말고 로그만 남겨줘"),
+    ("요청 본문 크기를 5MB로 제한", "요청 본문 크기를 50MB로 제한"),
+    ("요청 본문 크기를 5MB로 제한", "요청 본문 크기를 5KB로 제한"),
+    ("IP당 분당 100회로 요청 수 제한", "IP당 분당 10회로 요청 수 제한"),
+    ("IP당 분당 100회로 요청 수 제한", "IP당 시간당 100회로 요청 수 제한"),
+    ("POST 요청의 본문 크기를 5MB로 제한", "GET 요청의 본문 크기를 5MB로 제한"),
+    ("/admin 경로에 Authorization 헤더 필수", "/api 경로에 Authorization 헤더 필수"),
+])
+def test_key_parameter_changes_change_signature(app, first, second):
+    assert app.request_signature(first) != app.request_signature(second)
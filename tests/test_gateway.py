@@ -0,0 +1,186 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from anthropic import APIStatusError
+
+
+def message(app, text, model='test'):
+    return app.Message.model_validate({
+        'id': 'msg', 'type': 'message', 'role': 'assistant', 'model': model,
+        'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+        'usage': {'input_tokens': 3, 'output_tokens': 2},
+    })
+
+
+def status_error(status, headers=None):
+    response = httpx.Response(status, headers=headers or {}, request=httpx.Request('POST', 'https://api.test'))
+    return APIStatusError(f"status {status}", response=response, body=None)
+
+
+class FlakyClient:
+    """errors에 담긴 오류를 차례로 낸 뒤부터는 'ok'로 응답합니다."""
+    def __init__(self, app, errors):
+        self.app = app
+        self.errors = list(errors)
+        self.calls = 0
+        self.messages = self
+
+    async def create(self, **params):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return message(self.app, 'ok', params['model'])
+
+
+@pytest.fixture
+def gateway_for(app, monkeypatch):
+    monkeypatch.setattr(app, 'LLM_BACKOFF_BASE_SECONDS', 0.001)
+
+    def build(errors, max_retries=3):
+        client = FlakyClient(app, errors)
+        gateway = app.LLMGateway(client, cache=None, max_retries=max_retries,
+                                 scheduler=app.RequestScheduler(10000, 10 ** 7, 4))
+        return gateway, client
+    return build
+
+
+def test_retryable_errors_are_retried(app, gateway_for):
+    gateway, client = gateway_for([status_error(529), status_error(429)])
+    response = gateway.create_message(model=app.MODEL, max_tokens=5, messages=[{'role': 'user', 'content': 'hi'}])
+    assert response.content[0].text == 'ok'
+    assert client.calls == 3
+
+
+def test_client_errors_and_exhausted_retries_raise(app, gateway_for):
+    gateway, client = gateway_for([status_error(400)])
+    with pytest.raises(APIStatusError):
+        gateway.create_message(model=app.MODEL, max_tokens=5, messages=[])
+    assert client.calls == 1
+
+    gateway, client = gateway_for([status_error(503)] * 3, max_retries=2)
+    with pytest.raises(APIStatusError):
+        gateway.create_message(model=app.MODEL, max_tokens=5, messages=[])
+    assert client.calls == 3
+
+
+def test_retry_after_header_is_honoured_and_capped(app):
+    assert app.backoff_delay(0, status_error(429, {'retry-after': '7'})) == 7
+    assert app.backoff_delay(0, status_error(429, {'retry-after': '9999'})) == app.LLM_BACKOFF_MAX_SECONDS
+
+
+def test_backoff_grows_exponentially_with_jitter(app, monkeypatch):
+    monkeypatch.setattr(app, 'LLM_BACKOFF_BASE_SECONDS', 1.0)
+    for attempt in range(4):
+        delay = app.backoff_delay(attempt, status_error(500))
+        assert 2 ** attempt / 2 <= delay <= 2 ** attempt
+
+
+def test_token_bucket_waits_for_refill_and_refunds(app):
+    bucket = app.TokenBucket(60)
+    bucket.consume(60)
+    assert bucket.delay_for(1) == pytest.approx(1.0, abs=0.05)
+    bucket.refund(30)
+    assert bucket.delay_for(30) == 0.0
+
+
+def test_scheduler_limits_concurrency(app):
+    scheduler = app.RequestScheduler(10000, 10 ** 7, max_concurrency=2)
+    active, peak = 0, 0
+
+    async def request():
+        nonlocal active, peak
+        await scheduler.acquire(10)
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        scheduler.release(10, 5)
+
+    async def main():
+        await asyncio.gather(*(request() for _ in range(6)))
+
+    asyncio.run(main())
+    assert peak == 2
+
+
+def test_scheduler_refunds_unused_estimate(app):
+    scheduler = app.RequestScheduler(10000, tokens_per_minute=600, max_concurrency=1)
+    asyncio.run(scheduler.acquire(500))
+    scheduler.release(500, 100)
+    assert scheduler.token_bucket.tokens == pytest.approx(500, abs=5)
+
+
+class StreamingClient:
+    """messages.stream 응답을 chunks 단위로 흘려보냅니다. 첫 요청은 fail_after개를 보낸 뒤 끊길 수 있습니다."""
+    def __init__(self, app, chunks, fail_after=None):
+        self.app = app
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.calls = 0
+        self.messages = self
+
+    def stream(self, **params):
+        self.calls += 1
+        client = self
+        fail_after = self.fail_after if self.calls == 1 else None
+
+        class Stream:
+            async def __aenter__(self):
+                return self
+
+            async def __aexit__(self, *exc):
+                return False
+
+            @property
+            async def text_stream(self):
+                for i, chunk in enumerate(client.chunks):
+                    if i == fail_after:
+                        raise status_error(529)
+                    yield chunk
+
+            async def get_final_message(self):
+                return message(client.app, ''.join(client.chunks), params['model'])
+
+        return Stream()
+
+
+def stream_gateway(app, tmp_path, client):
+    cache = app.LLMResponseCache(str(tmp_path / "cache.db"))
+    return app.LLMGateway(client, cache=cache, scheduler=app.RequestScheduler(10000, 10 ** 7, 4))
+
+
+STREAM_PARAMS = {'max_tokens': 10, 'temperature': 0.0, 'messages': [{'role': 'user', 'content': 'hi'}]}
+
+
+def test_stream_text_yields_chunks_then_whole_cached_text(app, tmp_path):
+    client = StreamingClient(app, ['al', 'pha ', 'beta'])
+    gateway = stream_gateway(app, tmp_path, client)
+
+    assert list(gateway.stream_text(model=app.MODEL, **STREAM_PARAMS)) == ['al', 'pha ', 'beta']
+    # 같은 요청은 캐시에서 전체 텍스트 하나로 반환
+    assert list(gateway.stream_text(model=app.MODEL, **STREAM_PARAMS)) == ['alpha beta']
+    assert client.calls == 1
+
+
+def test_interrupted_stream_is_not_retried(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'LLM_BACKOFF_BASE_SECONDS', 0.001)
+    client = StreamingClient(app, ['al', 'pha ', 'beta'], fail_after=1)
+    gateway = stream_gateway(app, tmp_path, client)
+
+    received = []
+    with pytest.raises(APIStatusError):
+        for chunk in gateway.stream_text(model=app.MODEL, **STREAM_PARAMS):
+            received.append(chunk)
+    # 이미 내보낸 조각이 중복되지 않도록 한 번만 요청
+    assert received == ['al']
+    assert client.calls == 1
+
+
+def test_stream_failing_before_first_chunk_is_retried(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'LLM_BACKOFF_BASE_SECONDS', 0.001)
+    client = StreamingClient(app, ['alpha'], fail_after=0)
+    gateway = stream_gateway(app, tmp_path, client)
+    assert list(gateway.stream_text(use_cache=False, model=app.MODEL, **STREAM_PARAMS)) == ['alpha']
+    assert client.calls == 2
@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+
+def canonical(app, requirements):
+    return app.canonicalize_requirements(requirements)
+
+
+def test_equivalent_requirements_share_a_hash(app):
+    first = {
+        'intent': 'Body_Size_Limit',
+        'requirements': ["본문 크기 제한", "413 응답"],
+        'parameters': {'max body bytes': "10 MB", 'window': "30 seconds"},
+    }
+    second = {
+        'Intent': 'body_size_limit',
+        'requirements': ["413 응답", "본문  크기 제한."],
+        'parameters': {'max-body-bytes': "10mb", 'window': "30초", 'unused': ""},
+    }
+    assert app.requirements_hash(first) == app.requirements_hash(second)
+
+
+def test_unit_regex_only_touches_numbers_followed_by_a_unit_word(app):
+    parameters = canonical(app, {'parameters': {'rule': "100 초과", 'size': "5 MB", 'path': "/v1/2ms-report"}})['parameters']
+    assert parameters == {'rule': "100 초과", 'size': "5242880b", 'path': "/v1/2ms-report"}
+
+
+def test_free_text_keeps_case_and_units(app):
+    result = canonical(app, {'requirements': ["Authorization 헤더가 없으면 30초 안에 401 응답"],
+                             'parameters': {'header_value': "Bearer ABC"}})
+    assert result['requirements'] == ["Authorization 헤더가 없으면 30초 안에 401 응답"]
+    assert result['parameters']['header_value'] == "Bearer ABC"
+
+
+def test_only_unordered_lists_are_sorted(app):
+    first = {'parameters': {'countries': ["RU", "cn"], 'middleware_chain': ["auth", "rate_limit", "cache"]}}
+    second = {'parameters': {'countries': ["CN", "ru"], 'middleware_chain': ["cache", "rate_limit", "auth"]}}
+    assert canonical(app, first)['parameters']['countries'] == ["cn", "ru"]
+    assert canonical(app, first)['parameters']['middleware_chain'] == ["auth", "rate_limit", "cache"]
+    assert app.requirements_hash(first) != app.requirements_hash(second)
+
+
+REQUIREMENTS = {'intent': 'geo_block', 'parameters': {'countries': ["RU"]}}
+
+
+def test_new_code_drops_documents_built_from_the_old_code(app, tmp_path):
+    cache = app.GenerationCache(str(tmp_path / "cache.db"))
+    key = app.generation_cache_key(REQUIREMENTS)
+    assert cache.get(key) == {}
+    # 코드보다 먼저 저장된 문서는 쓰지 않음
+    cache.put(key, REQUIREMENTS, 'documentation', "고아 문서")
+    assert cache.get(key) == {}
+
+    cache.put(key, REQUIREMENTS, 'code', "v1")
+    cache.put(key, REQUIREMENTS, 'documentation', "v1 문서")
+    cache.put(key, REQUIREMENTS, 'validation_report', {'passed': True, 'issues': []})
+    assert cache.get(key) == {'code': "v1", 'documentation': "v1 문서",
+                              'validation_report': {'passed': True, 'issues': []}}
+
+    cache.put(key, REQUIREMENTS, 'code', "v2")
+    assert cache.get(key) == {'code': "v2"}
+    assert cache.get_stats() == {'entries': 1, 'hits': 1}
+
+
+def test_entries_expire_and_least_recently_used_are_evicted(app, tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    cache = app.GenerationCache(str(tmp_path / "cache.db"), ttl_seconds=100, max_entries=2)
+    for key in ("a", "b"):
+        cache.put(key, REQUIREMENTS, 'code', key)
+        now[0] += 1
+    cache.get("a")
+    cache.put("c", REQUIREMENTS, 'code', "c")
+    assert [key for key in "abc" if cache.get(key)] == ["a", "c"]
+
+    now[0] += 101
+    assert cache.get("c") == {}
+
+
+def test_cache_key_follows_the_model_configuration(app, monkeypatch):
+    key = app.generation_cache_key(REQUIREMENTS)
+    monkeypatch.setattr(app, 'FAST_MODEL', "another-model")
+    assert app.generation_cache_key(REQUIREMENTS) != key
+
+
+def test_pipeline_reuses_stages_for_equivalent_requirements(app, tmp_path):
+    generator = SimpleNamespace(generation_cache=app.GenerationCache(str(tmp_path / "cache.db")))
+    calls = []
+
+    def stage(name, value):
+        def run(**inputs):
+            calls.append(name)
+            return value
+        return run
+
+    def run_pipeline(requirements, report=None):
+        stages = {
+            'requirements': lambda input_text: requirements,
+            'code': stage('code', "code"),
+            'documentation': stage('documentation', "docs"),
+            'validation_report': stage('validation_report', report or {'passed': True}),
+            'validation': stage('validation', "ok"),
+        }
+        executor = app.PipelineExecutor(
+            app.PIPELINE_GRAPH, stages,
+            on_stage_complete=lambda name, results: app.NLPMiddlewareGenerator._use_generation_cache(
+                generator, name, results))
+        return executor.run({'input_text': "요청"}, targets=app.INITIAL_PIPELINE_TARGETS)
+
+    # 검증에 실패한 결과는 저장하지 않아 다음 실행에서 다시 검증
+    run_pipeline(REQUIREMENTS, report={'failed': True})
+    assert sorted(calls) == ['code', 'documentation', 'validation', 'validation_report']
+    calls.clear()
+    run_pipeline({'Intent': 'GEO_BLOCK', 'parameters': {'countries': ["ru"]}})
+    assert sorted(calls) == ['validation', 'validation_report']
+    calls.clear()
+    assert run_pipeline(REQUIREMENTS)['documentation'] == "docs"
+    assert calls == []
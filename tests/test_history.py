@@ -0,0 +1,78 @@
+import pytest
+
+
+def test_list_history_marks_improved_entries(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    initial = {'input_text': "러시아 차단", 'requirements': {}, 'code': "pass"}
+    db.save_results(initial)
+    db.save_results(dict(initial, input_text="중국 차단"), {'improved_code': "pass  # 개선"})
+    improved = {row['input_text']: bool(row['has_improvement']) for row in db.list_history()}
+    assert improved == {"러시아 차단": False, "중국 차단": True}
+
+
+def test_connections_are_reused_per_thread_in_wal_mode(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    conn = db.connections.connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert db.connections.connection() is conn
+    # 같은 파일을 여는 다른 인스턴스도 연결 관리자를 공유하고 스키마를 다시 만들지 않음
+    again = app.MiddlewareDatabase(db.db_name)
+    assert again.connections is db.connections
+
+    other = []
+    thread = app.threading.Thread(target=lambda: other.append(db.connections.connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+
+def test_save_many_writes_one_transaction_and_skips_saved_requests(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    results = [({'input_text': f"요청 {i}", 'requirements': {}, 'code': "pass", 'request_key': f"key-{i}"}, None)
+               for i in range(5)]
+    db.save_many(results)
+    # 재시작한 배치가 같은 요청 키를 다시 저장해도 중복되지 않음
+    db.save_many(results[3:] + [({'input_text': "요청 5", 'requirements': {}, 'code': "pass"}, None)])
+    assert sorted(row['input_text'] for row in db.list_history()) == [f"요청 {i}" for i in range(6)]
+
+
+def test_save_many_rolls_back_on_failure(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    good = ({'input_text': "저장됨", 'requirements': {}, 'code': "pass"}, None)
+    # 두 번째 행은 바인딩할 수 없어 첫 행을 넣은 뒤 executemany 도중 실패
+    bad = ({'input_text': "실패", 'requirements': {}, 'code': object()}, None)
+    with pytest.raises(app.sqlite3.Error):
+        db.save_many([good, bad])
+    assert db.list_history() == []
+
+
+def save_at(db, *timestamps):
+    db.save_many([({'input_text': timestamp, 'requirements': {}, 'code': "pass"}, None) for timestamp in timestamps])
+    with db.connections.transaction() as conn:
+        conn.execute("UPDATE middleware_history SET timestamp = input_text")
+
+
+def test_history_is_filtered_by_date_in_sql(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    save_at(db, "2024-03-01T09:00:00", "2024-03-02T23:59:59", "2024-03-02T00:00:00", "2024-03-10T12:00:00")
+
+    assert db.get_history_dates() == ["2024-03-10", "2024-03-02", "2024-03-01"]
+    assert [row['timestamp'] for row in db.list_history(date="2024-03-02")] == [
+        "2024-03-02T23:59:59", "2024-03-02T00:00:00"]
+    assert db.list_history(date="2024-03-03") == []
+
+    plan = " ".join(row[3] for row in db.connections.connection().execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM middleware_history WHERE date = ? ORDER BY timestamp DESC",
+        ("2024-03-02",)))
+    assert "idx_middleware_history_date" in plan
+
+
+def test_date_filter_pages_with_before(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    save_at(db, *[f"2024-03-02T0{i}:00:00" for i in range(5)], "2024-03-01T12:00:00")
+
+    first = db.list_history(limit=3, date="2024-03-02")
+    last = first[-1]
+    rest = db.list_history(limit=3, date="2024-03-02", before=(last['timestamp'], last['id']))
+    assert [row['timestamp'][11:13] for row in first + rest] == ["04", "03", "02", "01", "00"]
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+
+def test_independent_stages_run_concurrently(app):
+    # 두 단계가 동시에 실행되어야 barrier를 통과함 (순서대로 실행되면 시간 초과)
+    barrier = threading.Barrier(2, timeout=5)
+
+    def wait_for_other(**inputs):
+        barrier.wait()
+        return inputs['source'] + 1
+
+    executor = app.PipelineExecutor(
+        {'source': [], 'left': ['source'], 'right': ['source'], 'joined': ['left', 'right']},
+        {'source': lambda: 1, 'left': wait_for_other, 'right': wait_for_other,
+         'joined': lambda left, right: left + right},
+    )
+    assert executor.run({})['joined'] == 4
+    assert set(executor.timings) == {'source', 'left', 'right', 'joined'}
+
+
+def test_only_stages_needed_for_targets_run(app):
+    calls = []
+
+    def stage(name):
+        def run(**inputs):
+            calls.append(name)
+            return name
+        return run
+
+    executor = app.PipelineExecutor(
+        {'a': [], 'b': ['a'], 'c': ['a'], 'd': ['c']},
+        {name: stage(name) for name in 'abcd'},
+    )
+    results = executor.run({'a': 'given'}, targets=['d'])
+    assert sorted(calls) == ['c', 'd']
+    assert results['d'] == 'd' and results['a'] == 'given'
+
+
+def test_seeded_stages_are_not_executed(app):
+    calls = []
+
+    def generate(**inputs):
+        calls.append('generate')
+        return 'generated'
+
+    executor = app.PipelineExecutor(
+        {'key': [], 'generate': ['key']},
+        {'key': lambda: 'k', 'generate': generate},
+        on_stage_complete=lambda stage, results: {'generate': 'cached'} if stage == 'key' else {},
+    )
+    assert executor.run({})['generate'] == 'cached'
+    assert calls == [] and executor.seeded_stages == ['generate']
+
+
+def test_unknown_and_unsatisfiable_stages_fail(app):
+    with pytest.raises(KeyError):
+        app.PipelineExecutor({'a': []}, {'a': lambda: 1}).run({}, targets=['missing'])
+    cyclic = app.PipelineExecutor({'a': ['b'], 'b': ['a']}, {'a': lambda b: b, 'b': lambda a: a})
+    with pytest.raises(RuntimeError):
+        cyclic.run({})
+
+
+def test_stage_errors_propagate(app):
+    def fail():
+        raise ValueError("boom")
+
+    executor = app.PipelineExecutor({'a': [], 'b': ['a']}, {'a': fail, 'b': lambda a: a})
+    with pytest.raises(ValueError):
+        executor.run({})
@@ -0,0 +1,42 @@
+import pytest
+
+
+def breakpoints(params):
+    return [block for block in params['system'] if 'cache_control' in block]
+
+
+@pytest.mark.parametrize('model_attr', ['MODEL', 'FAST_MODEL'])
+def test_real_agent_prompt_gets_breakpoint_on_shared_block(app, model_attr):
+    model = getattr(app, model_attr)
+    params = {'model': model, 'system': app.prompt_prefix('middleware')}
+    assert app.prompt_prefix_tokens(params) >= app.min_cacheable_tokens(model)
+    marked = app.with_prompt_cache_breakpoint(params)
+    assert breakpoints(marked) == [marked['system'][0]]
+    # 원래 블록은 바꾸지 않음
+    assert not breakpoints(params)
+
+
+def test_every_task_shares_the_same_first_block(app):
+    first_blocks = {app.prompt_prefix(task)[0]['text'] for task in app.AGENT_TASKS}
+    assert len(first_blocks) == 1
+    selectors = [app.prompt_prefix(task)[1]['text'] for task in app.AGENT_TASKS]
+    assert len(set(selectors)) == len(app.AGENT_TASKS)
+
+
+def test_validation_prompt_with_tool_gets_breakpoint(app):
+    params = {'model': app.MODEL, 'system': app.prompt_prefix('validation'),
+              'tools': [app.VALIDATION_REPORT_TOOL]}
+    assert breakpoints(app.with_prompt_cache_breakpoint(params))
+
+
+def test_short_prefix_gets_no_breakpoint(app):
+    params = {'model': app.MODEL, 'system': [{'type': 'text', 'text': "규칙을 지키세요."}]}
+    assert not breakpoints(app.with_prompt_cache_breakpoint(params))
+
+
+def test_minimum_depends_on_model(app):
+    system = [{'type': 'text', 'text': "규칙을 지키세요. " * 200}]
+    tokens = app.prompt_prefix_tokens({'system': system})
+    assert app.min_cacheable_tokens('claude-sonnet-4-5') <= tokens < app.min_cacheable_tokens('claude-haiku-4-5')
+    assert breakpoints(app.with_prompt_cache_breakpoint({'model': 'claude-sonnet-4-5', 'system': system}))
+    assert not breakpoints(app.with_prompt_cache_breakpoint({'model': 'claude-haiku-4-5', 'system': system}))
@@ -0,0 +1,105 @@
+import textwrap
+from types import SimpleNamespace
+
+
+def make_module(functions, changed=None):
+    """함수 여러 개로 이루어진 모듈 소스를 만듭니다. changed에 든 함수만 본문을 바꿉니다."""
+    changed = changed or set()
+    parts = []
+    for index in range(functions):
+        value = "validated" if index in changed else "raw"
+        parts.append(textwrap.dedent(f'''
+            def handler_{index}(environ, start_response):
+                """요청 {index}를 처리합니다."""
+                path = environ.get('PATH_INFO', '/')
+                headers = [('Content-Type', 'text/plain'), ('X-Handler', '{index}')]
+                start_response('200 OK', headers)
+                return [b'{value}: ' + path.encode()]
+        '''))
+    return "".join(parts)
+
+
+def test_small_change_in_large_code_sends_diff_not_full_code(app):
+    original = make_module(30)
+    improved = make_module(30, changed={7})
+    context = app.improved_code_context(original, improved)
+    assert context.startswith("원본 대비 변경 내용")
+    assert "def handler_7" in context
+    # 바뀌지 않은 함수의 본문은 보내지 않음
+    assert "def handler_20" not in context
+    full = f"개선된 코드:\n{app.code_context(improved)}"
+    assert app.estimate_prompt_tokens(context) < app.estimate_prompt_tokens(full)
+
+
+def test_rewrite_sends_full_code_only(app):
+    original = make_module(3)
+    improved = make_module(3, changed={0, 1, 2})
+    context = app.improved_code_context(original, improved)
+    assert context == f"개선된 코드:\n{improved}"
+    assert "```diff" not in context
+
+
+class RecordingClient:
+    """프롬프트를 기록하고 항상 True로 응답합니다."""
+    def __init__(self):
+        self.calls = []
+        self.messages = self
+
+    def create(self, **params):
+        self.calls.append(params)
+        return SimpleNamespace(content=[SimpleNamespace(type='text', text='True')])
+
+
+def test_verification_prompt_is_smaller_than_full_code(app):
+    original = make_module(30)
+    improved = make_module(30, changed={3})
+    agent = app.MiddlewareAgent()
+    agent.client = RecordingClient()
+    assert agent.verify_improvements(original, improved, {'intent': 'test'})
+    prompt = agent.client.calls[0]['messages'][0]['content']
+    assert app.estimate_prompt_tokens(prompt) < app.estimate_prompt_tokens(improved)
+    assert "개선된 코드:\n" not in prompt
+
+
+def test_token_estimate_counts_hangul_per_character(app):
+    assert app.estimate_prompt_tokens("abcdefgh") == 2
+    assert app.estimate_prompt_tokens("요청 차단") == 5  # 공백은 ASCII로 1/4토큰
+
+
+def test_truncation_keeps_whole_lines_within_budget(app):
+    text = "\n".join(f"line_{i:03d} = {i}" for i in range(100))
+    truncated = app.truncate_to_tokens(text, 50)
+    kept = truncated.splitlines()[:-1]
+    assert kept == text.splitlines()[:len(kept)]
+    assert truncated.endswith(f"... ({100 - len(kept)}줄 생략)")
+    assert app.estimate_prompt_tokens("\n".join(kept)) <= 50
+    assert app.truncate_to_tokens("짧은 글", 50) == "짧은 글"
+
+
+def test_changes_context_sends_diff_within_budget(app):
+    original = make_module(5)
+    improved = make_module(5, changed={2}).replace("def handler_4", "def renamed_4")
+    context = app.code_changes_context(original, improved)
+    assert context.startswith("```diff\n--- original.py\n+++ improved.py")
+    assert "+    return [b'validated: ' + path.encode()]" in context
+    assert app.code_changes_context(original, original) == "변경 사항 없음"
+
+
+def test_large_diff_falls_back_to_change_set_and_leading_hunks(app):
+    original = make_module(40)
+    improved = make_module(40, changed=set(range(0, 40, 2))) + "import json\n"
+    context = app.code_changes_context(original, improved, max_tokens=300)
+    assert context.startswith("변경된 정의 (AST 기준):\n- 변경된 정의: handler_0, handler_2")
+    assert "- 추가된 import: import json" in context
+    assert "@@" in context and context.rstrip("`\n").endswith("개 생략)")
+    # 코드 블록 표시와 생략 안내만큼만 예산을 넘음
+    assert app.estimate_prompt_tokens(context) <= 300 + 20
+
+
+def test_long_code_is_sent_as_an_outline(app):
+    code = make_module(40)
+    outline = app.code_context(code, max_tokens=800)
+    assert outline.startswith("# 코드가 길어 함수 본문을 생략한 개요입니다.")
+    assert "def handler_0(environ, start_response):\n    \"\"\"요청 0를 처리합니다.\"\"\"\n    ..." in outline
+    assert "start_response('200 OK'" not in outline
+    assert app.code_context(make_module(1)) == make_module(1)
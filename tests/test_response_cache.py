@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+
+def message(app, text):
+    return app.Message.model_validate({
+        'id': 'msg_test', 'type': 'message', 'role': 'assistant', 'model': 'test',
+        'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+        'usage': {'input_tokens': 1, 'output_tokens': 1},
+    })
+
+
+@pytest.fixture
+def gateway(app, monkeypatch, tmp_path):
+    """API 대신 보낸 요청을 기록하고 'fresh'로 응답하는 게이트웨이입니다."""
+    cache = app.LLMResponseCache(str(tmp_path / "cache.db"))
+    monkeypatch.setattr(app.anthropic, 'cache', cache)
+    monkeypatch.setattr(app.anthropic, 'telemetry', None)
+    sent = []
+
+    async def send(params, on_text=None, call=None):
+        sent.append(params)
+        return message(app, 'fresh')
+
+    monkeypatch.setattr(app.anthropic, '_send', send)
+    monkeypatch.setattr(app.anthropic, 'sent', sent, raising=False)
+    return app.anthropic
+
+
+def request(app, gateway, agent, method, **params):
+    token = app.LLM_CALL_CONTEXT.set((agent, method))
+    try:
+        return asyncio.run(gateway.acreate_message(**{
+            'model': app.ROUTED_MODEL, 'max_tokens': 10, 'temperature': 0.1,
+            'messages': [{"role": "user", "content": "hi"}], **params}))
+    finally:
+        app.LLM_CALL_CONTEXT.reset(token)
+
+
+@pytest.mark.parametrize('agent, method', [
+    ('MiddlewareAgent', 'generate_improved_code'),  # 같은 모델로 재시도
+    ('ParsingAgent', 'parse_natural_language'),  # 기본 모델로 승격
+])
+def test_retry_drops_the_failed_cached_response(app, gateway, agent, method):
+    # 첫 요청의 응답이 캐시에 저장된 뒤 호출자의 검사에 실패했다고 가정
+    assert request(app, gateway, agent, method).content[0].text == 'fresh'
+    first_key = gateway.cache.make_key(gateway.sent[0])
+    gateway.cache.put(first_key, gateway.sent[0]['model'], message(app, 'invalid'))
+
+    assert request(app, gateway, agent, method, escalate=True).content[0].text == 'fresh'
+    assert gateway.cache.get(first_key) is None
+    # 검사에 실패한 응답이 지워졌으므로 같은 요청은 API로 다시 감
+    request(app, gateway, agent, method)
+    assert len(gateway.sent) == 3
+
+
+def test_sampling_temperature_is_not_cached(app, gateway):
+    for _ in range(2):
+        request(app, gateway, 'SampleRequestAgent', 'generate_sample_requests', temperature=0.5)
+    assert len(gateway.sent) == 2
+    assert gateway.cache.get_stats()['entries'] == 0
+
+
+def test_temperature_is_part_of_the_key(app, gateway):
+    request(app, gateway, 'MiddlewareAgent', 'generate_middleware', temperature=0.1)
+    request(app, gateway, 'MiddlewareAgent', 'generate_middleware', temperature=0.2)
+    request(app, gateway, 'MiddlewareAgent', 'generate_middleware', temperature=0.1)
+    assert len(gateway.sent) == 2
+
+
+def test_cache_hit_skips_the_api(app, gateway):
+    first = request(app, gateway, 'MiddlewareAgent', 'generate_middleware')
+    second = request(app, gateway, 'MiddlewareAgent', 'generate_middleware')
+    assert len(gateway.sent) == 1
+    assert second.content[0].text == first.content[0].text
+    assert gateway.cache.get_stats()['hits'] == 1
+
+
+def test_entries_are_shared_between_instances(app, tmp_path):
+    # Streamlit 프로세스마다 따로 만든 캐시도 같은 파일을 씀
+    first = app.LLMResponseCache(str(tmp_path / "shared.db"))
+    second = app.LLMResponseCache(str(tmp_path / "shared.db"))
+    key = first.make_key({'model': 'm', 'messages': [{'role': 'user', 'content': 'hi'}], 'temperature': 0.1})
+    first.put(key, 'm', message(app, 'cached'))
+    assert second.get(key).content[0].text == 'cached'
+
+
+def test_key_ignores_parameter_order(app):
+    assert (app.LLMResponseCache.make_key({'model': 'm', 'temperature': 0.1, 'max_tokens': 5})
+            == app.LLMResponseCache.make_key({'max_tokens': 5, 'temperature': 0.1, 'model': 'm'}))
+
+
+def test_expired_entries_are_not_returned(app, tmp_path, monkeypatch):
+    cache = app.LLMResponseCache(str(tmp_path / "ttl.db"), ttl_seconds=60)
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    cache.put('key', 'm', message(app, 'old'))
+    now[0] += 61
+    assert cache.get('key') is None
+    assert cache.get_stats()['entries'] == 0
+
+
+def test_least_recently_used_entries_are_evicted(app, tmp_path, monkeypatch):
+    cache = app.LLMResponseCache(str(tmp_path / "lru.db"), max_entries=2)
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'time', lambda: now[0])
+    for key in ('a', 'b'):
+        now[0] += 1
+        cache.put(key, 'm', message(app, key))
+    now[0] += 1
+    cache.get('a')
+    now[0] += 1
+    cache.put('c', 'm', message(app, 'c'))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_total_size_is_bounded(app, tmp_path):
+    size = len(message(app, 'x' * 100).model_dump_json())
+    cache = app.LLMResponseCache(str(tmp_path / "bytes.db"), max_bytes=size * 2)
+    for key in 'abc':
+        cache.put(key, 'm', message(app, 'x' * 100))
+    stats = cache.get_stats()
+    assert stats['entries'] == 2 and stats['bytes'] <= size * 2
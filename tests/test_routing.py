@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def sent(app, monkeypatch, tmp_path):
+    """게이트웨이가 API로 보내려던 (모델, 승격 여부, 캐시 사용 여부)를 기록합니다."""
+    calls = []
+    monkeypatch.setattr(app.anthropic, 'cache', app.LLMResponseCache(str(tmp_path / "cache.db")))
+
+    async def create_message(use_cache, on_text, agent, method, escalated, span, params):
+        calls.append((params['model'], escalated, use_cache))
+
+    monkeypatch.setattr(app.anthropic, '_create_message', create_message)
+    return calls
+
+
+def call(app, agent, method, escalate):
+    token = app.LLM_CALL_CONTEXT.set((agent, method))
+    try:
+        asyncio.run(app.anthropic.acreate_message(model=app.ROUTED_MODEL, max_tokens=10, escalate=escalate,
+                                                  messages=[{"role": "user", "content": "hi"}]))
+    finally:
+        app.LLM_CALL_CONTEXT.reset(token)
+
+
+def test_escalation_from_fast_model_is_counted(app, sent):
+    call(app, 'ParsingAgent', 'parse_natural_language', escalate=True)
+    assert sent == [(app.MODEL, True, False)]
+
+
+def test_retry_on_default_model_is_not_an_escalation(app, sent):
+    call(app, 'MiddlewareAgent', 'generate_improved_code', escalate=True)
+    assert sent == [(app.MODEL, False, False)]
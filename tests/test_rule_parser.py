@@ -0,0 +1,50 @@
+import pytest
+
+
+@pytest.fixture
+def parser(app):
+    return app.RuleBasedParser()
+
+
+@pytest.mark.parametrize("text, intent", [
+    ("CF-IPCountry 헤더로 러시아에서 오는 요청을 차단해줘", 'country_filter'),
+    ("CloudFront-Viewer-Country 기준으로 한국에서 오는 요청만 허용하고 나머지는 막아줘", 'country_filter'),
+    ("10.0.0.0/8 대역에서 오는 요청을 차단", 'ip_filter'),
+    ("Authorization 헤더가 없는 요청은 거부해줘", 'require_header'),
+    ("X-API-Key 헤더가 없으면 요청을 거부", 'require_header'),
+    ("요청 본문 크기를 5MB로 제한", 'body_size_limit'),
+    ("IP당 분당 100회로 요청 수 제한", 'rate_limit'),
+    ("API 키별로 1분에 10번까지 요청 제한", 'rate_limit'),
+    ("Limit clients to 100 requests per minute", 'rate_limit'),
+    ("https://example.com 에서 GET, POST 요청만 CORS 허용", 'cors'),
+])
+def test_parses_simple_requests(parser, text, intent):
+    result = parser.parse(text)
+    assert result is not None and result['intent'] == intent
+
+
+@pytest.mark.parametrize("text", [
+    # 부정
+    "러시아에서 오는 요청은 차단하지 말고 로그만 남겨줘",
+    # 거부가 아닌 다른 동작
+    "X-Request-Id 헤더가 없으면 UUID를 생성해서 넣어줘",
+    # 헤더 값 조건
+    "Content-Type 헤더가 application/json인지 검사",
+    "Authorization 헤더의 Bearer 토큰이 유효한지 검사",
+    # 경로/메서드 범위
+    "/admin 경로로 오는 요청에 Authorization 헤더 필수",
+    "/upload 엔드포인트는 업로드 크기를 10MB로 제한",
+    "Limit uploads to 10MB for POST /files only",
+    "로그인 API는 5분에 3회로 제한",
+    # 추가 동작
+    "IP당 분당 100회 요청 제한, 초과 시 1시간 차단",
+])
+def test_falls_back_to_llm_for_unconsumed_clauses(parser, text):
+    assert parser.parse(text) is None
+
+
+def test_country_filter_needs_proxy_header(app, parser):
+    # 국가 코드를 읽을 프록시 헤더를 모르면 LLM으로 분석
+    assert parser.parse("러시아에서 오는 요청을 차단해줘") is None
+    result = app.RuleBasedParser(country_header='X-Geo-Country').parse("러시아에서 오는 요청을 차단해줘")
+    assert result['parameters']['country_header'] == 'X-Geo-Country'
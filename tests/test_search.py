@@ -0,0 +1,206 @@
+import textwrap
+
+import numpy as np
+
+
+def test_query_embedding_covers_every_chunk(app):
+    manager = app.EmbeddingManager(chunk_tokens=32, overlap=4)
+    text = " ".join([
+        "러시아와 중국에서 오는 요청은 모두 403으로 차단해야 합니다.",
+        *["요청 로그는 남기지 않아도 됩니다." for _ in range(10)],
+        "업로드 본문은 10MB를 넘으면 413 응답을 돌려주세요.",
+    ])
+    chunks = manager.create_embeddings(text)
+    assert len(chunks) > 1
+    query = manager.create_query_embedding(text)
+    assert np.isclose(np.linalg.norm(query), 1.0)
+    last = chunks[-1]['embedding']
+    # 첫 청크만 쓰면 뒤쪽 청크의 내용이 검색에 반영되지 않음
+    assert query @ last > chunks[0]['embedding'] @ last
+
+
+def test_empty_query_has_no_embedding(app):
+    assert app.EmbeddingManager().create_query_embedding("") is None
+
+
+CODE = '''import time
+
+
+class RateLimitMiddleware:
+    """클라이언트 IP별로 1분에 60번까지만 요청을 허용합니다."""
+
+    def __init__(self, app, limit=60):
+        self.app = app
+        self.limit = limit
+        self.hits = {}
+
+    def __call__(self, environ, start_response):
+        client = environ.get('REMOTE_ADDR', '')
+        window = int(time.time() // 60)
+        count = self.hits.get((client, window), 0) + 1
+        self.hits[(client, window)] = count
+        if count > self.limit:
+            start_response('429 Too Many Requests', [('Content-Type', 'text/plain')])
+            return [b'Too Many Requests']
+        return self.app(environ, start_response)
+'''
+
+
+def test_indexer_embeds_code_fields_by_ast_blocks(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    db.save_results({'input_text': "분당 요청 수 제한", 'requirements': {}, 'code': CODE},
+                    {'improved_code': CODE.replace("60", "120")})
+    db.indexer.process_pending()
+
+    rows = db.connections.connection().execute(
+        "SELECT field, text FROM embeddings ORDER BY field, chunk_index").fetchall()
+    fields = {row['field'] for row in rows}
+    assert fields == {'input_text', 'initial_code', 'improved_code'}
+    code_chunks = [row['text'] for row in rows if row['field'] == 'initial_code']
+    # 코드 열은 AST 블록 경계로 나누는 코드 청커를 거침
+    assert app.looks_like_code(CODE)
+    expected = list(db.embedding_manager.iter_chunks(CODE))
+    assert code_chunks == expected
+
+
+def test_semantic_search_matches_code_queries_against_code(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    db.save_results({'input_text': "러시아 차단", 'requirements': {}, 'code': "pass"})
+    db.save_results({'input_text': "분당 요청 수 제한", 'requirements': {}, 'code': CODE})
+    db.indexer.process_pending()
+    search = app.SearchManager(db)
+
+    snippet = textwrap.dedent("    def __call__" + CODE.split("    def __call__")[1])
+    assert app.looks_like_code(snippet)
+    [best, *_] = search.semantic_search(snippet, top_k=2)
+    assert best['input_text'] == "분당 요청 수 제한"
+    # 자연어 요청은 이전 요청하고만 비교하므로 같은 요청의 유사도가 1
+    [same, *_] = search.semantic_search("러시아 차단", top_k=1)
+    assert same['input_text'] == "러시아 차단" and np.isclose(same['similarity'], 1.0, atol=1e-2)
+
+
+def test_fts_query_strips_korean_particles(app):
+    assert app.build_fts_query("러시아로부터 오는 요청을 차단") == '"러시아"* OR "오는"* OR "요청"* OR "차단"*'
+    assert app.build_fts_query("요청 요청을") == '"요청"*'
+    assert app.build_fts_query("?!") == ""
+
+
+def test_search_history_ranks_by_bm25(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    db.save_many([
+        ({'input_text': "중국 요청 차단", 'requirements': {}, 'code': "pass"}, None),
+        ({'input_text': "러시아 요청 차단, 러시아 IP 로그 기록", 'requirements': {}, 'code': "pass"}, None),
+        ({'input_text': "업로드 크기 제한", 'requirements': {'blocked_countries': ['러시아']}, 'code': "pass"}, None),
+        ({'input_text': "응답 압축", 'requirements': {}, 'code': "pass"}, None),
+    ])
+    db.indexer.process_pending()
+
+    results = [row['input_text'] for row in db.search_history("러시아에서 오는 요청", limit=3)]
+    # 먼저 저장된 순서가 아니라 일치도 순서이며, requirements에만 있는 단어도 찾음
+    assert results[0] == "러시아 요청 차단, 러시아 IP 로그 기록"
+    assert set(results) == {"러시아 요청 차단, 러시아 IP 로그 기록", "중국 요청 차단", "업로드 크기 제한"}
+    assert db.search_history("") == []
+
+
+def test_sentence_chunks_respect_budget_and_overlap(app):
+    sentences = [f"{i}번 규칙은 요청 {i}건마다 로그를 남깁니다." for i in range(30)]
+    chunks = list(app.pack_segments(iter(sentences), max_tokens=40, overlap=10, separator=" "))
+    assert len(chunks) > 1
+    assert all(app.count_tokens(chunk) <= 40 for chunk in chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # 앞 청크의 마지막 문장(7토큰)을 이어받음
+        assert list(app.iter_sentences(chunk))[0] == list(app.iter_sentences(previous))[-1]
+    assert " ".join(dict.fromkeys(s for chunk in chunks for s in app.iter_sentences(chunk))) == " ".join(sentences)
+
+
+def test_sentences_do_not_split_inside_addresses(app):
+    text = "192.168.0.1에서 오는 요청은 차단합니다. https://example.com/v1.2 경로는 허용합니다!\n다음 줄"
+    assert list(app.iter_sentences(text)) == [
+        "192.168.0.1에서 오는 요청은 차단합니다.", "https://example.com/v1.2 경로는 허용합니다!", "다음 줄"]
+
+
+def test_long_segments_are_split_into_overlapping_windows(app):
+    text = " ".join(f"t{i}" for i in range(25))
+    windows = list(app.split_tokens(text, max_tokens=10, overlap=3))
+    assert windows == [" ".join(f"t{i}" for i in range(start, min(start + 10, 25))) for start in (0, 7, 14, 21)]
+
+
+def test_code_blocks_follow_ast_boundaries(app):
+    blocks = list(app.iter_code_blocks(CODE, max_tokens=1000))
+    assert blocks[0] == "import time\n\n"
+    assert blocks[1].startswith("class RateLimitMiddleware")
+    # 클래스가 예산을 넘으면 메서드 단위로 다시 나눔
+    methods = list(app.iter_code_blocks(CODE, max_tokens=40))
+    assert methods[1] == "class RateLimitMiddleware:"
+    assert [block.lstrip().split("(")[0] for block in methods[-2:]] == ["def __init__", "def __call__"]
+    assert "\n".join(methods) == CODE.rstrip("\n")
+
+
+def test_chunks_are_embedded_in_batches(app, monkeypatch):
+    manager = app.EmbeddingManager(chunk_tokens=16, overlap=0, batch_size=4)
+    batches = []
+    embed = manager._get_embeddings
+    monkeypatch.setattr(manager, '_get_embeddings', lambda texts: batches.append(len(texts)) or embed(texts))
+
+    texts = [" ".join(f"{j}번째 문장입니다." for j in range(i * 3, i * 3 + 3)) for i in range(5)]
+    results = manager.create_embeddings_many(texts)
+    chunk_count = sum(len(chunks) for chunks in results)
+    assert batches == [4] * (chunk_count // 4) + ([chunk_count % 4] if chunk_count % 4 else [])
+    assert [chunk['text'] for chunk in results[2]] == list(manager.iter_chunks(texts[2]))
+
+
+def test_triggers_log_only_indexed_column_changes(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    db.save_results({'input_text': "러시아 차단", 'requirements': {}, 'code': "pass"})
+    db.indexer.process_pending()
+    [entry] = db.list_history()
+
+    conn = app.sqlite3.connect(db.db_name)
+    try:
+        # 커밋하지 않은 변경은 색인 스레드에 보이지 않으므로 변경 로그를 그대로 확인할 수 있음
+        conn.execute("BEGIN")
+        conn.execute("UPDATE middleware_history SET validation = '통과' WHERE id = ?", (entry['id'],))
+        assert conn.execute("SELECT COUNT(*) FROM history_changes").fetchone()[0] == 0
+        conn.execute("UPDATE middleware_history SET improved_code = 'pass  # 개선' WHERE id = ?", (entry['id'],))
+        conn.execute("DELETE FROM middleware_history WHERE id = ?", (entry['id'],))
+        assert conn.execute("SELECT history_id, op FROM history_changes ORDER BY seq").fetchall() == [
+            (entry['id'], 'upsert'), (entry['id'], 'delete')]
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_updates_and_deletes_reach_every_search_structure(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    db.save_many([({'input_text': text, 'requirements': {}, 'code': "pass"}, None)
+                  for text in ("러시아 차단", "업로드 크기 제한")])
+    db.indexer.process_pending()
+    search = app.SearchManager(db)
+    ids = {row['input_text']: row['id'] for row in db.list_history()}
+
+    with db.connections.transaction() as conn:
+        conn.execute("UPDATE middleware_history SET input_text = '중국 차단' WHERE id = ?", (ids["러시아 차단"],))
+        conn.execute("DELETE FROM middleware_history WHERE id = ?", (ids["업로드 크기 제한"],))
+    db.indexer.process_pending()
+
+    assert db.indexer.pending_count() == 0
+    assert db.search_history("러시아") == [] and db.search_history("업로드") == []
+    assert [row['id'] for row in db.search_history("중국")] == [ids["러시아 차단"]]
+    texts = {row['text'] for row in db.connections.connection().execute("SELECT text FROM embeddings")}
+    assert "중국 차단" in texts and "러시아 차단" not in texts and "업로드 크기 제한" not in texts
+    results = search.semantic_search("업로드 크기 제한", top_k=3)
+    assert [row['input_text'] for row in results] == ["중국 차단"]
+
+
+def test_rows_written_by_other_connections_are_indexed(app, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    conn = app.sqlite3.connect(db.db_name)
+    with conn:
+        # save_many를 거치지 않은 쓰기도 트리거가 변경 로그에 남김
+        conn.execute("INSERT INTO middleware_history (timestamp, input_text, initial_code, improved_code) "
+                     "VALUES ('2024-03-01T00:00:00', '남은 변경', '', '')")
+    conn.close()
+
+    # 변경 로그는 DB에 있으므로 새 색인기(다음 실행)도 이어서 처리
+    app.HistoryIndexer(db.db_name).process_pending()
+    assert [row['input_text'] for row in db.search_history("남은 변경")] == ["남은 변경"]
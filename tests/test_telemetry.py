@@ -0,0 +1,92 @@
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from anthropic import APIConnectionError
+
+
+def test_percentile_uses_nearest_rank(app):
+    values = [5, 1, 4, 2, 3, 10, 9, 8, 7, 6]
+    assert [app.percentile(values, q) for q in (50, 90, 95, 100)] == [5, 9, 10, 10]
+    assert app.percentile([], 50) == 0.0
+
+
+def call(**fields):
+    usage = SimpleNamespace(input_tokens=100, output_tokens=50, cache_read_input_tokens=300,
+                            cache_creation_input_tokens=0)
+    return {'created_at': time.time(), 'agent': 'MiddlewareAgent', 'method': 'generate_middleware',
+            'model': 'm', 'latency_ms': 1000.0, 'outcome': 'ok', 'usage': usage, **fields}
+
+
+def test_summary_counts_outcomes_and_uses_completed_calls_for_latency(app, tmp_path):
+    telemetry = app.LLMTelemetry(str(tmp_path / "telemetry.db"))
+    started = time.time()
+    telemetry.record(call(first_token_ms=200.0, retries=2))
+    telemetry.record(call(latency_ms=3000.0, escalated=True))
+    telemetry.record(call(latency_ms=5.0, outcome='cache_hit', usage=None))
+    telemetry.record(call(latency_ms=90000.0, outcome='error', error='APIStatusError', usage=None))
+    telemetry.record(call(agent='ParsingAgent', method='parse_natural_language'))
+
+    [middleware, parsing] = sorted(app.LLMTelemetry.summarize(telemetry.get_calls(started)),
+                                   key=lambda row: row['agent'])
+    assert middleware['agent'] == 'MiddlewareAgent' and parsing['calls'] == 1
+    assert (middleware['calls'], middleware['errors'], middleware['cache_hits'], middleware['escalations']) == (4, 1, 1, 1)
+    # 캐시 적중과 오류는 지연 시간/토큰 집계에서 제외
+    assert (middleware['p50_ms'], middleware['p99_ms']) == (1000.0, 3000.0)
+    assert middleware['p50_first_token_ms'] == 200.0
+    assert (middleware['input_tokens'], middleware['output_tokens']) == (200, 100)
+    assert middleware['prompt_cache_read_ratio'] == pytest.approx(600 / 800)
+    assert middleware['output_tokens_per_second'] == pytest.approx(100 / 4)
+
+    [by_model] = app.LLMTelemetry.summarize(telemetry.get_calls(started), keys=('model',))
+    assert by_model['calls'] == 5
+    assert telemetry.get_calls(time.time() + 1) == []
+
+
+def test_old_calls_are_dropped_on_startup(app, tmp_path):
+    db_name = str(tmp_path / "telemetry.db")
+    telemetry = app.LLMTelemetry(db_name, retention_days=1)
+    telemetry.record(call(created_at=time.time() - 2 * 86400))
+    telemetry.record(call())
+    telemetry.create_schema()
+    assert len(telemetry.get_calls(0)) == 1
+
+
+def test_gateway_records_each_call(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'LLM_BACKOFF_BASE_SECONDS', 0.001)
+    telemetry = app.LLMTelemetry(str(tmp_path / "telemetry.db"))
+    attempts = []
+
+    class Client:
+        messages = None
+
+        async def create(self, **params):
+            attempts.append(params)
+            if len(attempts) == 1:
+                raise APIConnectionError(request=httpx.Request('POST', 'https://api.test'))
+            return app.Message.model_validate({
+                'id': 'msg', 'type': 'message', 'role': 'assistant', 'model': params['model'],
+                'content': [{'type': 'text', 'text': 'ok'}], 'stop_reason': 'end_turn', 'stop_sequence': None,
+                'usage': {'input_tokens': 7, 'output_tokens': 3},
+            })
+
+    client = Client()
+    client.messages = client
+    gateway = app.LLMGateway(client, cache=None, telemetry=telemetry,
+                             scheduler=app.RequestScheduler(10000, 10 ** 7, 4))
+    token = app.LLM_CALL_CONTEXT.set(('DocumentationAgent', 'generate_documentation'))
+    try:
+        gateway.create_message(model=app.MODEL, max_tokens=5, messages=[{'role': 'user', 'content': 'hi'}])
+    finally:
+        app.LLM_CALL_CONTEXT.reset(token)
+
+    # 기록은 작업 스레드에서 저장되므로 잠시 기다림
+    deadline = time.time() + 5
+    while not telemetry.get_calls(0) and time.time() < deadline:
+        time.sleep(0.01)
+    [row] = telemetry.get_calls(0)
+    assert (row['agent'], row['method'], row['model'], row['outcome']) == (
+        'DocumentationAgent', 'generate_documentation', app.MODEL, 'ok')
+    assert (row['input_tokens'], row['output_tokens'], row['retries']) == (7, 3, 1)
+    assert row['latency_ms'] > 0
@@ -0,0 +1,106 @@
+import pytest
+
+
+def load(code, name, app=None):
+    namespace = {}
+    exec(compile(code, "<middleware>", "exec"), namespace)
+    return namespace[name](app or (lambda environ, start_response: [b"ok"]))
+
+
+def call(code, environ, name='CountryFilterMiddleware'):
+    statuses = []
+    body = load(code, name)(environ, lambda status, headers: statuses.append(status))
+    return statuses[0] if statuses else "200 OK", body
+
+
+def render(app, intent, parameters):
+    template = app.MIDDLEWARE_TEMPLATES[intent]
+    return template.render(template.bind(parameters))
+
+
+@pytest.fixture
+def template(app):
+    return app.MIDDLEWARE_TEMPLATES['country_filter']
+
+
+@pytest.mark.parametrize("parameters", [
+    {'countries': ['RU']},
+    {'countries': ['RU'], 'country_header': 'X-Country'},
+])
+def test_country_filter_requires_proxy_header(template, parameters):
+    # 누구나 보낼 수 있는 헤더로는 템플릿을 만들지 않음
+    assert template.bind(parameters) is None
+
+
+def test_country_filter_reads_proxy_header(template):
+    code = template.render(template.bind({'countries': ['RU'], 'country_header': 'CF-IPCountry'}))
+    assert call(code, {'HTTP_CF_IPCOUNTRY': 'RU'})[0].startswith("403")
+    assert call(code, {'HTTP_CF_IPCOUNTRY': 'KR', 'HTTP_X_COUNTRY': 'RU'})[0].startswith("200")
+
+
+def test_country_filter_rejects_requests_bypassing_proxy(template):
+    values = template.bind({'countries': ['RU'], 'country_header': 'CF-IPCountry', 'trusted_proxies': ['10.0.0.0/8']})
+    code = template.render(values)
+    assert call(code, {'REMOTE_ADDR': '10.1.2.3', 'HTTP_CF_IPCOUNTRY': 'KR'})[0].startswith("200")
+    assert call(code, {'REMOTE_ADDR': '203.0.113.5', 'HTTP_CF_IPCOUNTRY': 'KR'})[0].startswith("403")
+
+
+@pytest.mark.parametrize("forwarded, hops, status", [
+    # 클라이언트가 앞에 허용된 주소를 넣어도 프록시가 덧붙인 실제 주소로 판단
+    ("198.51.100.7, 203.0.113.5", 1, "403"),
+    ("203.0.113.5", 1, "403"),
+    ("198.51.100.7", 1, "200"),
+    # 프록시 두 단계: 오른쪽에서 두 번째 항목이 클라이언트
+    ("198.51.100.7, 203.0.113.5, 10.0.0.2", 2, "403"),
+    ("203.0.113.5, 198.51.100.7, 10.0.0.2", 2, "200"),
+])
+def test_ip_filter_ignores_forged_forwarded_for(app, forwarded, hops, status):
+    code = render(app, 'ip_filter', {'networks': ['203.0.113.0/24'], 'trust_proxy': True, 'trusted_hops': hops})
+    environ = {'REMOTE_ADDR': '10.0.0.1', 'HTTP_X_FORWARDED_FOR': forwarded}
+    assert call(code, environ, 'IPFilterMiddleware')[0].startswith(status)
+
+
+def test_ip_filter_uses_remote_addr_without_proxy(app):
+    code = render(app, 'ip_filter', {'networks': ['203.0.113.0/24']})
+    environ = {'REMOTE_ADDR': '203.0.113.5', 'HTTP_X_FORWARDED_FOR': '198.51.100.7'}
+    assert call(code, environ, 'IPFilterMiddleware')[0].startswith("403")
+
+
+def cached_app(headers):
+    calls = []
+
+    def app(environ, start_response):
+        calls.append(environ.get('HTTP_HOST'))
+        start_response("200 OK", [('Content-Type', 'text/plain'), *headers])
+        return [f"body {len(calls)}".encode()]
+    return app
+
+
+def get(middleware, **environ):
+    statuses = []
+    body = middleware(dict({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/me', 'HTTP_HOST': 'a.example'}, **environ),
+                      lambda status, headers, exc_info=None: statuses.append(dict(headers)))
+    return b"".join(body), statuses[0].get('X-Cache')
+
+
+@pytest.mark.parametrize("headers", [
+    [('Set-Cookie', 'session=abc')],
+    [('Cache-Control', 'private, max-age=60')],
+    [('Cache-Control', 'no-store')],
+    [('Vary', '*')],
+])
+def test_response_cache_skips_per_user_responses(app, headers):
+    origin = cached_app(headers)
+    middleware = load(render(app, 'response_cache', {}), 'ResponseCacheMiddleware', origin)
+    get(middleware)
+    assert get(middleware) == (b"body 2", 'MISS')
+
+
+def test_response_cache_keys_by_host_and_vary(app):
+    origin = cached_app([('Vary', 'Accept-Language')])
+    middleware = load(render(app, 'response_cache', {}), 'ResponseCacheMiddleware', origin)
+    assert get(middleware, HTTP_ACCEPT_LANGUAGE='ko') == (b"body 1", 'MISS')
+    assert get(middleware, HTTP_ACCEPT_LANGUAGE='ko') == (b"body 1", 'HIT')
+    # 다른 호스트나 다른 Vary 헤더 값에는 캐시된 응답을 주지 않음
+    assert get(middleware, HTTP_HOST='b.example', HTTP_ACCEPT_LANGUAGE='ko') == (b"body 2", 'MISS')
+    assert get(middleware, HTTP_ACCEPT_LANGUAGE='en') == (b"body 3", 'MISS')
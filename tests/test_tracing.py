@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def exported(app, monkeypatch):
+    traces = []
+    monkeypatch.setattr(app.tracer, 'sample_rate', 1.0)
+    monkeypatch.setattr(app.tracer, 'export', traces.append)
+    return traces
+
+
+def streaming_agent(app):
+    class StreamingAgent:
+        @app.track_llm_calls
+        def generate_stream(self):
+            def chunks():
+                # 실제 *_stream 메서드처럼 LLM 호출은 처음 읽을 때 일어남
+                with app.tracer.child_span('llm.call'):
+                    assert app.LLM_CALL_CONTEXT.get() == ('StreamingAgent', 'generate_stream')
+                    yield 'a'
+                    yield 'b'
+            return chunks()
+    return StreamingAgent()
+
+
+def spans_by_name(trace):
+    return {span.name: span for span in trace.spans}
+
+
+def test_stream_span_stays_open_until_exhausted(app, exported):
+    stream = streaming_agent(app).generate_stream()
+    # 호출자의 컨텍스트는 바뀌지 않고, 아직 읽지 않았으므로 내보낸 trace도 없음
+    assert app.CURRENT_SPAN.get() is None
+    assert exported == []
+
+    assert list(stream) == ['a', 'b']
+    [trace] = exported
+    spans = spans_by_name(trace)
+    method, llm = spans['StreamingAgent.generate_stream'], spans['llm.call']
+    assert llm.parent_id == method.span_id
+    assert method.end_ns >= llm.end_ns
+    assert method.error is None
+
+
+def test_closing_stream_early_ends_span_without_error(app, exported):
+    stream = streaming_agent(app).generate_stream()
+    assert next(stream) == 'a'
+    stream.close()
+    [trace] = exported
+    assert spans_by_name(trace)['StreamingAgent.generate_stream'].error is None
+
+
+def test_history_reads_are_traced(app, exported, tmp_path):
+    db = app.MiddlewareDatabase(str(tmp_path / "history.db"))
+    with app.tracer.span('request'):
+        db.list_history()
+        db.get_history_dates()
+        db.get_entry(-1)
+    names = {span.name for span in exported[-1].spans}
+    assert {'MiddlewareDatabase.list_history', 'MiddlewareDatabase.get_history_dates',
+            'MiddlewareDatabase.get_entry'} <= names
+
+
+def test_trace_exports_chrome_and_otlp_files(app, tmp_path):
+    tracer = app.Tracer(sample_rate=1.0, output_dir=str(tmp_path), formats=['chrome', 'otlp'])
+    with pytest.raises(ValueError):
+        with tracer.span('request', user='u1'):
+            with tracer.span('db.save', rows=2):
+                pass
+            raise ValueError
+
+    chrome_file, otlp_file = sorted(tmp_path.iterdir())
+    assert chrome_file.name.endswith('.chrome.json') and otlp_file.name.endswith('.otlp.json')
+    chrome = json.loads(chrome_file.read_text(encoding='utf-8'))
+    request, save = [event for event in chrome['traceEvents'] if event['ph'] == 'X']
+    assert (request['name'], save['name']) == ('request', 'db.save')
+    assert save['args']['parent_id'] == request['args']['span_id']
+    assert request['args']['error'] == 'ValueError' and request['dur'] >= save['dur']
+    assert [event['args']['name'] for event in chrome['traceEvents'] if event['ph'] == 'M'] == ['MainThread']
+
+    otlp = json.loads(otlp_file.read_text(encoding='utf-8'))
+    spans = {span['name']: span for span in otlp['resourceSpans'][0]['scopeSpans'][0]['spans']}
+    assert spans['db.save']['parentSpanId'] == spans['request']['spanId']
+    assert 'parentSpanId' not in spans['request']
+    assert spans['request']['status'] == {'code': 2, 'message': 'ValueError'}
+    assert {'key': 'rows', 'value': {'intValue': '2'}} in spans['db.save']['attributes']
+
+
+def test_sampling_is_decided_once_per_request(app, exported, monkeypatch):
+    monkeypatch.setattr(app.tracer, 'sample_rate', 0.5)
+    monkeypatch.setattr(app.random, 'random', lambda: 0.9)
+    with app.tracer.span('request') as root:
+        with app.tracer.span('db.save') as child:
+            assert (root, child) == (None, None)
+    assert exported == []
+
+    monkeypatch.setattr(app.random, 'random', lambda: 0.1)
+    with app.tracer.span('request'):
+        with app.tracer.span('db.save'):
+            pass
+    assert [span.name for span in exported[0].spans] == ['db.save', 'request']
+
+
+def test_background_work_does_not_start_traces(app, exported):
+    with app.tracer.child_span('HistoryIndexer.process_pending') as span:
+        assert span is None
+    assert exported == []
+    with app.tracer.span('request'):
+        with app.tracer.child_span('HistoryIndexer.process_pending') as span:
+            assert span is not None
+    assert len(exported[0].spans) == 2
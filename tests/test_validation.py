@@ -0,0 +1,23 @@
+from types import SimpleNamespace
+
+
+class MalformedToolClient:
+    """report_validation 도구 입력이 항상 스키마에 맞지 않는 응답을 돌려줍니다."""
+    def __init__(self):
+        self.calls = []
+        self.messages = self
+
+    def create(self, **params):
+        self.calls.append(params)
+        return SimpleNamespace(content=[SimpleNamespace(type='tool_use', input={'summary': 1})])
+
+
+def test_malformed_report_falls_back_to_failed_report(app):
+    agent = app.ValidationAgent()
+    agent.client = MalformedToolClient()
+    report = agent.validate_middleware_report("pass", {'intent': 'custom'})
+    assert len(agent.client.calls) == app.VALIDATION_MAX_ATTEMPTS
+    assert report['failed'] and report['meets_requirements'] is False
+    assert report['summary'].startswith("검증 실패")
+    # 히스토리에서 다시 읽어도 실패 표시가 남음
+    assert app.check_validation_report(report) == report
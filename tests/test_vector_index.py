@@ -0,0 +1,192 @@
+import numpy as np
+
+
+def unit_vectors(app, rng, count):
+    vectors = rng.normal(size=(count, app.EMBEDDING_DIM))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_reloads_ann_after_another_process_compacts(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'IVF_MIN_TRAIN_SIZE', 200)
+    db_name = str(tmp_path / "vectors.db")
+    db = app.MiddlewareDatabase(db_name)
+    rng = np.random.default_rng(0)
+    with db.connections.transaction() as conn:
+        for history_id, vector in enumerate(unit_vectors(app, rng, 400)):
+            app.MiddlewareDatabase._insert_embeddings(conn, history_id, 'input_text', [{'text': 'x', 'embedding': vector}])
+
+    # 같은 파일을 쓰는 두 프로세스
+    first, second = app.VectorIndex(db_name), app.VectorIndex(db_name)
+    query = unit_vectors(app, rng, 1)[0]
+    first.search(query)
+    assert first.ann.is_trained
+
+    with db.connections.transaction() as conn:
+        conn.execute("DELETE FROM embeddings WHERE history_id < 60")
+    expected = second.search(query)
+    assert second.store.epoch == first.store.epoch + 1
+
+    # 압축 전 행 위치로 만든 ANN 배정을 쓰지 않고 다시 불러옴
+    assert first.search(query) == expected
+    assert first.store.epoch == second.store.epoch
+    assert first.ann.list_ids.max() < first.store.size
+
+
+def fill_index(app, tmp_path, vectors, **options):
+    db_name = str(tmp_path / "vectors.db")
+    db = app.MiddlewareDatabase(db_name)
+    with db.connections.transaction() as conn:
+        for history_id, vector in enumerate(vectors):
+            app.MiddlewareDatabase._insert_embeddings(conn, history_id, 'input_text', [{'text': 'x', 'embedding': vector}])
+    index = app.VectorIndex(db_name, dim=vectors.shape[1], **options)
+    index.refresh()
+    return index
+
+
+def clustered_vectors(rng, count, dim, clusters=32):
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(clusters, size=count)] + 0.5 * rng.normal(size=(count, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def test_int8_ivf_recall_against_float_scan(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'IVF_MIN_TRAIN_SIZE', 1000)
+    rng = np.random.default_rng(1)
+    vectors = clustered_vectors(rng, 3000, 64)
+    index = fill_index(app, tmp_path, vectors, quantization='int8', nprobe=8)
+    assert index.ann.is_trained
+
+    queries = vectors[rng.choice(len(vectors), 20, replace=False)] + 0.1 * rng.normal(size=(20, 64))
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+    hits = 0
+    for query in queries:
+        expected = set(app.top_k_indices(vectors @ query, 10).tolist())
+        hits += len(expected & {history_id for history_id, _ in index.search(query, top_k=10)})
+    assert hits / (10 * len(queries)) >= 0.9
+
+
+def test_training_and_scan_read_memmap_in_chunks(app, tmp_path, monkeypatch):
+    import tracemalloc
+
+    monkeypatch.setattr(app, 'VECTOR_SCAN_CHUNK_ROWS', 256)
+    rng = np.random.default_rng(2)
+    vectors = clustered_vectors(rng, 20000, 64)
+    index = fill_index(app, tmp_path, vectors, quantization='int8', index_type='exact')
+    full_matrix_bytes = vectors.nbytes
+    ivf = app.IVFIndex(n_lists=16)
+
+    tracemalloc.start()
+    try:
+        ivf.train(index._float_rows())
+        _, train_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        index.search(vectors[0], top_k=5)
+        _, search_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert np.bincount(ivf.list_ids, minlength=16).sum() == len(vectors)
+    # 전체 float32 행렬(약 5MB)을 만들지 않음
+    assert train_peak < full_matrix_bytes / 4
+    assert search_peak < full_matrix_bytes / 4
+
+
+def test_ivf_candidates_cover_probed_lists(app):
+    rng = np.random.default_rng(3)
+    vectors = clustered_vectors(rng, 2000, 32)
+    ivf = app.IVFIndex(n_lists=16)
+    ivf.train(vectors)
+    assert sorted(np.concatenate(ivf.lists).tolist()) == list(range(len(vectors)))
+
+    query = vectors[0]
+    assert 0 in ivf.candidates(query, nprobe=1)
+    sizes = [len(ivf.candidates(query, nprobe)) for nprobe in (1, 4, 16)]
+    assert sizes[0] < sizes[1] < sizes[2] == len(vectors)
+
+    # 새 행은 가장 가까운 군집에 추가
+    ivf.add(len(vectors), vectors[:3])
+    assert len(ivf.list_ids) == len(vectors) + 3
+    assert len(vectors) in ivf.candidates(vectors[0], nprobe=1)
+
+
+def test_ivf_recall_grows_with_nprobe(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'IVF_MIN_TRAIN_SIZE', 1000)
+    rng = np.random.default_rng(4)
+    vectors = clustered_vectors(rng, 3000, 64)
+    index = fill_index(app, tmp_path, vectors, quantization='float32')
+    assert index.ann.is_trained
+    queries = rng.normal(size=(20, 64)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    def recall(nprobe):
+        index.nprobe = nprobe
+        hits = 0
+        for query in queries:
+            expected = set(app.top_k_indices(vectors @ query, 10).tolist())
+            hits += len(expected & {history_id for history_id, _ in index.search(query, top_k=10)})
+        return hits / (10 * len(queries))
+
+    recalls = [recall(nprobe) for nprobe in (1, 8, len(index.ann.centroids))]
+    assert recalls[0] <= recalls[1] <= recalls[2]
+    # 모든 군집을 탐색하면 전체 스캔과 같음
+    assert recalls[2] == 1.0
+
+
+def test_saved_ivf_is_reused_only_for_the_same_epoch(app, tmp_path):
+    rng = np.random.default_rng(5)
+    vectors = clustered_vectors(rng, 500, 16)
+    ivf = app.IVFIndex(n_lists=8)
+    ivf.train(vectors[:400])
+    path = str(tmp_path / "ivf.npz")
+    ivf.save(path, row_count=400, last_row_id=400, epoch=2)
+
+    loaded = app.IVFIndex(n_lists=8)
+    assert loaded.load(path, vectors, last_row_id=500, epoch=2)
+    # 저장 이후 추가된 행은 불러올 때 배정
+    assert np.array_equal(loaded.list_ids[:400], ivf.list_ids)
+    assert len(loaded.list_ids) == 500
+    assert not app.IVFIndex(n_lists=8).load(path, vectors, last_row_id=500, epoch=3)
+    assert not app.IVFIndex(n_lists=8).load(str(tmp_path / "missing.npz"), vectors, last_row_id=500, epoch=2)
+
+
+def test_int8_round_trip_keeps_cosine(app):
+    rng = np.random.default_rng(6)
+    vectors = unit_vectors(app, rng, 50).astype(np.float32)
+    blobs, scales = zip(*(app.encode_embedding(vector, 'int8') for vector in vectors))
+    assert all(len(blob) == app.EMBEDDING_DIM for blob in blobs)
+
+    # float32와 int8 BLOB이 섞여 있어도 복원
+    float_blob, no_scale = app.encode_embedding(vectors[0], 'float32')
+    decoded = app.decode_embeddings([float_blob, *blobs], [no_scale, *scales], app.EMBEDDING_DIM)
+    assert np.array_equal(decoded[0], vectors[0])
+    cosine = np.sum(decoded[1:] * vectors, axis=1) / np.linalg.norm(decoded[1:], axis=1)
+    assert cosine.min() > 0.999
+
+    rows = app.DequantizedRows(*app.quantize_int8(vectors))
+    assert np.allclose(rows[[3, 7]], decoded[[4, 8]])
+
+
+def test_hamming_distance_counts_differing_signs(app):
+    rng = np.random.default_rng(7)
+    vectors = rng.normal(size=(20, 100))
+    codes = app.pack_bits(vectors)
+    assert codes.dtype == np.uint64 and codes.shape == (20, 2)
+    expected = ((vectors > 0) != (vectors[0] > 0)).sum(axis=1)
+    assert np.array_equal(app.hamming_distances(codes, codes[0]), expected)
+
+
+def test_binary_index_rescores_hamming_candidates(app, tmp_path):
+    rng = np.random.default_rng(8)
+    vectors = clustered_vectors(rng, 2000, 64)
+    index = fill_index(app, tmp_path, vectors, quantization='binary', index_type='exact')
+    # 부호 비트만 메모리에 보관
+    assert index.matrix is None and index.bits.nbytes == len(vectors) * 8
+
+    hits = 0
+    for row in rng.choice(len(vectors), 10, replace=False):
+        query = vectors[row]
+        expected = set(app.top_k_indices(vectors @ query, 5).tolist())
+        results = index.search(query, top_k=5)
+        assert results[0][0] == row
+        hits += len(expected & {history_id for history_id, _ in results})
+    assert hits / 50 >= 0.9